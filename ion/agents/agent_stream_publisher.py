@@ -15,6 +15,8 @@ __license__ = 'Apache 2.0'
 from pyon.public import log
 
 # Standard imports.
+from collections import deque
+import time
 import uuid
 
 # 3rd party.
@@ -33,18 +35,31 @@ from pyon.core.object import IonObjectDeserializer
 
 from ion.agents.populate_rdt import populate_rdt
 
+# Publish every particle in its own granule unless batching is configured.
+DEFAULT_PUBBATCH = {'particles' : 1, 'bytes' : 0, 'latency' : 0}
+
 class AgentStreamPublisher(object):
     """
+    Buffers the particles of each stream and publishes them as granules.
+
+    Each stream buffer holds up to buffer_size particles, once full the oldest
+    particles are dropped. With a pubrate the buffer is published every pubrate
+    seconds. Otherwise it is published as soon as it holds pubbatch particles
+    or bytes, or latency milliseconds after its oldest particle arrived,
+    whichever comes first.
     """
-    def __init__(self, agent, flush_on_publish=False):
+    def __init__(self, agent, flush_on_publish=False, buffer_size=None):
         self._agent = agent
         self._stream_defs = {}
         self._publishers = {}
         self._stream_greenlets = {}
+        self._flush_greenlets = {}
         self._stream_buffers = {}
+        self._buffer_bytes = {}
         self._connection_ID = None
         self._connection_index = {}
         self._flush_on_publish = flush_on_publish
+        self._buffer_size = buffer_size or self._agent.CFG.get('stream_buffer_size', 100000)
         
         stream_info = self._agent.CFG.get('stream_config', None)
         if not stream_info:
@@ -58,6 +73,7 @@ class AgentStreamPublisher(object):
         self._construct_streams(stream_info)
         self._construct_publishers(stream_info)
         agent.aparam_set_streams = self.aparam_set_streams
+        agent.aparam_set_streamstats = self.aparam_set_streamstats
         
     def _construct_streams(self, stream_info):
         decoder = IonObjectDeserializer(obj_registry=get_obj_registry())
@@ -75,6 +91,13 @@ class AgentStreamPublisher(object):
                     rdt = RecordDictionaryTool(stream_definition_id=stream_def)    
                 self._agent.aparam_streams[stream_name] = rdt.fields
                 self._agent.aparam_pubrate[stream_name] = 0
+                self._agent.aparam_pubbatch[stream_name] = dict(DEFAULT_PUBBATCH)
+                self._agent.aparam_streamstats[stream_name] = {'particles_in' : 0,
+                                                               'particles_out' : 0,
+                                                               'granules_out' : 0,
+                                                               'dropped' : 0,
+                                                               'buffered' : 0,
+                                                               'max_latency' : 0.0}
             except Exception as e:
                 errmsg = 'Instrument agent %s' % self._agent._proc_name
                 errmsg += 'error constructing stream %s. ' % stream_name
@@ -82,6 +105,7 @@ class AgentStreamPublisher(object):
                 log.error(errmsg)
                 
         self._agent.aparam_set_pubrate = self.aparam_set_pubrate
+        self._agent.aparam_set_pubbatch = self.aparam_set_pubbatch
 
     def _construct_publishers(self, stream_info):
         for (stream_name, stream_config) in stream_info.iteritems():
@@ -95,7 +119,9 @@ class AgentStreamPublisher(object):
                                     stream_id=stream_id, stream_route=route)
                 self._publishers[stream_name] = publisher
                 self._stream_greenlets[stream_name] = None
-                self._stream_buffers[stream_name] = []
+                self._flush_greenlets[stream_name] = None
+                self._stream_buffers[stream_name] = deque(maxlen=self._buffer_size)
+                self._buffer_bytes[stream_name] = 0
         
             except Exception as e:
                 errmsg = 'Instrument agent %s' % self._agent._proc_name
@@ -112,9 +138,9 @@ class AgentStreamPublisher(object):
         
         try:
             stream_name = sample['stream_name']
-            self._stream_buffers[stream_name].insert(0, sample)
+            self._buffer_sample(stream_name, sample)
             if not self._stream_greenlets[stream_name]:
-                self._publish_stream_buffer(stream_name)
+                self._check_batch(stream_name)
 
         except KeyError:
             log.warning('Instrument agent %s received sample with bad stream name %s.',
@@ -128,7 +154,7 @@ class AgentStreamPublisher(object):
         for sample in sample_list:
             try:
                 stream_name = sample['stream_name']
-                self._stream_buffers[stream_name].insert(0, sample)
+                self._buffer_sample(stream_name, sample)
                 streams.add(stream_name)
             except KeyError:
                 log.warning('Instrument agent %s received sample with bad stream name %s.',
@@ -136,11 +162,100 @@ class AgentStreamPublisher(object):
 
         for stream_name in streams:
             if not self._stream_greenlets[stream_name]:
+                self._check_batch(stream_name)
+
+    def _buffer_sample(self, stream_name, sample):
+        """
+        Appends the sample to the stream buffer, dropping the oldest sample when full.
+        """
+        buf = self._stream_buffers[stream_name]
+        stats = self._agent.aparam_streamstats[stream_name]
+        if len(buf) == buf.maxlen:
+            self._buffer_bytes[stream_name] -= buf[0][1]
+            stats['dropped'] += 1
+            if stats['dropped'] == 1 or stats['dropped'] % 1000 == 0:
+                log.warning('Instrument agent %s stream %s buffer full, %i particles dropped.',
+                            self._agent._proc_name, stream_name, stats['dropped'])
+        size = self._sample_size(sample)
+        buf.append((time.time(), size, sample))
+        self._buffer_bytes[stream_name] += size
+        stats['particles_in'] += 1
+        stats['buffered'] = len(buf)
+
+    @staticmethod
+    def _sample_size(sample):
+        """
+        Approximate size of the sample values in bytes.
+        """
+        size = 0
+        for value in sample.get('values', ()):
+            value = value.get('value')
+            size += len(value) if isinstance(value, basestring) else 8
+        return size
+
+    def _check_batch(self, stream_name):
+        """
+        Publishes the stream buffer if the batch is complete, otherwise makes
+        sure it is published once the oldest particle is latency ms old.
+        """
+        policy = self._agent.aparam_pubbatch[stream_name]
+        buf = self._stream_buffers[stream_name]
+        if len(buf) >= policy['particles'] or \
+            (policy['bytes'] and self._buffer_bytes[stream_name] >= policy['bytes']):
+            self._publish_stream_buffer(stream_name)
+        elif buf and policy['latency'] and not self._flush_greenlets[stream_name]:
+            delay = buf[0][0] + policy['latency'] / 1000.0 - time.time()
+            self._flush_greenlets[stream_name] = gevent.spawn_later(max(delay, 0), self._flush_loop, stream_name)
+
+    def _flush_loop(self, stream_name):
+        self._flush_greenlets[stream_name] = None
+        self._publish_stream_buffer(stream_name)
+
+    def flush_all(self):
+        """
+        Publishes every buffered particle, for agents shutting down.
+        """
+        for (stream_name, gl) in self._flush_greenlets.items():
+            if gl:
+                gl.kill(block=False)
+                self._flush_greenlets[stream_name] = None
+        for (stream_name, buf) in self._stream_buffers.iteritems():
+            if buf:
                 self._publish_stream_buffer(stream_name)
 
 
     def aparam_set_streams(self, params):
         return -1
+
+    def aparam_set_streamstats(self, params):
+        return -1
+
+    def aparam_set_pubbatch(self, params):
+        """
+        Sets the particles, bytes and latency (ms) batching limits of streams.
+        A stream batching more than 1 particle, or by bytes, needs a latency.
+        Nothing is set unless every stream's limits are valid.
+        """
+        if not isinstance(params, dict):
+            return -1
+
+        new_policies = {}
+        for (stream_name, policy) in params.iteritems():
+            if not isinstance(stream_name, str) \
+                or stream_name not in self._agent.aparam_streams.keys() \
+                or not isinstance(policy, dict) \
+                or not set(policy.keys()) <= set(DEFAULT_PUBBATCH.keys()) \
+                or not all(isinstance(v, (int, float)) and v >= 0 for v in policy.values()):
+                return -1
+            new_policy = dict(self._agent.aparam_pubbatch[stream_name], **policy)
+            if (new_policy['particles'] > 1 or new_policy['bytes']) and not new_policy['latency']:
+                return -1
+            new_policies[stream_name] = new_policy
+
+        for (stream_name, new_policy) in new_policies.iteritems():
+            self._agent.aparam_pubbatch[stream_name] = new_policy
+            if not self._stream_greenlets[stream_name]:
+                self._check_batch(stream_name)
     
     def aparam_set_pubrate(self, params):
         if not isinstance(params, dict):
@@ -197,7 +312,12 @@ class AgentStreamPublisher(object):
                 log.debug("ASP Flush Agent State")
                 self._agent._flush_state()
 
-            buf_len = len(self._stream_buffers[stream_name])
+            if self._flush_greenlets[stream_name]:
+                self._flush_greenlets[stream_name].kill(block=False)
+                self._flush_greenlets[stream_name] = None
+
+            buf = self._stream_buffers[stream_name]
+            buf_len = len(buf)
             if buf_len == 0:
                 return
 
@@ -208,10 +328,12 @@ class AgentStreamPublisher(object):
                 rdt = RecordDictionaryTool(stream_definition=stream_def)
                 
             publisher = self._publishers[stream_name]
-            vals = []
-            for x in xrange(buf_len):
-                vals.append(self._stream_buffers[stream_name].pop())
-    
+            oldest = buf[0][0]
+            vals = [buf.popleft()[2] for x in xrange(buf_len)]
+            self._buffer_bytes[stream_name] = sum(size for (_, size, _) in buf)
+            stats = self._agent.aparam_streamstats[stream_name]
+            stats['buffered'] = len(buf)
+
             rdt = populate_rdt(rdt, vals)
             
             #log.info('Outgoing granule: %s',
@@ -222,6 +344,9 @@ class AgentStreamPublisher(object):
                     connection_index=str(self._connection_index[stream_name]))
             
             publisher.publish(g)
+            stats['particles_out'] += buf_len
+            stats['granules_out'] += 1
+            stats['max_latency'] = max(stats['max_latency'], time.time() - oldest)
             #log.info('Instrument agent %s published data granule on stream %s.',
                 #self._agent._proc_name, stream_name)
             #log.info('Connection id: %s, connection index: %i.',
@@ -365,6 +365,10 @@ class DataSetAgent(InstrumentAgent):
         if len(params)>0:
             self.aparam_set_pubrate(params)
 
+        # Particles waiting for a batch to fill up
+        if self._asp:
+            self._asp.flush_all()
+
         state = self._fsm.get_current_state()
         if state == ResourceAgentState.UNINITIALIZED:
             pass
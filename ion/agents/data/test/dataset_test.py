@@ -1074,7 +1074,7 @@ class DatasetAgentTestCase(IonIntegrationTestCase):
         list of common agent parameters
         @return: list of agent parameters
         '''
-        return ['aggstatus', 'alerts', 'driver_name', 'driver_pid', 'example', 'pubrate', 'streams']
+        return ['aggstatus', 'alerts', 'driver_name', 'driver_pid', 'example', 'pubbatch', 'pubrate', 'streams', 'streamstats']
 
     def _common_agent_commands(self, agent_state):
         '''
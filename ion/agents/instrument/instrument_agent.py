@@ -198,6 +198,20 @@ class InstrumentAgent(ResourceAgent):
         # Use default base class get function.
         self.aparam_set_pubrate = None
 
+        # Dictionary of stream batching limits, used when pubrate is 0.
+        self.aparam_pubbatch = {}
+
+        # The set helper is set by the manager class.
+        # Use default base class get function.
+        self.aparam_set_pubbatch = None
+
+        # Dictionary of stream publication counters.
+        self.aparam_streamstats = {}
+
+        # The set helper is set by the manager class (read only).
+        # We use the default base class get function.
+        self.aparam_set_streamstats = None
+
         # The driver process id. For test instrumentation.
         self.aparam_driver_pid = None
 
@@ -272,6 +286,10 @@ class InstrumentAgent(ResourceAgent):
         
         if len(params)>0:
             self.aparam_set_pubrate(params)
+
+        # Particles waiting for a batch to fill up
+        if self._asp:
+            self._asp.flush_all()
                 
         state = self._fsm.get_current_state()
         if state == ResourceAgentState.UNINITIALIZED:
@@ -1593,6 +1611,11 @@ class InstrumentAgent(ResourceAgent):
         if aparam_pubrate_config and 'pubrate' in aparams:
             self.aparam_set_pubrate(aparam_pubrate_config)
 
+        # If specified and configed, build the pubbatch aparam.
+        aparam_pubbatch_config = self.CFG.get('aparam_pubbatch_config', None)
+        if aparam_pubbatch_config and 'pubbatch' in aparams:
+            self.aparam_set_pubbatch(aparam_pubbatch_config)
+
         # If specified and configed, build the alerts aparam.                
         aparam_alerts_config = self.CFG.get('aparam_alerts_config', None)
         if aparam_alerts_config and 'alerts' in aparams:
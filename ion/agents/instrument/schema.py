@@ -215,6 +215,35 @@ AGENT_SCHEMA_V1 = {
                     }
                 }]
             },
+        "pubbatch" :
+            {
+                "display_name" : "Stream Publication Batching",
+                "description" : "Particles, bytes and latency in milliseconds at which a stream granule is published, when the publication rate is 0.",
+                "visibility" : "READ_WRITE",
+                "type" : "dict",
+                "valid_values" : [{
+                    "key" : {
+                        "display_name" : "Stream Name",
+                        "description" : "A valid stream name published by this agent.",
+                        "type" : "str",
+                        "valid_values" : [
+                            "/parameters/streams/keys"
+                            ]
+                    },
+                    "value" : {
+                        "display_name" : "Batching Limits",
+                        "description" : "Nonnegative particles, bytes and latency limits, the first reached publishes the granule.",
+                        "type" : "dict"
+                    }
+                }]
+            },
+        "streamstats" :
+            {
+                "display_name" : "Stream Statistics",
+                "description" : "Particles received, published and dropped, granules published and maximum latency in seconds of each stream.",
+                "visibility" : "READ_ONLY",
+                "type" : "dict"
+            },
         "alerts" :
             {
                 "display_name" : "Agent Alerts.",
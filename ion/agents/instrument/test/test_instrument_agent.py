@@ -1320,6 +1320,8 @@ class InstrumentAgentTest(IonIntegrationTestCase, InstrumentAgentTestMixin):
                         'alerts',
                         'streams',
                         'pubrate',
+                        'pubbatch',
+                        'streamstats',
                         'aggstatus',
                         'driver_pid',
                         'driver_name'
@@ -2254,6 +2256,8 @@ class InstrumentAgentTest(IonIntegrationTestCase, InstrumentAgentTestMixin):
                         'alerts',
                         'streams',
                         'pubrate',
+                        'pubbatch',
+                        'streamstats',
                         'aggstatus',
                         'driver_pid'
                         ]
@@ -12,9 +12,78 @@ __license__ = 'Apache 2.0'
 
 import numpy
 import base64
+import weakref
 from pyon.public import log
 from ion.agents.data.parsers.parser_utils import DataParticleKey
 
+
+class ParticleColumns(object):
+    """
+    The columns particles fill in the record dictionaries of a stream
+    definition: the fields a particle key or value_id may set and the NumPy
+    dtype of each numeric field. Computed once per FieldIndex, which record
+    dictionaries of the same stream definition share.
+    """
+    _cache = weakref.WeakKeyDictionary()
+
+    def __init__(self, rdt):
+        self.temporal_parameter = rdt.temporal_parameter
+        self.dtypes = {}
+        index = getattr(rdt, '_index', None)
+        if index is None:
+            # Anything acting as a dictionary of the fields
+            self.fields = frozenset(rdt)
+            return
+        self.fields = index.field_set
+        for name in index.quantities & index.field_set:
+            fill_value = index.fill_values[name]
+            value_encoding = index.value_encodings[name]
+            if fill_value is None or value_encoding is None:
+                continue
+            try:
+                dtype = numpy.dtype(value_encoding)
+            except TypeError:
+                continue
+            if dtype.kind in 'iuf':
+                self.dtypes[name] = (dtype, fill_value)
+
+    @classmethod
+    def get(cls, rdt):
+        index = getattr(rdt, '_index', None)
+        if index is None:
+            return cls(rdt)
+        columns = cls._cache.get(index)
+        if columns is None:
+            columns = cls._cache[index] = cls(rdt)
+        return columns
+
+    def column(self, name, size):
+        """
+        Returns a typed array of fill values for a numeric field, otherwise a list of None
+        """
+        if name in self.dtypes:
+            dtype, fill_value = self.dtypes[name]
+            try:
+                column = numpy.empty(size, dtype=dtype)
+                column.fill(fill_value)
+                return column
+            except (TypeError, ValueError):
+                pass
+        return [None] * size
+
+
+def _set_value(data_arrays, name, i, value):
+    """
+    Sets a value, falling back to a list when it doesn't fit the typed column
+    """
+    column = data_arrays[name]
+    try:
+        column[i] = value
+    except (TypeError, ValueError, OverflowError):
+        column = data_arrays[name] = column.tolist()
+        column[i] = value
+
+
 def populate_rdt(rdt, vals):
     """
     Populate a RecordDictionaryTool object with values from a data particle
@@ -39,47 +108,54 @@ def populate_rdt(rdt, vals):
          u'driver_timestamp': 3578927113.75216}]
     @retval A valid, filled RDT structure
     """
+    columns = ParticleColumns.get(rdt)
+    fields = columns.fields
     array_size = len(vals)
-    data_arrays = {}    
-        
+    data_arrays = {}
+    binary_values = {}  # value_id -> ([index], [encoded value]), decoded per field at the end
+
     # Populate the temporal parameter.
-    data_arrays[rdt.temporal_parameter] = [None] * array_size
-        
-    found_preferred_timestamp = False
+    temporal_parameter = columns.temporal_parameter
+    data_arrays[temporal_parameter] = columns.column(temporal_parameter, array_size)
 
     for i, particle in enumerate(vals):
-        preferred_timestamp = DataParticleKey.DRIVER_TIMESTAMP
-        if DataParticleKey.PREFERRED_TIMESTAMP in particle:
-            preferred_timestamp = particle[DataParticleKey.PREFERRED_TIMESTAMP]
-
         for k,v in particle.iteritems():
             if k == DataParticleKey.VALUES:
                 for value_dict in v:
                     value_id = value_dict[DataParticleKey.VALUE_ID]
+                    if value_id not in fields:
+                        continue
+                    if value_id not in data_arrays:
+                        data_arrays[value_id] = columns.column(value_id, array_size)
                     value = value_dict[DataParticleKey.VALUE]
-                    if value_id in rdt:
-                        if value_id not in data_arrays:
-                            data_arrays[value_id] = [None] * array_size
-                        if 'binary' in value_dict:
-                            value = base64.b64decode(value)
-                        data_arrays[value_id][i] = value
-            
-            elif k in rdt:
+                    if 'binary' in value_dict and value is not None:
+                        indexes, encoded = binary_values.setdefault(value_id, ([], []))
+                        indexes.append(i)
+                        encoded.append(value)
+                    elif value is not None:
+                        _set_value(data_arrays, value_id, i, value)
+
+            elif k in fields:
                 if k not in data_arrays:
-                    data_arrays[k] = [None] * array_size
-                data_arrays[k][i] = v
+                    data_arrays[k] = columns.column(k, array_size)
+                if v is not None:
+                    _set_value(data_arrays, k, i, v)
 
-            if k == preferred_timestamp:
-                data_arrays[rdt.temporal_parameter][i] = v
-                found_preferred_timestamp = True
+        # The preferred timestamp wins over a particle key of the same name
+        preferred_timestamp = particle.get(DataParticleKey.PREFERRED_TIMESTAMP, DataParticleKey.DRIVER_TIMESTAMP)
+        timestamp = particle.get(preferred_timestamp)
+        if timestamp is not None:
+            _set_value(data_arrays, temporal_parameter, i, timestamp)
+
+    for value_id, (indexes, encoded) in binary_values.iteritems():
+        for i, value in zip(indexes, map(base64.b64decode, encoded)):
+            _set_value(data_arrays, value_id, i, value)
 
     for k,v in data_arrays.iteritems():
         try:
-            rdt[k] = numpy.array(v)
+            rdt[k] = v if isinstance(v, numpy.ndarray) else numpy.array(v)
         except ValueError:
             log.error("Couldn't set %s as %s", k, repr(v))
             raise
 
     return rdt
-
-            
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+@package ion.agents.test.test_agent_stream_publisher
+@file ion/agents/test/test_agent_stream_publisher.py
+@brief Tests for the stream buffering and batching of the agent stream publisher
+"""
+
+from pyon.util.unit_test import PyonTestCase
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import gevent
+
+from ion.agents.agent_stream_publisher import AgentStreamPublisher
+
+
+def sample(i):
+    return {'stream_name' : 'parsed',
+            'values' : [{'value_id' : 'temp', 'value' : float(i)}]}
+
+
+@attr('UNIT', group='sa')
+class TestAgentStreamPublisher(PyonTestCase):
+
+    def setUp(self):
+        self.agent = Mock()
+        self.agent._proc_name = 'instrument_agent'
+        self.agent.CFG = {'stream_config' : {'parsed' : {'stream_definition_ref' : 'stream_def_id',
+                                                         'exchange_point' : 'science_data',
+                                                         'routing_key' : 'parsed',
+                                                         'stream_id' : 'stream_id'}}}
+        self.agent.aparam_streams = {}
+        self.agent.aparam_pubrate = {}
+        self.agent.aparam_pubbatch = {}
+        self.agent.aparam_streamstats = {}
+
+        self.published = []
+        for name in ['RecordDictionaryTool', 'StreamPublisher']:
+            patcher = patch('ion.agents.agent_stream_publisher.%s' % name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('ion.agents.agent_stream_publisher.populate_rdt',
+                        side_effect=lambda rdt, vals : self.published.append([v['values'][0]['value'] for v in vals]) or rdt)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stream_publisher(self, **kwargs):
+        asp = AgentStreamPublisher(self.agent, **kwargs)
+        asp.reset_connection()
+        return asp
+
+    def test_unbatched(self):
+        asp = self.stream_publisher()
+        for i in xrange(3):
+            asp.on_sample(sample(i))
+
+        self.assertEquals(self.published, [[0.0], [1.0], [2.0]])
+        stats = self.agent.aparam_streamstats['parsed']
+        self.assertEquals((stats['particles_in'], stats['particles_out'], stats['granules_out']), (3, 3, 3))
+
+    def test_batched(self):
+        asp = self.stream_publisher()
+        self.assertEquals(asp.aparam_set_pubbatch({'parsed' : {'particles' : 3}}), -1)
+        self.assertIsNone(asp.aparam_set_pubbatch({'parsed' : {'particles' : 3, 'latency' : 50}}))
+
+        asp.on_sample_mult([sample(i) for i in xrange(5)])
+        self.assertEquals(self.published, [[0.0, 1.0, 2.0, 3.0, 4.0]])
+
+        asp.on_sample(sample(5))
+        asp.on_sample(sample(6))
+        self.assertEquals(len(self.published), 1)
+        asp.on_sample(sample(7))
+        self.assertEquals(self.published[1], [5.0, 6.0, 7.0])
+
+        # The rest goes out once the oldest particle is latency ms old
+        asp.on_sample(sample(8))
+        gevent.sleep(0.2)
+        self.assertEquals(self.published[2], [8.0])
+
+        stats = self.agent.aparam_streamstats['parsed']
+        self.assertEquals((stats['particles_out'], stats['granules_out'], stats['buffered']), (9, 3, 0))
+        self.assertGreater(stats['max_latency'], 0.04)
+
+    def test_bytes(self):
+        asp = self.stream_publisher()
+        asp.aparam_set_pubbatch({'parsed' : {'particles' : 100, 'bytes' : 20, 'latency' : 10000}})
+        for i in xrange(5):
+            asp.on_sample(sample(i))
+        self.assertEquals(self.published, [[0.0, 1.0, 2.0]])
+
+    def test_overflow(self):
+        asp = self.stream_publisher(buffer_size=2)
+        asp.aparam_set_pubbatch({'parsed' : {'particles' : 10, 'latency' : 10000}})
+        for i in xrange(5):
+            asp.on_sample(sample(i))
+
+        stats = self.agent.aparam_streamstats['parsed']
+        self.assertEquals((stats['particles_in'], stats['dropped'], stats['buffered']), (5, 3, 2))
+
+        asp.aparam_set_pubbatch({'parsed' : {'particles' : 1}})
+        self.assertEquals(self.published, [[3.0, 4.0]])
+
+    def test_flush_all(self):
+        asp = self.stream_publisher()
+        asp.aparam_set_pubbatch({'parsed' : {'particles' : 10, 'latency' : 10000}})
+        for i in xrange(3):
+            asp.on_sample(sample(i))
+        self.assertIsNotNone(asp._flush_greenlets['parsed'])
+
+        asp.flush_all()
+        self.assertEquals(self.published, [[0.0, 1.0, 2.0]])
+        self.assertIsNone(asp._flush_greenlets['parsed'])
+        asp.flush_all()
+        self.assertEquals(len(self.published), 1)
+
+    def test_invalid_pubbatch(self):
+        self.agent.CFG['stream_config']['raw'] = dict(self.agent.CFG['stream_config']['parsed'], routing_key='raw')
+        asp = self.stream_publisher()
+        pubbatch = {'parsed' : dict(self.agent.aparam_pubbatch['parsed']),
+                    'raw' : dict(self.agent.aparam_pubbatch['raw'])}
+        self.assertEquals(asp.aparam_set_pubbatch({'parsed' : {'particles' : 5, 'latency' : 100},
+                                                   'raw' : {'particles' : 5}}), -1)
+        self.assertEquals(self.agent.aparam_pubbatch, pubbatch)
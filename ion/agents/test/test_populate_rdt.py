@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+'''
+@file ion/agents/test/test_populate_rdt.py
+@brief Tests and benchmarks for populating record dictionaries with particles
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+
+from ion.agents.data.parsers.parser_utils import DataParticleKey
+from ion.agents.populate_rdt import populate_rdt, ParticleColumns
+from ion.services.dm.utility.granule import RecordDictionaryTool
+
+from coverage_model import ParameterDictionary, ParameterContext, QuantityType, ArrayType, AxisTypeEnum
+from nose.plugins.attrib import attr
+
+import numpy as np
+import base64
+import os
+import time
+
+
+def quantity(pdict, name, encoding, fill_value=-9999, temporal=False):
+    ctxt = ParameterContext(name, param_type=QuantityType(value_encoding=np.dtype(encoding)))
+    ctxt.fill_value = fill_value
+    if temporal:
+        ctxt.axis = AxisTypeEnum.TIME
+        ctxt.uom = 'seconds since 1900-01-01'
+    pdict.add_context(ctxt, is_temporal=temporal)
+
+
+def sbe37_pdict():
+    '''
+    Returns a parameter dictionary like ctd_parsed_param_dict
+    '''
+    pdict = ParameterDictionary()
+    quantity(pdict, 'time', 'float64', temporal=True)
+    for name in ('port_timestamp', 'driver_timestamp'):
+        quantity(pdict, name, 'float64')
+    for name in ('temp', 'conductivity', 'pressure'):
+        quantity(pdict, name, 'float32')
+    pdict.add_context(ParameterContext('quality_flag', param_type=ArrayType()))
+    return pdict
+
+
+def hydrophone_pdict():
+    '''
+    Returns a parameter dictionary like ctd_raw_param_dict
+    '''
+    pdict = ParameterDictionary()
+    quantity(pdict, 'time', 'float64', temporal=True)
+    quantity(pdict, 'length', 'int32')
+    quantity(pdict, 'type', 'int8', fill_value=0)
+    quantity(pdict, 'checksum', 'int32')
+    pdict.add_context(ParameterContext('raw', param_type=ArrayType()))
+    return pdict
+
+
+def sbe37_particles(count):
+    t = 3578927139.
+    return [{DataParticleKey.QUALITY_FLAG        : 'ok',
+             DataParticleKey.PREFERRED_TIMESTAMP : DataParticleKey.PORT_TIMESTAMP,
+             DataParticleKey.STREAM_NAME         : 'parsed',
+             DataParticleKey.PORT_TIMESTAMP      : t + i,
+             DataParticleKey.DRIVER_TIMESTAMP    : t + i + 0.06,
+             DataParticleKey.PKT_FORMAT_ID       : 'JSON_Data',
+             DataParticleKey.PKT_VERSION         : 1,
+             DataParticleKey.VALUES              : [{DataParticleKey.VALUE_ID : 'temp',         DataParticleKey.VALUE : 10 + (i % 100) / 10.},
+                                                    {DataParticleKey.VALUE_ID : 'conductivity', DataParticleKey.VALUE : 26 + (i % 50) / 10.},
+                                                    {DataParticleKey.VALUE_ID : 'pressure',     DataParticleKey.VALUE : 733 + (i % 20)}]}
+            for i in xrange(count)]
+
+
+def hydrophone_particles(count, payload=1024):
+    t = 3578927113.
+    samples = [base64.b64encode(os.urandom(payload)) for i in xrange(16)]
+    return [{DataParticleKey.QUALITY_FLAG        : 'ok',
+             DataParticleKey.PREFERRED_TIMESTAMP : DataParticleKey.DRIVER_TIMESTAMP,
+             DataParticleKey.STREAM_NAME         : 'raw',
+             DataParticleKey.PORT_TIMESTAMP      : t + i,
+             DataParticleKey.DRIVER_TIMESTAMP    : t + i + 0.4,
+             DataParticleKey.VALUES              : [{DataParticleKey.VALUE_ID : 'raw', DataParticleKey.VALUE : samples[i % 16], 'binary' : True},
+                                                    {DataParticleKey.VALUE_ID : 'length',   DataParticleKey.VALUE : payload},
+                                                    {DataParticleKey.VALUE_ID : 'type',     DataParticleKey.VALUE : 1},
+                                                    {DataParticleKey.VALUE_ID : 'checksum', DataParticleKey.VALUE : None}]}
+            for i in xrange(count)]
+
+
+def populate_rdt_by_particle(rdt, vals):
+    '''
+    Fills the rdt one particle value at a time into lists, the way
+    populate_rdt used to
+    '''
+    data_arrays = {rdt.temporal_parameter : [None] * len(vals)}
+    for i, particle in enumerate(vals):
+        preferred_timestamp = particle.get(DataParticleKey.PREFERRED_TIMESTAMP, DataParticleKey.DRIVER_TIMESTAMP)
+        for k, v in particle.iteritems():
+            if k == DataParticleKey.VALUES:
+                for value_dict in v:
+                    value_id = value_dict[DataParticleKey.VALUE_ID]
+                    value = value_dict[DataParticleKey.VALUE]
+                    if value_id in rdt:
+                        if 'binary' in value_dict:
+                            value = base64.b64decode(value)
+                        data_arrays.setdefault(value_id, [None] * len(vals))[i] = value
+            elif k in rdt:
+                data_arrays.setdefault(k, [None] * len(vals))[i] = v
+            if k == preferred_timestamp:
+                data_arrays[rdt.temporal_parameter][i] = v
+    for k, v in data_arrays.iteritems():
+        rdt[k] = np.array(v)
+    return rdt
+
+
+@attr('UNIT', group='sa')
+class PopulateRDTTest(PyonTestCase):
+    def assert_rdts_equal(self, rdt, expected):
+        for field in expected.fields:
+            if expected[field] is None:
+                self.assertIsNone(rdt[field], field)
+            else:
+                np.testing.assert_array_equal(rdt[field], expected[field])
+
+    def test_columns(self):
+        pdict = sbe37_pdict()
+        rdt = RecordDictionaryTool(param_dictionary=pdict)
+        columns = ParticleColumns.get(rdt)
+        self.assertIs(ParticleColumns.get(RecordDictionaryTool(param_dictionary=pdict)), columns)
+        self.assertEquals(columns.temporal_parameter, 'time')
+        self.assertEquals(columns.dtypes['temp'], (np.dtype('float32'), -9999))
+        self.assertNotIn('quality_flag', columns.dtypes)
+
+    def test_parsed(self):
+        particles = sbe37_particles(10)
+        # A missing value and one the column's type can't hold
+        particles[3][DataParticleKey.VALUES][0][DataParticleKey.VALUE] = None
+        particles[4][DataParticleKey.VALUES][2][DataParticleKey.VALUE] = '740.5'
+        del particles[5][DataParticleKey.PREFERRED_TIMESTAMP]
+
+        rdt = populate_rdt(RecordDictionaryTool(param_dictionary=sbe37_pdict()), particles)
+        self.assert_rdts_equal(rdt, populate_rdt_by_particle(RecordDictionaryTool(param_dictionary=sbe37_pdict()), particles))
+        self.assertEquals(rdt['temp'].dtype, np.dtype('float32'))
+        self.assertEquals(rdt['temp'][3], -9999)
+        self.assertEquals(rdt['pressure'][4], 740.5)
+        self.assertEquals(rdt['time'][0], particles[0][DataParticleKey.PORT_TIMESTAMP])
+        self.assertEquals(rdt['time'][5], particles[5][DataParticleKey.DRIVER_TIMESTAMP])
+
+        particles[6][DataParticleKey.VALUES][1][DataParticleKey.VALUE] = 'bad'
+        with self.assertRaises(ValueError):
+            populate_rdt(RecordDictionaryTool(param_dictionary=sbe37_pdict()), particles)
+
+    def test_binary(self):
+        particles = hydrophone_particles(20, payload=8)
+        rdt = populate_rdt(RecordDictionaryTool(param_dictionary=hydrophone_pdict()), particles)
+        self.assert_rdts_equal(rdt, populate_rdt_by_particle(RecordDictionaryTool(param_dictionary=hydrophone_pdict()), particles))
+        self.assertEquals(rdt['raw'][0], base64.b64decode(particles[0][DataParticleKey.VALUES][0][DataParticleKey.VALUE]))
+        self.assertEquals(rdt['length'].dtype, np.dtype('int32'))
+        self.assertIsNone(rdt['checksum'])
+
+
+@attr('UTIL', group='sa')
+class PopulateRDTBenchmark(PyonTestCase):
+    particles = 10000
+
+    def bench(self, name, pdict, particles):
+        then = time.time()
+        rdt = populate_rdt_by_particle(RecordDictionaryTool(param_dictionary=pdict), particles)
+        by_particle = time.time() - then
+
+        then = time.time()
+        populate_rdt(RecordDictionaryTool(param_dictionary=pdict), particles)
+        first = time.time() - then
+
+        then = time.time()
+        columnar = populate_rdt(RecordDictionaryTool(param_dictionary=pdict), particles)
+        cached = time.time() - then
+
+        log.info('%s, %d particles: by particle %.4fs, columnar %.4fs (%.4fs computing the columns)',
+                 name, len(particles), by_particle, cached, first)
+        for field in rdt.fields:
+            if rdt[field] is not None:
+                np.testing.assert_array_equal(columnar[field], rdt[field])
+
+    def test_sbe37(self):
+        self.bench('SBE37 parsed', sbe37_pdict(), sbe37_particles(self.particles))
+
+    def test_hydrophone(self):
+        self.bench('Hydrophone raw', hydrophone_pdict(), hydrophone_particles(self.particles))
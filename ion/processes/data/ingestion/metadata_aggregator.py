@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/ingestion/metadata_aggregator.py
+@description In-process aggregation of the dataset metadata documents
+maintained by ingestion
+'''
+
+import numpy as np
+import time
+
+
+class DatasetMetadata(object):
+    '''
+    Accumulates the bounds, extents, last values and size of a dataset as well
+    as the temporal and geospatial bounds of its data products between flushes
+    to the object store and resource registry.
+    '''
+    def __init__(self):
+        self.bounds      = {}
+        self.last_values = {}
+        self.rows        = {}
+        self.granules    = 0
+        self.t_min       = None
+        self.t_max       = None
+        self.lat         = None
+        self.lon         = None
+        self.created     = time.time()
+
+    def add(self, rdt):
+        '''
+        Accumulates the metadata of a record dictionary
+        '''
+        self.granules += 1
+        elements = len(rdt)
+        for k,v in rdt.iteritems():
+            v = v[:].flatten() # Get the numpy representation (dense array).
+            if v.dtype.char not in ('S', 'O', 'U', 'V'):
+                l_min = np.min(v)
+                l_max = np.max(v)
+                if k in self.bounds:
+                    o_min, o_max = self.bounds[k]
+                    self.bounds[k] = (min(l_min, o_min), max(l_max, o_max))
+                else:
+                    self.bounds[k] = (l_min, l_max)
+                self.last_values[k] = v[-1]
+            self.rows[k] = self.rows.get(k, 0) + elements
+
+        if rdt.temporal_parameter and rdt[rdt.temporal_parameter] is not None:
+            t = rdt[rdt.temporal_parameter][:]
+            t_min = np.min(t)
+            self.t_min = t_min if self.t_min is None else min(self.t_min, t_min)
+            self.t_max = np.max(t)
+
+        lat, lon = self.geo_from_rdt(rdt)
+        if lat and lon:
+            self.lat, self.lon = lat, lon
+
+    def merge(self, newer):
+        '''
+        Accumulates the metadata of an aggregate started after this one
+        '''
+        for k, (l_min, l_max) in newer.bounds.iteritems():
+            if k in self.bounds:
+                o_min, o_max = self.bounds[k]
+                self.bounds[k] = (min(l_min, o_min), max(l_max, o_max))
+            else:
+                self.bounds[k] = (l_min, l_max)
+        self.last_values.update(newer.last_values)
+        for k, rows in newer.rows.iteritems():
+            self.rows[k] = self.rows.get(k, 0) + rows
+        self.granules += newer.granules
+        if newer.t_min is not None:
+            self.t_min = newer.t_min if self.t_min is None else min(self.t_min, newer.t_min)
+            self.t_max = newer.t_max
+        if newer.lat and newer.lon:
+            self.lat, self.lon = newer.lat, newer.lon
+        return self
+
+    @classmethod
+    def geo_from_rdt(cls, rdt):
+        lat = None
+        lon = None
+        for p in rdt:
+            if rdt._rd[p] is None:
+                continue
+            # TODO: Not an all encompassing list of acceptable names for lat and lon
+            if p.lower() in ('lat', 'latitude', 'y_axis'):
+                lat = np.asscalar(rdt[p][-1])
+            elif p.lower() in ('lon', 'longitude', 'x_axis'):
+                lon = np.asscalar(rdt[p][-1])
+            if lat and lon:
+                break
+        return lat, lon
+
+    def age(self):
+        return time.time() - self.created
+
+    def to_doc(self):
+        '''
+        Returns a new metadata document for a dataset without one
+        '''
+        doc = {'bounds'      : dict(self.bounds),
+               'extents'     : dict(self.rows),
+               'last_values' : dict(self.last_values),
+               'size'        : sum(self.rows.values()) * 4}
+        return doc
+
+    def merge_doc(self, doc):
+        '''
+        Merges the accumulated metadata into an existing metadata document
+        '''
+        bounds = doc['bounds']
+        extents = doc['extents']
+        last_values = doc['last_values']
+        rough_size = doc['size']
+        for k, rows in self.rows.iteritems():
+            if k not in bounds:
+                continue
+            if k in self.bounds:
+                l_min, l_max = self.bounds[k]
+                o_min, o_max = bounds[k]
+                bounds[k] = (min(l_min, o_min), max(l_max, o_max))
+                last_values[k] = self.last_values[k]
+            extents[k] = extents[k] + rows
+            rough_size += rows * 4
+        doc['size'] = rough_size
+        return doc
+
+    def update_data_product(self, data_product):
+        '''
+        Applies the accumulated temporal and geospatial bounds to a data product
+        '''
+        if self.t_min is not None:
+            #TODO: Account for non NTP-based timestamps
+            if not data_product.nominal_datetime.start_datetime:
+                data_product.nominal_datetime.start_datetime = self.t_min - 2208988800
+            data_product.nominal_datetime.end_datetime = self.t_max - 2208988800
+
+        if self.lat and self.lon:
+            data_product.geospatial_bounds.geospatial_latitude_limit_north = self.lat
+            data_product.geospatial_bounds.geospatial_latitude_limit_south = self.lat
+            data_product.geospatial_bounds.geospatial_longitude_limit_east = self.lon
+            data_product.geospatial_bounds.geospatial_longitude_limit_west = self.lon
+        return data_product
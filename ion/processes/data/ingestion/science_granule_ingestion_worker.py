@@ -8,15 +8,18 @@
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from ion.services.dm.utility.granule_utils import time_series_domain
 from interface.services.coi.iresource_registry_service import ResourceRegistryServiceClient
-from pyon.core.exception import CorruptionError, NotFound
+from pyon.core.exception import CorruptionError, NotFound, BadRequest, Conflict
 from pyon.ion.event import handle_stream_exception, EventPublisher
 from pyon.ion.event import EventSubscriber
 from pyon.public import log, RT, PRED, CFG, OT
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+from ion.processes.data.ingestion.metadata_aggregator import DatasetMetadata
 from interface.objects import Granule
 from ion.core.process.transform import TransformStreamListener, TransformStreamProcess
 from ion.util.time_utils import TimeUtils
 from ion.util.stored_values import StoredValueManager
+from ion.services.dm.utility.qc_alerts import QCAlertAggregator
+from ion.services.dm.utility.tail_buffer import tail_buffers
 from interface.services.dm.iingestion_worker import BaseIngestionWorker
 from pyon.ion.stream import StreamSubscriber
 from gevent.coros import RLock
@@ -35,11 +38,13 @@ import time
 import uuid
 import numpy as np
 from gevent.queue import Queue
+from gevent.event import Event
 
 numpy_walk = DatasetManagementService.numpy_walk
 
 REPORT_FREQUENCY=100
 MAX_RETRY_TIME=3600
+MAX_CONFLICT_RETRIES=5
 
 class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker):
     CACHE_LIMIT=CFG.get_safe('container.ingestion_cache',5)
@@ -58,7 +63,38 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
 
         self._bad_coverages = {}
 
+        #--------------------------------------------------------------------------------
+        # Batching (group-commit) buffers
+        # - stream_id -> { 'rdts' : [...], 'size' : bytes, 'first' : arrival time }
+        # - stream_id -> lock held while a batch of the stream is persisted
+        #--------------------------------------------------------------------------------
+        self._batches = {}
+        self._persist_locks = {}
+        self.batching = False
+
+        #--------------------------------------------------------------------------------
+        # Dataset metadata accumulated between flushes
+        # - dataset_id -> DatasetMetadata
+        #--------------------------------------------------------------------------------
+        self._metadata = {}
+        self.metadata_flush_granules = 1
+        self.metadata_flush_interval = 0
+        self.monitor_thread = None
+
+        #--------------------------------------------------------------------------------
+        # QC
+        # - QC fields per stream definition
+        # - dataset_id -> (data product ids, expiration)
+        # - Failed QC values collected for qc_window seconds
+        #--------------------------------------------------------------------------------
+        self._qc_fields = {}
+        self._data_product_ids = {}
+        self.data_product_ttl = 300
+        self.qc_window = 0
+        self.qc_alerts = QCAlertAggregator(self._publish_qc_alert)
+
         self.time_stats = Accumulator(format='%3f')
+        self.batch_stats = Accumulator(format='%3f')
         # unique ID to identify this worker in log msgs
         self._id = uuid.uuid1()
 
@@ -100,16 +136,48 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         self.lookup_monitor = EventSubscriber(event_type=OT.ExternalReferencesUpdatedEvent, callback=self._add_lookups, auto_delete=True)
         self.add_endpoint(self.lookup_monitor)
         self.qc_publisher = EventPublisher(event_type=OT.ParameterQCEvent)
+        self.qc_window = self.qc_alerts.window = self.CFG.get_safe('process.qc.window', 0) # seconds
+        self.data_product_ttl = self.CFG.get_safe('process.qc.data_product_ttl', 300) # seconds
+        self.data_product_monitor = EventSubscriber(event_type=OT.ResourceModifiedEvent, origin_type=RT.DataProduct, callback=self._data_product_modified, auto_delete=True)
+        self.add_endpoint(self.data_product_monitor)
         self.connection_id = ''
         self.connection_index = None
+
+        #--------------------------------------------------------------------------------
+        # Batching mode: consecutive granules on a stream are coalesced into a
+        # single append, flush, metadata update and DatasetModified event
+        #--------------------------------------------------------------------------------
+        self.batching = self.CFG.get_safe('process.batching.enabled', False)
+        self.batch_max_granules = self.CFG.get_safe('process.batching.max_granules', 10)
+        self.batch_max_bytes = self.CFG.get_safe('process.batching.max_bytes', 1024 * 1024)
+        self.batch_max_latency = self.CFG.get_safe('process.batching.max_latency', 5.0) # seconds
+        self.batch_lock = RLock()
+
+        #--------------------------------------------------------------------------------
+        # Metadata documents and data product bounds are persisted every
+        # flush_granules granules or flush_interval seconds (0 disables)
+        #--------------------------------------------------------------------------------
+        self.metadata_flush_granules = self.CFG.get_safe('process.metadata.flush_granules', 1)
+        self.metadata_flush_interval = self.CFG.get_safe('process.metadata.flush_interval', 0) # seconds
+
+        self.monitor_quit = Event()
+        if self.batching or self.metadata_flush_interval or self.qc_window:
+            self.monitor_thread = self._process.thread_manager.spawn(self._monitor, thread_name='%s-monitor' % self.id)
         
         self.start_listener()
 
     def on_quit(self): #pragma no cover
-        self.event_publisher.close()
-        self.qc_publisher.close()
+        if self.monitor_thread:
+            self.monitor_quit.set()
+            self.monitor_thread.join(timeout=10)
+            self.monitor_thread = None
         if self.subscriber_thread:
             self.stop_listener()
+        self.flush_batches()
+        self.flush_all_metadata()
+        self.qc_alerts.flush()
+        self.event_publisher.close()
+        self.qc_publisher.close()
         for stream, coverage in self._coverages.iteritems():
             try:
                 coverage.close(timeout=5)
@@ -130,6 +198,8 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         with self.thread_lock:
             self.subscriber.close()
             self.subscriber_thread.join(timeout=10)
+            self.flush_batches()
+            self.flush_all_metadata()
             for stream, coverage in self._coverages.iteritems():
                 try:
                     coverage.close(timeout=5)
@@ -169,114 +239,91 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         return data_products
 
 
-    def initialize_metadata(self, dataset_id, rdt):
+    def update_metadata(self, dataset_id, rdt):
         '''
-        Initializes a metadata document in the object store. The document
-        contains information about the bounds and extents of the dataset as
-        well other metadata to improve performance.
-
+        Accumulates the latest information available for the dataset's
+        metadata document, it's persisted on the configured schedule
         '''
-
-        object_store = self.container.object_store
-        key = dataset_id
-        bounds = {}
-        extents = {}
-        last_values = {}
-        rough_size = 0
-        for k,v in rdt.iteritems():
-            v = v[:].flatten()
-            if v.dtype.char not in ('S', 'O', 'U', 'V'):
-                bounds[k] = (np.min(v), np.max(v))
-                last_values[k] = v[-1]
-            extents[k] = len(rdt)
-            rough_size += len(rdt) * 4
-
-        doc = {'bounds':bounds, 'extents':extents, 'last_values':last_values, 'size': rough_size}
-        doc = numpy_walk(doc)
-        object_store.create_doc(doc, object_id=key)
-        return 
-
-    def update_metadata(self, dataset_id, rdt):
+        metadata = self._metadata.get(dataset_id)
+        if metadata is None:
+            metadata = self._metadata[dataset_id] = DatasetMetadata()
+        metadata.add(rdt)
+        if metadata.granules >= self.metadata_flush_granules:
+            self.flush_metadata(dataset_id)
+        elif self.metadata_flush_interval and metadata.age() >= self.metadata_flush_interval:
+            self.flush_metadata(dataset_id)
+
+    def flush_metadata(self, dataset_id):
         '''
-        Updates the metada document with the latest information available
+        Persists the accumulated metadata for a dataset to the object store
+        and the dataset's data products. Revision conflicts are resolved by
+        re-reading the document and merging again. Metadata that couldn't be
+        written is kept, along with anything accumulated meanwhile, for the
+        next flush. Errors aren't raised: the granule is already persisted and
+        retrying it would add its metadata twice.
         '''
+        # Granules ingested during the I/O accumulate into a new aggregate
+        metadata = self._metadata.pop(dataset_id, None)
+        if metadata is None:
+            return
+        try:
+            written = self._write_metadata(dataset_id, metadata)
+        except Exception:
+            log.exception('Failed to persist metadata for dataset %s, keeping it for the next flush', dataset_id)
+            written = False
+        if not written:
+            self._restore_metadata(dataset_id, metadata)
 
-        self.update_data_product_metadata(dataset_id, rdt)
+    def _write_metadata(self, dataset_id, metadata):
+        self.update_data_product_metadata(dataset_id, metadata)
 
-        # Grab the document
         object_store = self.container.object_store
-        key = dataset_id
-        try:
-            doc = object_store.read_doc(key)
-        except NotFound:
-            return self.initialize_metadata(dataset_id, rdt)
-        # These are the fields we're interested in
-        bounds = doc['bounds']
-        extents = doc['extents']
-        last_values = doc['last_values']
-        rough_size = doc['size']
-        for k,v in rdt.iteritems():
-            if k not in bounds:
-                continue
+        for i in xrange(MAX_CONFLICT_RETRIES):
+            try:
+                doc = object_store.read_doc(dataset_id)
+            except NotFound:
+                try:
+                    object_store.create_doc(numpy_walk(metadata.to_doc()), object_id=dataset_id)
+                    return True
+                except (BadRequest, Conflict):
+                    # Created in the meantime by another worker
+                    continue
+            doc = metadata.merge_doc(doc)
+            try:
+                object_store.update_doc(numpy_walk(doc))
+                return True
+            except Conflict:
+                log.debug('Conflict updating metadata for dataset %s, merging again', dataset_id)
+        log.error('Unable to update the metadata document for dataset %s', dataset_id)
+        return False
 
-            v = v[:].flatten() # Get the numpy representation (dense array).
-            if v.dtype.char not in ('S', 'O', 'U', 'V'):
-                l_min = np.min(v)
-                l_max = np.max(v)
-                o_min, o_max = bounds[k]
-                bounds[k] = (min(l_min, o_min), max(l_max, o_max))
-                last_values[k] = v[-1]
-            # Update the bounds
-            # Increase the extents
-            extents[k] = extents[k] + len(rdt)
-            # How about the last value?
-
-            rough_size += len(rdt) * 4
-            doc['size'] = rough_size
-        # Sanitize it
-        doc = numpy_walk(doc)
-        object_store.update_doc(doc)
-
-    def update_data_product_metadata(self, dataset_id, rdt):
-        data_products = self._get_data_products(dataset_id)
-        for data_product in data_products:
-            self.update_time(data_product, rdt[rdt.temporal_parameter][:])
-            self.update_geo(data_product, rdt)
-            self.container.resource_registry.update(data_product)
-
-    def update_time(self, data_product, t):
-        #TODO: Account for non NTP-based timestamps
-        t_min = np.min(t)
-        t_min -= 2208988800
-        t_max = np.max(t)
-        t_max -= 2208988800
-
-        if not data_product.nominal_datetime.start_datetime:
-            data_product.nominal_datetime.start_datetime = t_min
-        data_product.nominal_datetime.end_datetime = t_max
-
-    def update_geo(self, data_product, rdt):
-        lat = None
-        lon = None
-        for p in rdt:
-            if rdt._rd[p] is None:
-                continue
-            # TODO: Not an all encompassing list of acceptable names for lat and lon
-            if p.lower() in ('lat', 'latitude', 'y_axis'):
-                lat = np.asscalar(rdt[p][-1])
-            elif p.lower() in ('lon', 'longitude', 'x_axis'):
-                lon = np.asscalar(rdt[p][-1])
-            if lat and lon:
-                break
+    def _restore_metadata(self, dataset_id, metadata):
+        newer = self._metadata.get(dataset_id)
+        if newer is not None:
+            metadata.merge(newer)
+        self._metadata[dataset_id] = metadata
 
-        if lat and lon:
-            data_product.geospatial_bounds.geospatial_latitude_limit_north = lat
-            data_product.geospatial_bounds.geospatial_latitude_limit_south = lat
-            data_product.geospatial_bounds.geospatial_longitude_limit_east = lon
-            data_product.geospatial_bounds.geospatial_longitude_limit_west = lon
+    def flush_all_metadata(self, max_age=None):
+        '''
+        Persists the accumulated metadata for every dataset, or only for the
+        datasets whose metadata is older than max_age seconds.
+        '''
+        for dataset_id, metadata in self._metadata.items():
+            if max_age is None or metadata.age() >= max_age:
+                self.flush_metadata(dataset_id)
 
+    def update_data_product_metadata(self, dataset_id, metadata):
+        rr_client = self.container.resource_registry
+        data_products = self._get_data_products(dataset_id)
+        for data_product in data_products:
+            for i in xrange(MAX_CONFLICT_RETRIES):
+                metadata.update_data_product(data_product)
+                try:
+                    rr_client.update(data_product)
+                    break
+                except Conflict:
+                    data_product = rr_client.read(data_product._id)
 
-    
     def get_dataset(self,stream_id):
         '''
         Memoization (LRU) of _new_dataset
@@ -328,26 +375,60 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
     def dataset_changed(self, dataset_id, extents, window):
         self.event_publisher.publish_event(origin=dataset_id, author=self.id, extents=extents, window=window)
 
+    def qc_fields(self, rdt):
+        '''
+        The QC fields alerted on during ingestion, per stream definition
+        '''
+        key = rdt._stream_def or tuple(rdt._rd)
+        fields = self._qc_fields.get(key)
+        if fields is None:
+            fields = self._qc_fields[key] = [field for field in rdt._rd if field.endswith('glblrng_qc') or field.endswith('loclrng_qc')]
+        return fields
+
     def evaluate_qc(self, rdt, dataset_id):
         if self.qc_enabled:
-            for field in rdt.fields:
-                if not (field.endswith('glblrng_qc') or field.endswith('loclrng_qc')):
-                    continue
+            fields = self.qc_fields(rdt)
+            if not fields:
+                return
+            timestamps = rdt[rdt.temporal_parameter]
+            for field in fields:
                 try:
                     values = rdt[field]
                     if values is not None:
-                        if not all(values):
-                            topology = np.where(values==0)
-                            timestamps = rdt[rdt.temporal_parameter][topology[0]]
-                            self.flag_qc_parameter(dataset_id, field, timestamps.tolist(), {})
+                        self.qc_alerts.add(dataset_id, field, timestamps, values)
                 except:
                     continue
+
+    def _publish_qc_alert(self, alert):
+        '''
+        Publishes the failed values of a QC parameter, every failed timestamp
+        when alerts aren't collected over a window and the first timestamp of
+        each range otherwise. The ranges are in the configuration.
+        '''
+        temporal_values = [r[0] for r in alert.ranges] if self.qc_window else alert.timestamps
+        self.flag_qc_parameter(alert.dataset_id, alert.parameter, temporal_values, {'ranges':alert.ranges})
+
     def flag_qc_parameter(self, dataset_id, parameter, temporal_values, configuration):
-        data_product_ids, _ = self.container.resource_registry.find_subjects(object=dataset_id, predicate=PRED.hasDataset, subject_type=RT.DataProduct, id_only=True)
-        for data_product_id in data_product_ids:
+        for data_product_id in self.get_data_product_ids(dataset_id):
             description = 'Automated Quality Control Alerted on %s' % parameter
             self.qc_publisher.publish_event(origin=data_product_id, qc_parameter=parameter, temporal_values=temporal_values, configuration=configuration, description=description)
 
+    def get_data_product_ids(self, dataset_id):
+        '''
+        Cached ids of the data products of a dataset, they are dropped when a
+        data product is created, deleted or associated and after data_product_ttl seconds
+        '''
+        entry = self._data_product_ids.get(dataset_id)
+        if entry is None or entry[1] < time.time():
+            data_product_ids, _ = self.container.resource_registry.find_subjects(object=dataset_id, predicate=PRED.hasDataset, subject_type=RT.DataProduct, id_only=True)
+            entry = self._data_product_ids[dataset_id] = (data_product_ids, time.time() + self.data_product_ttl)
+        return entry[0]
+
+    def _data_product_modified(self, event, *args, **kwargs):
+        # Plain updates, like the ones made by flush_metadata, don't change the associations
+        if event.sub_type != 'UPDATE':
+            self._data_product_ids.clear()
+
     def update_connection_index(self, connection_id, connection_index):
         self.connection_id = connection_id
         try:
@@ -403,7 +484,108 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
             log.debug('Empty granule for stream %s', stream_id)
             return
 
-        self.persist_or_timeout(stream_id, rdt)
+        if self.batching:
+            self.buffer_granule(stream_id, rdt)
+        else:
+            self.persist_or_timeout(stream_id, rdt)
+
+    #--------------------------------------------------------------------------------
+    # Batching
+    #--------------------------------------------------------------------------------
+
+    def buffer_granule(self, stream_id, rdt):
+        '''
+        Adds the record dictionary to the stream's batch and persists the batch
+        once it exceeds the configured granule count or size.
+        '''
+        with self.batch_lock:
+            batch = self._batches.get(stream_id)
+            if batch is None:
+                batch = {'rdts':[], 'size':0, 'first':time.time()}
+                self._batches[stream_id] = batch
+            batch['rdts'].append(rdt)
+            batch['size'] += self._rdt_size(rdt)
+            full = len(batch['rdts']) >= self.batch_max_granules or batch['size'] >= self.batch_max_bytes
+        if full:
+            self.flush_batch(stream_id)
+
+    def flush_batch(self, stream_id):
+        '''
+        Merges the buffered record dictionaries for a stream into one
+        contiguous record dictionary and persists it.
+
+        The batch is taken out of the buffers under the batch lock and
+        persisted outside of it, so granules keep being buffered meanwhile.
+        The stream's persist lock keeps the batches of a stream in order.
+        '''
+        with self.batch_lock:
+            persist_lock = self._persist_locks.setdefault(stream_id, RLock())
+        with persist_lock:
+            with self.batch_lock:
+                batch = self._batches.pop(stream_id, None)
+            if not batch:
+                return
+            timer = Timer()
+            rdts = batch['rdts']
+            rdt = RecordDictionaryTool.concatenate(rdts)
+            timer.complete_step('merge')
+            if rdt is None:
+                return
+            self.persist_or_timeout(stream_id, rdt)
+            timer.complete_step('persist')
+            self._add_batch_stats(timer, len(rdts), batch['size'], time.time() - batch['first'])
+
+    def flush_batches(self, max_age=None):
+        '''
+        Persists every pending batch, or only the batches older than max_age seconds.
+        '''
+        with self.batch_lock:
+            now = time.time()
+            stream_ids = [stream_id for stream_id, batch in self._batches.iteritems()
+                          if max_age is None or (now - batch['first']) >= max_age]
+        for stream_id in stream_ids:
+            self.flush_batch(stream_id)
+
+    def _monitor(self):
+        ''' Bounds the latency of buffered granules and accumulated metadata '''
+        intervals = []
+        if self.batching:
+            intervals.append(self.batch_max_latency)
+        if self.metadata_flush_interval:
+            intervals.append(self.metadata_flush_interval)
+        if self.qc_window:
+            intervals.append(self.qc_window)
+        interval = max(min(intervals) / 2., 0.1)
+        while not self.monitor_quit.wait(timeout=interval):
+            if self.batching:
+                try:
+                    self.flush_batches(max_age=self.batch_max_latency)
+                except:
+                    log.exception('Failed to persist batched granules')
+            if self.metadata_flush_interval:
+                self.flush_all_metadata(max_age=self.metadata_flush_interval)
+            if self.qc_window:
+                try:
+                    self.qc_alerts.flush(max_age=self.qc_window)
+                except:
+                    log.exception('Failed to publish QC alerts')
+
+    def _rdt_size(self, rdt):
+        ''' Rough size in bytes of the values in a record dictionary '''
+        size = 0
+        for k,v in rdt.iteritems():
+            size += getattr(v[:], 'nbytes', len(rdt) * 4)
+        return size
+
+    def _add_batch_stats(self, timer, granules, size, latency):
+        self.batch_stats.add(timer)
+        self.batch_stats.add_value('granules', granules)
+        self.batch_stats.add_value('bytes', size)
+        self.batch_stats.add_value('latency', latency)
+        if not log.isEnabledFor(DEBUG) or self.batch_stats.get_count() % REPORT_FREQUENCY>0:
+            return
+        for step in 'merge', 'persist', 'granules', 'bytes', 'latency':
+            log.debug('%s batch %s: %s', self._id, step, self.batch_stats.to_string(step))
 
     def persist_or_timeout(self, stream_id, rdt):
         """ retry writing coverage multiple times and eventually time out """
@@ -449,13 +631,12 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
             new_values = self.new_lookups.get()
             self.lookup_docs = new_values + self.lookup_docs
         lookup_value_document_keys = self.lookup_docs
-        for key in lookup_value_document_keys:
-            try:
-                document = self.stored_value_manager.read_value(key)
-                if lookup_value in document:
-                    return document[lookup_value] 
-            except NotFound:
+        documents = self.stored_value_manager.read_value_mult(lookup_value_document_keys)
+        for document in documents:
+            if document is None:
                 log.warning('Specified lookup document does not exist')
+            elif lookup_value in document:
+                return document[lookup_value]
         return None
 
 
@@ -610,8 +791,28 @@ class ScienceGranuleIngestionWorker(TransformStreamListener, BaseIngestionWorker
         self.update_connection_index(rdt.connection_id, rdt.connection_index)
 
         self.update_metadata(dataset_id, rdt)
+        if elements:
+            self.feed_tail(dataset_id, start_index, rdt)
         self.dataset_changed(dataset_id,coverage.num_timesteps,(start_index,start_index+elements))
 
+    def feed_tail(self, dataset_id, start_index, rdt):
+        '''
+        Hands the appended rows to the dataset's tail buffer when the dataset
+        is polled in this container (DataRetrieverService.retrieve_since)
+        '''
+        if dataset_id not in tail_buffers:
+            return
+        columns = {}
+        for field in rdt.fields:
+            try:
+                values = rdt[field]
+            except Exception:
+                log.debug('Unable to evaluate %s for the tail of dataset %s', field, dataset_id, exc_info=True)
+                continue
+            if values is not None:
+                columns[field] = np.atleast_1d(values)
+        tail_buffers.feed(dataset_id, start_index, columns)
+
     def _add_timing_stats(self, timer):
         """ add stats from latest coverage operation to Accumulator and periodically log results """
         self.time_stats.add(timer)
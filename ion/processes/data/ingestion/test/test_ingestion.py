@@ -7,7 +7,23 @@
 
 from pyon.util.unit_test import PyonTestCase
 from ion.processes.data.ingestion.science_granule_ingestion_worker import ScienceGranuleIngestionWorker
+from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from nose.plugins.attrib import attr
+from gevent.coros import RLock
+from ion.processes.data.ingestion.metadata_aggregator import DatasetMetadata
+from pyon.core.exception import Conflict, NotFound
+from mock import Mock, patch
+import gevent
+import numpy as np
+
+
+class FakeRDT(dict):
+    temporal_parameter = 'time'
+    def __init__(self, **kwargs):
+        dict.__init__(self, **kwargs)
+        self._rd = self
+    def __len__(self):
+        return len(self['time'])
 
 
 @attr('UNIT',group='dm')
@@ -41,3 +57,131 @@ class IngestionTest(PyonTestCase):
 
 
 
+    def test_ingestion_batching(self):
+        ingestion = ScienceGranuleIngestionWorker()
+        ingestion.batching = True
+        ingestion.batch_max_granules = 3
+        ingestion.batch_max_bytes = 1024
+        ingestion.batch_lock = RLock()
+        ingestion.persist_or_timeout = Mock()
+        ingestion._rdt_size = Mock(return_value=100)
+
+        with patch.object(RecordDictionaryTool, 'concatenate') as concatenate:
+            concatenate.side_effect = lambda rdts : rdts
+
+            ingestion.buffer_granule('stream1', 'rdt1')
+            ingestion.buffer_granule('stream1', 'rdt2')
+            ingestion.buffer_granule('stream2', 'rdt3')
+            self.assertFalse(ingestion.persist_or_timeout.called)
+
+            # Granule count threshold
+            ingestion.buffer_granule('stream1', 'rdt4')
+            ingestion.persist_or_timeout.assert_called_once_with('stream1', ['rdt1', 'rdt2', 'rdt4'])
+
+            # Byte threshold
+            ingestion._rdt_size.return_value = 2048
+            ingestion.buffer_granule('stream1', 'rdt5')
+            ingestion.persist_or_timeout.assert_called_with('stream1', ['rdt5'])
+
+            # Pending batches are persisted on shutdown
+            ingestion.flush_batches()
+            ingestion.persist_or_timeout.assert_called_with('stream2', ['rdt3'])
+            self.assertEquals(ingestion._batches, {})
+
+            # Granules are buffered while a batch is persisted
+            def persist(stream_id, rdt):
+                # Another greenlet would block on the batch lock if it were held
+                greenlet = gevent.spawn(ingestion.buffer_granule, 'stream2', 'rdt7')
+                greenlet.join(timeout=1)
+                self.assertTrue(greenlet.ready())
+            ingestion.persist_or_timeout.side_effect = persist
+            ingestion._rdt_size.return_value = 100
+            ingestion.buffer_granule('stream1', 'rdt6')
+            ingestion.flush_batch('stream1')
+            self.assertEquals(ingestion._batches['stream2']['rdts'], ['rdt7'])
+
+    def test_metadata_aggregation(self):
+        metadata = DatasetMetadata()
+        metadata.add(FakeRDT(time=np.arange(10, dtype='f8'), temp=np.arange(10, dtype='f4'), lat=np.array([40.]*10), lon=np.array([-70.]*10)))
+        metadata.add(FakeRDT(time=np.arange(10, 15, dtype='f8'), temp=np.array([-1, 2, 3, 4, 5], dtype='f4'), lat=np.array([41.]*5), lon=np.array([-71.]*5)))
+
+        doc = metadata.to_doc()
+        self.assertEquals(doc['bounds']['time'], (0, 14))
+        self.assertEquals(doc['bounds']['temp'], (-1, 9))
+        self.assertEquals(doc['extents']['temp'], 15)
+        self.assertEquals(doc['last_values']['temp'], 5)
+        self.assertEquals(doc['size'], 15 * 4 * 4)
+        self.assertEquals((metadata.lat, metadata.lon), (41., -71.))
+
+        existing = {'bounds':{'time':(-5,0), 'temp':(0,20)}, 'extents':{'time':5, 'temp':5}, 'last_values':{'time':0, 'temp':20}, 'size':40}
+        doc = metadata.merge_doc(existing)
+        self.assertEquals(doc['bounds']['time'], (-5, 14))
+        self.assertEquals(doc['bounds']['temp'], (-1, 20))
+        self.assertEquals(doc['extents']['time'], 20)
+        self.assertEquals(doc['last_values']['time'], 14)
+        self.assertEquals(doc['size'], 40 + 15 * 4 * 2)
+
+    def test_metadata_flush(self):
+        ingestion = ScienceGranuleIngestionWorker()
+        ingestion.metadata_flush_granules = 2
+        ingestion.container = Mock()
+        ingestion._get_data_products = Mock(return_value=[])
+        object_store = ingestion.container.object_store
+
+        object_store.read_doc.side_effect = NotFound
+        ingestion.update_metadata('dataset1', FakeRDT(time=np.arange(5, dtype='f8')))
+        self.assertFalse(object_store.create_doc.called)
+        ingestion.update_metadata('dataset1', FakeRDT(time=np.arange(5, 10, dtype='f8')))
+        self.assertEquals(object_store.create_doc.call_count, 1)
+        self.assertEquals(ingestion._metadata, {})
+
+        # A revision conflict causes the document to be read and merged again
+        docs = [{'bounds':{'time':(0, 9)}, 'extents':{'time':10}, 'last_values':{'time':9}, 'size':40} for i in xrange(2)]
+        object_store.read_doc.side_effect = docs
+        object_store.update_doc.side_effect = [Conflict, None]
+        ingestion.update_metadata('dataset1', FakeRDT(time=np.arange(10, 15, dtype='f8')))
+        ingestion.flush_all_metadata()
+        self.assertEquals(object_store.update_doc.call_count, 2)
+        doc = object_store.update_doc.call_args[0][0]
+        self.assertEquals(doc['extents']['time'], 15)
+        self.assertEquals(doc['bounds']['time'], (0, 14))
+
+        # Metadata that fails to be written is kept and merged with what arrives meanwhile
+        ingestion.update_metadata('dataset1', FakeRDT(time=np.arange(15, 20, dtype='f8')))
+        def read_doc(dataset_id):
+            ingestion.update_metadata('dataset1', FakeRDT(time=np.arange(20, 25, dtype='f8')))
+            raise IOError('object store unavailable')
+        object_store.read_doc.side_effect = read_doc
+        ingestion.flush_metadata('dataset1')
+        metadata = ingestion._metadata['dataset1']
+        self.assertEquals(metadata.rows['time'], 10)
+        self.assertEquals(metadata.bounds['time'], (15, 24))
+        self.assertEquals((metadata.t_min, metadata.t_max), (15, 24))
+
+    def test_qc_alerts(self):
+        ingestion = ScienceGranuleIngestionWorker()
+        ingestion.qc_enabled = True
+        ingestion.container = Mock()
+        ingestion.container.resource_registry.find_subjects.return_value = (['dp1'], None)
+        ingestion.qc_publisher = Mock()
+
+        qc = np.array([1, 0, 0, 1, 1, 1, 1, 0, 0, 0], dtype='i1')
+        ingestion.evaluate_qc(FakeRDT(time=np.arange(10), temp_glblrng_qc=qc, temp_spketst_qc=qc), 'dataset1')
+        kwargs = ingestion.qc_publisher.publish_event.call_args[1]
+        self.assertEquals(kwargs['qc_parameter'], 'temp_glblrng_qc')
+        self.assertEquals(kwargs['temporal_values'], [1, 2, 7, 8, 9])
+        self.assertEquals(kwargs['configuration'], {'ranges':[[1, 2, 2], [7, 9, 3]]})
+
+        # Alerts collected over a window are published once, ranges continue across granules
+        ingestion.qc_window = ingestion.qc_alerts.window = 60
+        ingestion.qc_publisher.publish_event.reset_mock()
+        ingestion.evaluate_qc(FakeRDT(time=np.arange(10, 20), temp_glblrng_qc=qc), 'dataset1')
+        ingestion.evaluate_qc(FakeRDT(time=np.arange(20, 30), temp_glblrng_qc=np.array([0, 0, 1, 1, 1, 1, 1, 1, 0, 1], dtype='i1')), 'dataset1')
+        self.assertFalse(ingestion.qc_publisher.publish_event.called)
+        ingestion.qc_alerts.flush()
+        kwargs = ingestion.qc_publisher.publish_event.call_args[1]
+        self.assertEquals(kwargs['temporal_values'], [11, 17, 28])
+        self.assertEquals(kwargs['configuration'], {'ranges':[[11, 12, 2], [17, 21, 5], [28, 28, 1]]})
+
+        # The data products of the dataset were looked up once
+        self.assertEquals(ingestion.container.resource_registry.find_subjects.call_count, 1)
@@ -11,13 +11,16 @@ from pyon.core.object import IonObjectDeserializer
 from pyon.core.bootstrap import get_obj_registry
 from pyon.util.arg_check import validate_is_instance
 from pyon.util.log import log
+from pyon.public import CFG
 
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
 from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.services.dm.utility.coverage_pool import coverage_pool
 from ion.util.time_utils import TimeUtils
 
 from coverage_model import utils
 from coverage_model.parameter_functions import ParameterFunctionException
+from coverage_model.parameter_types import ParameterFunctionType
 
 from interface.services.dm.idataset_management_service import DatasetManagementServiceProcessClient
 from interface.services.dm.ipubsub_management_service import PubsubManagementServiceProcessClient
@@ -47,11 +50,15 @@ class ReplayProcess(BaseReplayProcess):
         start_time: 0         # Start time (index value) to be replayed
         end_time:   0         # End time (index value) to be replayed
         parameters: []        # List of parameters to form in the granule
+        bulk_read: False      # Read all parameters from the coverage in one pass
+        publish_limit: 10     # Maximum number of records per published granule
+        publish_bytes: None   # Maximum (approximate) size in bytes per published granule
       
 
     '''
     process_type  = 'standalone'
     publish_limit = 10
+    publish_bytes = None
     dataset_id    = None
     delivery_format = {}
     start_time      = None
@@ -60,6 +67,7 @@ class ReplayProcess(BaseReplayProcess):
     parameters      = None
     stream_id       = ''
     stream_def_id   = ''
+    bulk_read       = CFG.get_safe('service.replay.bulk_read', False)
 
 
     def __init__(self, *args, **kwargs):
@@ -85,7 +93,9 @@ class ReplayProcess(BaseReplayProcess):
         self.stride_time     = self.CFG.get_safe('process.query.stride_time', None)
         self.parameters      = self.CFG.get_safe('process.query.parameters',None)
         self.publish_limit   = self.CFG.get_safe('process.query.publish_limit', 10)
+        self.publish_bytes   = self.CFG.get_safe('process.query.publish_bytes', None)
         self.tdoa            = self.CFG.get_safe('process.query.tdoa',None)
+        self.bulk_read       = self.CFG.get_safe('process.query.bulk_read', self.bulk_read)
         self.stream_id       = self.CFG.get_safe('process.publish_streams.output', '')
         self.stream_def      = pubsub.read_stream_definition(stream_id=self.stream_id)
         self.stream_def_id   = self.stream_def._id
@@ -109,6 +119,34 @@ class ReplayProcess(BaseReplayProcess):
         idx = TimeUtils.get_relative_time(coverage, corrected_time)
         return idx
 
+    @classmethod
+    def get_time_idxs(cls, coverage, timevals, method='nearest'):
+        '''
+        Vectorized get_time_idx, the times are looked up with a single read of
+        the temporal parameter. Times in units other than seconds are converted
+        one at a time
+        '''
+        corrected_times = cls.convert_times(coverage, timevals)
+        if corrected_times is None:
+            corrected_times = [cls.convert_time(coverage, t) for t in np.atleast_1d(timevals)]
+            if not all(isinstance(t, Number) for t in corrected_times):
+                raise BadRequest('Unable to find times in the time units of the coverage')
+            corrected_times = np.array(corrected_times, dtype='float64')
+        return TimeUtils.get_relative_times(coverage, corrected_times, method)
+
+    @classmethod
+    def convert_times(cls, coverage, timevals):
+        '''
+        Vectorized convert_time for time units in seconds, which are unix time
+        offset by their epoch. Returns None for other time units
+        '''
+        tname = coverage.temporal_parameter_name
+        uom = coverage.get_parameter_context(tname).uom or ''
+        if not uom.strip().startswith('seconds since'):
+            return None
+        offset = TimeUtils.ts_to_units(uom, 0)
+        return np.atleast_1d(np.asanyarray(timevals, dtype='float64')) + offset
+
     @classmethod
     def convert_time(cls, coverage, timeval):
         tname = coverage.temporal_parameter_name
@@ -150,7 +188,14 @@ class ReplayProcess(BaseReplayProcess):
 
 
     @classmethod
-    def _coverage_to_granule(cls, coverage, start_time=None, end_time=None, stride_time=None, fuzzy_stride=True, parameters=None, stream_def_id=None, tdoa=None):
+    def _coverage_to_granule(cls, coverage, start_time=None, end_time=None, stride_time=None, fuzzy_stride=True, parameters=None, stream_def_id=None, tdoa=None, stride_method='nearest', bulk_read=None):
+        '''
+        Reads the requested range of the coverage into a record dictionary.
+        With fuzzy_stride disabled the records matching each point of the
+        stride grid (by nearest, floor or ceil time, see stride_method) are
+        returned.
+        With bulk_read the parameters are read in one pass, see bulk_map_cov_rdt.
+        '''
         slice_ = slice(None) # Defaults to all values
 
 
@@ -165,12 +210,11 @@ class ReplayProcess(BaseReplayProcess):
         if tdoa is not None and isinstance(tdoa,slice):
             slice_ = tdoa
         
-        elif stride_time is not None and not fuzzy_stride: # SLOW 
-            ugly_range = np.arange(start_time, end_time, stride_time)
-            idx_values = [cls.get_time_idx(coverage,i) for i in ugly_range]
-            idx_values = list(set(idx_values)) # Removing duplicates - also mixes the order of the list!!!
-            idx_values.sort()
-            slice_ = [idx_values]
+        elif stride_time is not None and not fuzzy_stride:
+            stride_grid = np.arange(start_time, end_time, stride_time)
+            idx_values = cls.get_time_idxs(coverage, stride_grid, stride_method)
+            # Sorted and without duplicates
+            slice_ = [np.unique(idx_values).tolist()]
 
 
         elif not (start_time is None and end_time is None):
@@ -192,10 +236,16 @@ class ReplayProcess(BaseReplayProcess):
         else:
             fields = rdt.fields
 
-        if slice_.start == slice_.stop and slice_.start is not None:
+        if isinstance(slice_, slice) and slice_.start == slice_.stop and slice_.start is not None:
             log.warning('Requested empty set of data.  %s', slice_)
             return rdt
         
+        if bulk_read is None:
+            bulk_read = cls.bulk_read
+        if bulk_read and isinstance(slice_, slice):
+            cls.bulk_map_cov_rdt(coverage, rdt, fields, slice_)
+            return rdt
+
         # Do time first
         tname = coverage.temporal_parameter_name
         cls.map_cov_rdt(coverage,rdt,tname, slice_)
@@ -206,6 +256,57 @@ class ReplayProcess(BaseReplayProcess):
             cls.map_cov_rdt(coverage,rdt,field, slice_)
         return rdt
 
+    @classmethod
+    def bulk_map_cov_rdt(cls, coverage, rdt, fields, slice_):
+        '''
+        Reads the stored parameters in one pass of the coverage, checks the
+        shape of the values once per retrieval and then evaluates the
+        parameter functions against the values already loaded in the record
+        dictionary.
+        '''
+        tname = coverage.temporal_parameter_name
+        stored = [tname]
+        functions = []
+        for field in fields:
+            if field == tname:
+                continue
+            if isinstance(coverage.get_parameter_context(field).param_type, ParameterFunctionType):
+                functions.append(field)
+            else:
+                stored.append(field)
+
+        vdict = coverage.get_value_dictionary(stored, domain_slice=slice_)
+        if not vdict:
+            return
+
+        expected = utils.slice_shape(slice_, (coverage.num_timesteps,))[0]
+        for field in stored:
+            n = vdict.get(field)
+            if n is None:
+                continue
+            n = np.atleast_1d(n)
+            if n.shape[0] < expected:
+                log.error("Misformed coverage detected, padding with fill_value")
+                fill_arr = np.empty((expected - n.shape[0],) + n.shape[1:], dtype=n.dtype)
+                fill_arr.fill(coverage.get_parameter_context(field).fill_value)
+                n = np.append(n, fill_arr, axis=0)
+            elif n.shape[0] > expected:
+                raise CorruptionError('The coverage is corrupted:\n\tfield: %s\n\tvalues: %s\n\ttimesteps: %s' % (field, n.shape, expected))
+            rdt[field] = n
+
+        for field in functions:
+            values = None
+            try:
+                # Evaluated from the inputs in the record dictionary
+                values = rdt[field]
+            except Exception:
+                log.debug('Could not evaluate %s from the retrieved values', field, exc_info=True)
+            if values is None:
+                # The function's inputs weren't requested, evaluate it in the coverage
+                cls.map_cov_rdt(coverage, rdt, field, slice_)
+            else:
+                rdt[field] = values
+
     @classmethod
     def map_cov_rdt(cls, coverage, rdt, field, slice_):
         log.trace( 'Slice is %s' , slice_)
@@ -262,14 +363,17 @@ class ReplayProcess(BaseReplayProcess):
 
     def replay(self):
         self.publishing.set() # Minimal state, supposed to prevent two instances of the same process from replaying on the same stream
-        for rdt in self._replay():
-            if self.end.is_set():
-                return
-            self.play.wait()
-            self.output.publish(rdt.to_granule())
-
-        self.publishing.clear()
-        return 
+        # The granules are read from the coverage as they are published, so
+        # pausing the replay also pauses reading from the coverage
+        granules = self._replay()
+        try:
+            for rdt in granules:
+                if self.end.is_set():
+                    return
+                self.output.publish(rdt.to_granule())
+        finally:
+            granules.close()
+            self.publishing.clear()
 
     def pause(self):
         self.play.clear()
@@ -285,32 +389,77 @@ class ReplayProcess(BaseReplayProcess):
 
     @classmethod
     def get_last_values(cls, dataset_id, number_of_points, delivery_format):
-        coverage = DatasetManagementService._get_coverage(dataset_id,mode='r')
-        if coverage.num_timesteps < number_of_points:
-            if coverage.num_timesteps == 0:
-                rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
-                return rdt.to_granule()
-            number_of_points = coverage.num_timesteps
-        rdt = cls._coverage_to_granule(coverage,tdoa=slice(-number_of_points,None),stream_def_id=delivery_format)
-        coverage.close(timeout=5)
+        with coverage_pool.coverage(dataset_id) as coverage:
+            if coverage.num_timesteps < number_of_points:
+                if coverage.num_timesteps == 0:
+                    rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
+                    return rdt.to_granule()
+                number_of_points = coverage.num_timesteps
+            rdt = cls._coverage_to_granule(coverage,tdoa=slice(-number_of_points,None),stream_def_id=delivery_format)
         
         return rdt.to_granule()
 
     def _replay(self):
         coverage = DatasetManagementService._get_coverage(self.dataset_id,mode='r')
-        rdt = self._coverage_to_granule(coverage=coverage, start_time=self.start_time, end_time=self.end_time, stride_time=self.stride_time, parameters=self.parameters, stream_def_id=self.stream_def_id)
-        elements = len(rdt)
-        
-        for i in xrange(elements / self.publish_limit):
-            outgoing = RecordDictionaryTool(stream_definition_id=self.stream_def_id)
-            fields = self.parameters or outgoing.fields
-            for field in fields:
-                v = rdt[field]
-                if v is not None:
-                    outgoing[field] = v[(i*self.publish_limit) : ((i+1)*self.publish_limit)]
-            yield outgoing
-        coverage.close(timeout=5)
-        return 
+        try:
+            chunk_size = self.chunk_records(coverage, self.publish_limit, self.publish_bytes, self.parameters)
+            for slice_ in self.replay_slices(coverage, self.start_time, self.end_time, self.stride_time, chunk_size):
+                self.play.wait()
+                if self.end.is_set():
+                    return
+                rdt = self._coverage_to_granule(coverage=coverage, parameters=self.parameters, stream_def_id=self.stream_def_id, tdoa=slice_, bulk_read=self.bulk_read)
+                if len(rdt):
+                    yield rdt
+        finally:
+            coverage.close(timeout=5)
+
+    @classmethod
+    def replay_slices(cls, coverage, start_time=None, end_time=None, stride_time=None, chunk_size=10):
+        '''
+        Returns the index windows, of at most chunk_size records, covering the
+        requested time range of the coverage
+        '''
+        if coverage.num_timesteps == 0:
+            return []
+        start_idx = cls.get_time_idx(coverage, start_time) if start_time is not None else None
+        end_idx = cls.get_time_idx(coverage, end_time) if end_time is not None else None
+        return cls.index_windows(coverage.num_timesteps, start_idx, end_idx, stride_time, chunk_size)
+
+    @classmethod
+    def index_windows(cls, num_timesteps, start=None, stop=None, step=None, chunk_size=10):
+        '''
+        Splits slice(start, stop, step) over num_timesteps records into slices
+        of at most chunk_size records, including the trailing partial chunk
+        '''
+        step = int(step) if step else None
+        start, stop, step = slice(start, stop, step).indices(num_timesteps)
+        if step < 1:
+            raise BadRequest('Replay only supports positive strides')
+        chunk_size = max(int(chunk_size or 1), 1)
+        window = chunk_size * step
+        return [slice(i, min(i + window, stop), step) for i in xrange(start, stop, window)]
+
+    @classmethod
+    def chunk_records(cls, coverage, publish_limit=None, publish_bytes=None, parameters=None):
+        '''
+        Returns the number of records per granule satisfying both the record
+        and the (approximate) byte limit
+        '''
+        limits = []
+        if publish_limit:
+            limits.append(int(publish_limit))
+        if publish_bytes:
+            record_size = 0
+            for name in parameters or coverage.list_parameters():
+                ptype = coverage.get_parameter_context(name).param_type
+                try:
+                    record_size += np.dtype(ptype.value_encoding).itemsize
+                except TypeError:
+                    record_size += 8
+            limits.append(max(int(publish_bytes) / max(record_size, 1), 1))
+        if not limits:
+            return cls.publish_limit
+        return min(limits)
 
 class RetrieveProcess:
     '''
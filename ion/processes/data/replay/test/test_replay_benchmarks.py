@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/replay/test/test_replay_benchmarks.py
+@brief Benchmarks for reading wide coverages
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+
+from ion.processes.data.replay.replay_process import ReplayProcess
+from ion.services.dm.utility.granule_utils import time_series_domain
+
+from coverage_model import SimplexCoverage, ParameterDictionary, ParameterContext, QuantityType, ParameterFunctionType, NumexprFunction, AxisTypeEnum
+from nose.plugins.attrib import attr
+
+import numpy as np
+import shutil
+import tempfile
+import time
+
+
+@attr('UTIL', group='dm')
+class WideCoverageBenchmark(PyonTestCase):
+    records = 10000
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def wide_coverage(self, width):
+        pdict = ParameterDictionary()
+        t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('float64')))
+        t_ctxt.axis = AxisTypeEnum.TIME
+        t_ctxt.uom = 'seconds since 1900-01-01'
+        pdict.add_context(t_ctxt, is_temporal=True)
+        for i in xrange(width):
+            ctxt = ParameterContext('field_%04d' % i, param_type=QuantityType(value_encoding=np.dtype('float32')))
+            ctxt.fill_value = -9999.
+            pdict.add_context(ctxt)
+        # A parameter function of bulk read parameters
+        func = NumexprFunction('field_sum', 'a + b', ['a', 'b'], param_map={'a':'field_0000', 'b':'field_0001'})
+        pdict.add_context(ParameterContext('field_sum', param_type=ParameterFunctionType(func, value_encoding='float32')))
+
+        tdom, sdom = time_series_domain()
+        coverage = SimplexCoverage(self.root, 'wide_%d' % width, 'Wide coverage', parameter_dictionary=pdict, temporal_domain=tdom, spatial_domain=sdom)
+        self.addCleanup(coverage.close)
+        coverage.insert_timesteps(self.records)
+        coverage.set_parameter_values('time', np.arange(self.records, dtype='float64'))
+        for i in xrange(width):
+            coverage.set_parameter_values('field_%04d' % i, np.random.random(self.records).astype('float32'))
+        return coverage
+
+    def test_wide_reads(self):
+        for width in (10, 100, 300):
+            coverage = self.wide_coverage(width)
+
+            start = time.time()
+            serial = ReplayProcess._coverage_to_granule(coverage, tdoa=slice(None), bulk_read=False)
+            t_serial = time.time() - start
+
+            start = time.time()
+            bulk = ReplayProcess._coverage_to_granule(coverage, tdoa=slice(None), bulk_read=True)
+            t_bulk = time.time() - start
+
+            log.info('Coverage %3d parameters x %d records: serial %.4fs bulk %.4fs', width, self.records, t_serial, t_bulk)
+            for field in serial.fields:
+                np.testing.assert_array_equal(serial[field], bulk[field])
+            np.testing.assert_allclose(bulk['field_sum'], bulk['field_0000'] + bulk['field_0001'], rtol=1e-6)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/replay/test/test_replay_process.py
+@brief Unit tests for the replay process
+'''
+
+from pyon.core.exception import BadRequest
+from pyon.util.unit_test import PyonTestCase
+from ion.processes.data.replay.replay_process import ReplayProcess
+from ion.services.dm.utility.granule import RecordDictionaryTool
+from coverage_model import ParameterDictionary, ParameterContext, QuantityType, ParameterFunctionType, NumexprFunction, AxisTypeEnum
+from nose.plugins.attrib import attr
+from mock import Mock
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class ReplayProcessUnitTest(PyonTestCase):
+    def test_index_windows(self):
+        windows = ReplayProcess.index_windows(25, chunk_size=10)
+        self.assertEquals(windows, [slice(0,10,1), slice(10,20,1), slice(20,25,1)])
+
+        windows = ReplayProcess.index_windows(100, 5, 30, 2, chunk_size=5)
+        self.assertEquals(windows, [slice(5,15,2), slice(15,25,2), slice(25,30,2)])
+        indices = np.concatenate([np.arange(100)[w] for w in windows])
+        np.testing.assert_array_equal(indices, np.arange(100)[5:30:2])
+
+        self.assertEquals(ReplayProcess.index_windows(0, chunk_size=10), [])
+        self.assertEquals(ReplayProcess.index_windows(10, 5, 5, chunk_size=10), [])
+
+    def test_chunk_records(self):
+        coverage = Mock()
+        coverage.list_parameters.return_value = ['time', 'temp']
+        ptypes = {'time' : Mock(value_encoding='float64'), 'temp': Mock(value_encoding='float32')}
+        coverage.get_parameter_context.side_effect = lambda name : Mock(param_type=ptypes[name])
+
+        self.assertEquals(ReplayProcess.chunk_records(coverage, publish_limit=100), 100)
+        # 12 bytes per record
+        self.assertEquals(ReplayProcess.chunk_records(coverage, publish_bytes=1200), 100)
+        self.assertEquals(ReplayProcess.chunk_records(coverage, publish_limit=50, publish_bytes=1200), 50)
+        self.assertEquals(ReplayProcess.chunk_records(coverage, publish_bytes=1), 1)
+
+    def test_bulk_map(self):
+        pdict = ParameterDictionary()
+        t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('float64')))
+        t_ctxt.axis = AxisTypeEnum.TIME
+        pdict.add_context(t_ctxt, is_temporal=True)
+        temp_ctxt = ParameterContext('temp', param_type=QuantityType(value_encoding=np.dtype('float32')))
+        temp_ctxt.fill_value = -9999.
+        pdict.add_context(temp_ctxt)
+        func = NumexprFunction('temp_L1', 'temp * 2', ['temp'], param_map={'temp':'temp'})
+        pdict.add_context(ParameterContext('temp_L1', param_type=ParameterFunctionType(func, value_encoding='float32')))
+
+        values = {'time' : np.arange(10, dtype='float64'), 'temp' : np.arange(10, dtype='float32')}
+        coverage = Mock(temporal_parameter_name='time', num_timesteps=10, parameter_dictionary=pdict)
+        coverage.get_parameter_context.side_effect = pdict.get_context
+        coverage.get_value_dictionary.side_effect = lambda names, domain_slice : dict((n, values[n][domain_slice]) for n in names)
+
+        # The function is evaluated from the bulk read inputs, not read from the coverage
+        rdt = RecordDictionaryTool(param_dictionary=pdict)
+        ReplayProcess.bulk_map_cov_rdt(coverage, rdt, rdt.fields, slice(2, 8))
+        coverage.get_value_dictionary.assert_called_once_with(['time', 'temp'], domain_slice=slice(2, 8))
+        np.testing.assert_array_equal(rdt['time'], np.arange(2, 8))
+        np.testing.assert_array_equal(rdt['temp_L1'], np.arange(2, 8, dtype='float32') * 2)
+        self.assertFalse(coverage.get_parameter_values.called)
+
+        # Short values are padded with the fill value
+        values['temp'] = np.arange(8, dtype='float32')
+        rdt = RecordDictionaryTool(param_dictionary=pdict)
+        ReplayProcess.bulk_map_cov_rdt(coverage, rdt, rdt.fields, slice(None))
+        np.testing.assert_array_equal(rdt['temp'], np.append(np.arange(8), [-9999., -9999.]))
+        np.testing.assert_array_equal(rdt['temp_L1'][:8], np.arange(8, dtype='float32') * 2)
+
+        # Without its inputs the function is evaluated in the coverage
+        coverage.get_parameter_values.return_value = np.arange(10, dtype='float32') * 2
+        coverage.get_data_extents.return_value = (10,)
+        rdt = RecordDictionaryTool(param_dictionary=pdict)
+        ReplayProcess.bulk_map_cov_rdt(coverage, rdt, ['time', 'temp_L1'], slice(None))
+        coverage.get_parameter_values.assert_called_once_with('temp_L1', tdoa=slice(None))
+        np.testing.assert_array_equal(rdt['temp_L1'], np.arange(10, dtype='float32') * 2)
+
+    def test_time_idxs(self):
+        coverage = Mock(temporal_parameter_name='time')
+        context = Mock(uom='seconds since 1900-01-01')
+        coverage.get_parameter_context.return_value = context
+        unix = 1356998400. + np.arange(10) * 3600.
+        coverage.get_parameter_values.return_value = unix + 2208988800
+
+        np.testing.assert_array_equal(ReplayProcess.get_time_idxs(coverage, unix[::3] + 1), [0, 3, 6, 9])
+        self.assertEquals(coverage.get_parameter_values.call_count, 1)
+
+        # Times in days are converted one at a time, without the rounding of a linear map
+        context.uom = 'days since 1970-01-01'
+        coverage.get_parameter_values.return_value = unix / 86400.
+        self.assertIsNone(ReplayProcess.convert_times(coverage, unix))
+        np.testing.assert_array_equal(ReplayProcess.get_time_idxs(coverage, unix[::3] + 1), [0, 3, 6, 9])
+        np.testing.assert_array_equal(ReplayProcess.get_time_idxs(coverage, unix[::3] + 1, 'ceil'), [1, 4, 7, 9])
+        self.assertEquals(coverage.get_parameter_values.call_count, 3)
+
+        context.uom = 'iso8601'
+        with self.assertRaises(BadRequest):
+            ReplayProcess.get_time_idxs(coverage, unix)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/granule_batcher.py
+@description Micro-batching of the granules received by transform processes
+'''
+
+from pyon.util.log import log
+
+from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
+
+from gevent.coros import RLock
+from gevent.event import Event
+
+import time
+
+
+class GranuleBatcher(object):
+    '''
+    Buffers the record dictionaries received on each stream and hands them to
+    callback(stream_id, rdt, sizes) concatenated into one record dictionary,
+    once max_granules granules are buffered for the stream or the oldest one
+    has waited max_latency seconds. sizes holds the number of records of each
+    original granule so the results can be split along the same boundaries.
+    '''
+    def __init__(self, process, callback, max_granules=10, max_latency=1.0):
+        self.process      = process
+        self.callback     = callback
+        self.max_granules = max_granules
+        self.max_latency  = max_latency
+        self._batches     = {}
+        self._lock        = RLock()
+        self._quit        = Event()
+        self._thread      = None
+
+        # Counters
+        self.batches      = 0
+        self.granules     = 0
+        self.records      = 0
+        self.busy_time    = 0.   # seconds spent processing batches
+        self.total_wait   = 0.   # seconds granules spent buffered
+        self.max_wait     = 0.
+
+    def start(self):
+        self._quit.clear()
+        self._thread = self.process._process.thread_manager.spawn(self._monitor, thread_name='%s-batcher' % self.process.id)
+
+    def stop(self):
+        '''
+        Stops the monitor and processes the pending batches
+        '''
+        if self._thread:
+            self._quit.set()
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush_all()
+
+    def add(self, stream_id, rdt):
+        if rdt is None or not len(rdt):
+            return
+        with self._lock:
+            batch = self._batches.get(stream_id)
+            if batch is None:
+                batch = self._batches[stream_id] = {'rdts':[], 'first':time.time()}
+            batch['rdts'].append(rdt)
+            if len(batch['rdts']) >= self.max_granules:
+                self.flush(stream_id)
+
+    def flush(self, stream_id):
+        with self._lock:
+            batch = self._batches.pop(stream_id, None)
+            if not batch:
+                return
+            rdts = batch['rdts']
+            start = time.time()
+            wait = start - batch['first']
+            rdt = RecordDictionaryTool.concatenate(rdts)
+            sizes = [len(r) for r in rdts]
+            try:
+                self.callback(stream_id, rdt, sizes)
+            finally:
+                self.busy_time  += time.time() - start
+                self.total_wait += wait
+                self.max_wait    = max(self.max_wait, wait)
+                self.batches    += 1
+                self.granules   += len(rdts)
+                self.records    += len(rdt)
+
+    def flush_all(self, max_age=None):
+        '''
+        Processes every pending batch, or only the batches older than max_age seconds
+        '''
+        with self._lock:
+            now = time.time()
+            for stream_id, batch in self._batches.items():
+                if max_age is None or (now - batch['first']) >= max_age:
+                    self.flush(stream_id)
+
+    def stats(self):
+        return {'batches'         : self.batches,
+                'granules'        : self.granules,
+                'records'         : self.records,
+                'pending'         : sum([len(b['rdts']) for b in self._batches.itervalues()]),
+                'mean_latency'    : self.total_wait / self.batches if self.batches else 0.,
+                'max_latency'     : self.max_wait,
+                'records_per_sec' : self.records / self.busy_time if self.busy_time else 0.}
+
+    def _monitor(self):
+        ''' Bounds the time granules stay buffered '''
+        interval = max(self.max_latency / 2., 0.01)
+        while not self._quit.wait(timeout=interval):
+            try:
+                self.flush_all(max_age=self.max_latency)
+            except:
+                log.exception('Failed to process batched granules')
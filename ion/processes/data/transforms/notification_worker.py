@@ -12,8 +12,9 @@ from pyon.util.async import spawn
 from pyon.core.exception import BadRequest, NotFound
 from ion.core.process.transform import TransformEventListener
 from pyon.event.event import EventSubscriber
-from ion.services.dm.utility.uns_utility_methods import send_email, calculate_reverse_user_info
-from ion.services.dm.utility.uns_utility_methods import setting_up_smtp_client, check_user_notification_interest
+from ion.services.dm.utility.uns_utility_methods import convert_events_to_email_message, calculate_reverse_user_info
+from ion.services.dm.utility.uns_utility_methods import SubscriptionIndex, reload_notification
+from ion.services.dm.utility.smtp_delivery import SMTPConnectionPool, EmailDeliveryQueue
 from interface.services.coi.iresource_registry_service import ResourceRegistryServiceClient
 
 import gevent, time
@@ -41,6 +42,20 @@ class NotificationWorker(TransformEventListener):
 
         self.reverse_user_info = None
         self.user_info = None
+        self.subscriptions = SubscriptionIndex()
+
+        #------------------------------------------------------------------------------------
+        # Emails are sent in the background over pooled SMTP sessions
+        #------------------------------------------------------------------------------------
+
+        self.smtp_pool = SMTPConnectionPool(size=self.CFG.get_safe('process.smtp.pool_size', 1),
+                                            max_idle=self.CFG.get_safe('process.smtp.max_idle', 60))
+        self.delivery = EmailDeliveryQueue(self, self.smtp_pool,
+                                           maxsize=self.CFG.get_safe('process.smtp.queue_size', 1000),
+                                           max_recipients=self.CFG.get_safe('process.smtp.max_recipients', 50),
+                                           retries=self.CFG.get_safe('process.smtp.retries', 3),
+                                           backoff=self.CFG.get_safe('process.smtp.retry_backoff', 1.0))
+        self.delivery.start()
 
         #------------------------------------------------------------------------------------
         # Start by loading the user info and reverse user info dictionaries
@@ -49,6 +64,7 @@ class NotificationWorker(TransformEventListener):
         try:
             self.user_info = self.load_user_info()
             self.reverse_user_info =  calculate_reverse_user_info(self.user_info)
+            self.subscriptions.load(self.user_info)
 
             log.debug("On start up, notification workers loaded the following user_info dictionary: %s" % self.user_info)
             log.debug("The calculated reverse user info: %s" % self.reverse_user_info )
@@ -67,11 +83,21 @@ class NotificationWorker(TransformEventListener):
             '''
             Callback method for the subscriber to ReloadUserInfoEvent
             '''
-
-            try:
-                self.user_info = self.load_user_info()
-            except NotFound:
-                log.warning("ElasticSearch has not yet loaded the user_index.")
+            # A created or retired notification only changes the subscriptions of its users
+            notification_id = getattr(event_msg, 'notification_id', None)
+            reloaded = False
+            if notification_id and self.user_info is not None:
+                try:
+                    reloaded = reload_notification(self.resource_registry, self.user_info, notification_id, [self.subscriptions])
+                except NotFound:
+                    log.warning("Notification %s not found, reloading all the user info", notification_id)
+
+            if not reloaded:
+                try:
+                    self.user_info = self.load_user_info()
+                except NotFound:
+                    log.warning("ElasticSearch has not yet loaded the user_index.")
+                self.subscriptions.load(self.user_info or {})
 
             self.reverse_user_info =  calculate_reverse_user_info(self.user_info)
             self.test_hook(self.user_info, self.reverse_user_info)
@@ -104,12 +130,10 @@ class NotificationWorker(TransformEventListener):
         Callback method for the subscriber listening for all events
         """
         #------------------------------------------------------------------------------------
-        # From the reverse user info dict find out which users have subscribed to that event
+        # From the subscription index find out which users have subscribed to that event
         #------------------------------------------------------------------------------------
 
-        user_ids = []
-        if self.reverse_user_info:
-            user_ids = check_user_notification_interest(event = msg, reverse_user_info = self.reverse_user_info)
+        user_ids = self.subscriptions.match(msg)
 
             #log.debug('process_event  user_ids: %s', user_ids)
 
@@ -119,14 +143,16 @@ class NotificationWorker(TransformEventListener):
         # Send email to the users
         #------------------------------------------------------------------------------------
 
-        for user_id in user_ids:
-            msg_recipient = self.user_info[user_id]['user_contact'].email
-            self.smtp_client = setting_up_smtp_client()
-            send_email(event=msg,
-                       msg_recipient=msg_recipient,
-                       smtp_client=self.smtp_client,
-                       rr_client=self.resource_registry)
-            self.smtp_client.quit()
+        recipients = [self.user_info[user_id]['user_contact'].email for user_id in user_ids]
+        if recipients:
+            # The message is rendered once for all the recipients
+            email = convert_events_to_email_message([msg], self.resource_registry)
+            log.debug("Notification worker queueing email to %s for event type: %s", recipients, msg.type_)
+            self.delivery.put(email, recipients)
+
+    def on_quit(self):
+        self.delivery.stop()
+        super(NotificationWorker, self).on_quit()
 
     def get_user_notifications(self, user_info_id=''):
         """
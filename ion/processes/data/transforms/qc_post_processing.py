@@ -8,13 +8,19 @@
 from pyon.core.exception import BadRequest
 from pyon.ion.process import ImmediateProcess, SimpleProcess
 from interface.services.dm.idata_retriever_service import DataRetrieverServiceProcessClient
+from interface.services.dm.idataset_management_service import DatasetManagementServiceProcessClient
 from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.util.stored_values import StoredValueManager
+from ion.services.dm.utility.qc_alerts import failure_runs
+from ion.util.time_utils import TimeUtils
+from coverage_model import ParameterDictionary
 import time
 from pyon.ion.event import EventPublisher
 from pyon.public import OT, RT,PRED
 from pyon.util.arg_check import validate_is_not_none
 from pyon.ion.event import EventSubscriber
 from pyon.util.log import log
+from gevent.pool import Pool
 import numpy as np
 
 class QCPostProcessing(SimpleProcess):
@@ -22,42 +28,103 @@ class QCPostProcessing(SimpleProcess):
     QC Post Processing Process
 
     This process provides the capability to ION clients and operators to evaluate the automated quality control flags on
-    various data products. This process should be run periodically with overlapping spans of data to ensure complete
-    dataset QC verification.
+    various data products. Each run evaluates a dataset up to the end of its ingested time bounds, which is kept as
+    the dataset's watermark in the object store. The next run starts overlap seconds before the watermark so that
+    values ingested late, with times before the watermark, are evaluated too. Failed values flagged by the previous
+    run are remembered and not flagged again.
 
     This parameters that this process accepts as configurations are:
-        - dataset_id: The dataset identifier, required.
-        - start_time: Unix timestamp, defaults to 24 hours in the past
-        - end_time: Unix timestamp, defaults to current time
+        - interval_key: The origin of the timer events triggering a run, required.
         - qc_params: a list of qc functions to evaluate, currently supported functions are: ['glblrng_qc',
           'spketst_qc', 'stuckvl_qc'], defaults to all
+        - workers: Number of datasets evaluated concurrently, defaults to 4
+        - chunk_size: Seconds of data retrieved per request, defaults to 6 hours
+        - overlap: Seconds before the watermark evaluated again, defaults to 1 hour
+        - max_window: Most seconds evaluated in one run, older data is skipped, defaults to 7 days
+
+    A dataset without a watermark is evaluated from service.qc_processing.run_interval hours (plus one) before the
+    end of its data. Chunks that can't be retrieved are skipped. One ParameterQCEvent is published per contiguous run
+    of failed values.
 
     '''
 
     qc_suffixes = ['glblrng_qc', 'spketst_qc', 'stuckvl_qc']
+    watermark_prefix = 'qc_post_processing_'
     def on_start(self):
         SimpleProcess.on_start(self)
         self.data_retriever = DataRetrieverServiceProcessClient(process=self)
+        self.dataset_management = DatasetManagementServiceProcessClient(process=self)
         self.interval_key = self.CFG.get_safe('process.interval_key',None)
         self.qc_params    = self.CFG.get_safe('process.qc_params',[])
+        self.workers      = self.CFG.get_safe('process.workers', 4)
+        self.chunk_size   = self.CFG.get_safe('process.chunk_size', 3600*6)
+        self.overlap      = self.CFG.get_safe('process.overlap', 3600)
+        self.max_window   = self.CFG.get_safe('process.max_window', 3600*24*7)
         validate_is_not_none(self.interval_key, 'An interval key is necessary to paunch this process')
         self.event_subscriber = EventSubscriber(event_type=OT.TimerEvent, origin=self.interval_key, callback=self._event_callback, auto_delete=True)
         self.add_endpoint(self.event_subscriber)
         self.resource_registry = self.container.resource_registry
+        self.stored_values = StoredValueManager(self.container)
+        self.qc_publisher = EventPublisher(event_type=OT.ParameterQCEvent)
         self.run_interval = self.CFG.get_safe('service.qc_processing.run_interval', 24)
+
+    def on_quit(self):
+        self.qc_publisher.close()
+        SimpleProcess.on_quit(self)
     
     def _event_callback(self, *args, **kwargs):
         log.info('QC Post Processing Triggered')
         dataset_ids, _ = self.resource_registry.find_resources(restype=RT.Dataset, id_only=True)
+        if not dataset_ids:
+            return
+        watermarks = self.read_watermarks(dataset_ids)
+        pool = Pool(self.workers)
         for dataset_id in dataset_ids:
-            log.info('QC Post Processing for dataset %s', dataset_id)
-            try:
-                self.process(dataset_id)
-            except BadRequest as e:
-                if 'Problems reading from the coverage' in e.message:
-                    log.error('Failed to read from dataset')
+            pool.spawn(self._process_dataset, dataset_id, watermarks.get(dataset_id, {}))
+        pool.join()
+
+    def _process_dataset(self, dataset_id, watermark):
+        log.info('QC Post Processing for dataset %s', dataset_id)
+        try:
+            bounds = self.dataset_management.dataset_temporal_bounds(dataset_id)
+            if not bounds:
+                return
+            end_time = int(bounds[1]) + 1
+            if watermark.get('watermark'):
+                start_time = watermark['watermark'] - self.overlap
+            else:
+                start_time = end_time - 3600*(self.run_interval+1)
+            if self.max_window and end_time - start_time > self.max_window:
+                log.warning('QC Post Processing for dataset %s skips %s seconds of data', dataset_id, end_time - start_time - self.max_window)
+                start_time = end_time - self.max_window
+            failed, end_time = self.process(dataset_id, start_time=start_time, end_time=end_time, flagged=watermark.get('flagged'))
+        except Exception:
+            log.exception('QC Post Processing failed for dataset %s', dataset_id)
+            return
+        self.write_watermark(dataset_id, end_time, failed)
 
-    def process(self, dataset_id, start_time=0, end_time=0):
+    def read_watermarks(self, dataset_ids):
+        '''
+        Returns the watermark document of the previous run for each dataset that has one
+        '''
+        docs = self.stored_values.read_value_mult([self.watermark_prefix + dataset_id for dataset_id in dataset_ids])
+        return dict((dataset_id, doc) for dataset_id, doc in zip(dataset_ids, docs) if doc)
+
+    def write_watermark(self, dataset_id, watermark, flagged):
+        self.stored_values.stored_value_cas(self.watermark_prefix + dataset_id, {'watermark':watermark, 'flagged':flagged})
+
+    def qc_fields(self, dataset_id, qc_params):
+        pdict = ParameterDictionary.load(self.dataset_management.get_dataset_parameters(dataset_id))
+        return [i for i in pdict.keys() if any([i.endswith(j) for j in qc_params])]
+
+    def process(self, dataset_id, start_time=0, end_time=0, flagged=None):
+        '''
+        Flags the failed values of the dataset's QC fields between start_time
+        and end_time, except the ones in flagged (field -> timestamps). Returns
+        the time the dataset was processed up to, end_time or the start of the
+        first chunk that couldn't be read, and the failed timestamps of each
+        field within overlap seconds of it.
+        '''
         if not dataset_id:
             raise BadRequest('No dataset id specified.')
         now = time.time()
@@ -65,49 +132,109 @@ class QCPostProcessing(SimpleProcess):
         end_time   = end_time or now
         
         qc_params  = [i for i in self.qc_params if i in self.qc_suffixes] or self.qc_suffixes
-        
-        self.qc_publisher = EventPublisher(event_type=OT.ParameterQCEvent)
+        qc_fields  = self.qc_fields(dataset_id, qc_params)
+        log.debug('QC Fields: %s', qc_fields)
+        if not qc_fields:
+            return {}, end_time
+
+        flagged = dict((field, set(timestamps)) for field, timestamps in (flagged or {}).iteritems())
+        failed = dict((field, []) for field in qc_fields)
+        units_rdt = None # The first chunk read, for the dataset's time units
+        watermark = end_time
+        data_product_ids = {}
+        runs = {} # field -> timestamps of the failure run still open at the end of the last chunk
         log.debug('Iterating over the data blocks')
 
-        for st,et in self.chop(int(start_time),int(end_time)):
+        for st,et in self.chop(int(start_time),int(end_time), self.chunk_size):
             log.debug('Chopping %s:%s', st, et)
-            log.debug("Retrieving data: data_retriever.retrieve('%s', query={'start_time':%s, 'end_time':%s')", dataset_id, st, et)
+            log.debug("Retrieving data: data_retriever.retrieve('%s', query={'start_time':%s, 'end_time':%s, 'parameters':%s})", dataset_id, st, et, qc_fields)
             try:
-                granule = self.data_retriever.retrieve(dataset_id, query={'start_time':st, 'end_time':et})
+                granule = self.data_retriever.retrieve(dataset_id, query={'start_time':st, 'end_time':et, 'parameters':qc_fields})
             except BadRequest:
+                # Skipped, a chunk that can't be read doesn't hold the dataset back
                 data_products, _ = self.container.resource_registry.find_subjects(object=dataset_id, predicate=PRED.hasDataset, subject_type=RT.DataProduct)
                 for data_product in data_products:
                     log.exception('Failed to perform QC Post Processing on %s', data_product.name)
                     log.error('Calculated Start Time: %s', st)
                     log.error('Calculated End Time:   %s', et)
-                raise
+                # The next run retries the chunk
+                watermark = min(watermark, st)
+                continue
             log.debug('Retrieved Data')
             rdt = RecordDictionaryTool.load_from_granule(granule)
-            qc_fields = [i for i in rdt.fields if any([i.endswith(j) for j in qc_params])]
-            log.debug('QC Fields: %s', qc_fields)
+            if not len(rdt):
+                continue
+            timestamps = rdt[rdt.temporal_parameter]
+            if units_rdt is None:
+                units_rdt = rdt
             for field in qc_fields:
-                val = rdt[field]
+                val = rdt[field] if field in rdt else None
                 if val is None:
                     continue
-                if not np.all(val):
-                    log.debug('Found QC Alerts')
-                    indexes = np.where(val==0)
-                    timestamps = rdt[rdt.temporal_parameter][indexes[0]]
-                    self.flag_qc_parameter(dataset_id, field, timestamps.tolist(),{})
+                failures = self.failure_runs(val)
+                closed = []
+                for start, stop in failures:
+                    run = timestamps[start:stop].tolist()
+                    if start == 0 and field in runs:
+                        # Continues the run open at the end of the last chunk
+                        run = runs.pop(field) + run
+                    closed.append(run)
+                if field in runs:
+                    closed.insert(0, runs.pop(field))
+                if failures and failures[-1][1] == len(val):
+                    runs[field] = closed.pop()
+                for run in closed:
+                    self._flag_run(dataset_id, field, run, flagged.get(field), failed[field], data_product_ids)
 
+        for field, run in runs.iteritems():
+            self._flag_run(dataset_id, field, run, flagged.get(field), failed[field], data_product_ids)
 
+        cutoff = self.time_in_units(units_rdt, watermark - self.overlap) if units_rdt is not None else None
+        failed = dict((field, [t for t in timestamps if cutoff is None or t >= cutoff])
+                      for field, timestamps in failed.iteritems() if timestamps)
+        return failed, watermark
 
-    def flag_qc_parameter(self, dataset_id, parameter, temporal_values, configuration):
-        log.info('Flagging QC for %s', parameter)
+    def _flag_run(self, dataset_id, field, run, flagged, failed, data_product_ids):
+        failed.extend(run)
+        if flagged:
+            # Flagged by the previous run, which evaluated the overlap too
+            run = [t for t in run if t not in flagged]
+        if not run:
+            return
+        log.debug('Found QC Alerts')
+        if dataset_id not in data_product_ids:
+            data_product_ids[dataset_id] = self.data_product_ids(dataset_id)
+        self.flag_qc_parameter(dataset_id, field, run, {}, data_product_ids[dataset_id])
+
+    @classmethod
+    def time_in_units(cls, rdt, timeval):
+        '''
+        Converts a unix time to the time units of the rdt, None if they aren't known
+        '''
+        try:
+            converted = TimeUtils.ts_to_units(rdt.context(rdt.temporal_parameter).uom, timeval)
+        except Exception:
+            return None
+        return converted if isinstance(converted, (int, long, float)) else None
+
+    failure_runs = staticmethod(failure_runs)
+
+    def data_product_ids(self, dataset_id):
         data_product_ids, _ = self.resource_registry.find_subjects(object=dataset_id, subject_type=RT.DataProduct, predicate=PRED.hasDataset, id_only=True)
+        return data_product_ids
+
+    def flag_qc_parameter(self, dataset_id, parameter, temporal_values, configuration, data_product_ids=None):
+        log.info('Flagging QC for %s', parameter)
+        if data_product_ids is None:
+            data_product_ids = self.data_product_ids(dataset_id)
+        description = 'Automated Quality Control Alerted on %s for %d values from %s to %s' % (parameter, len(temporal_values), temporal_values[0], temporal_values[-1])
         for data_product_id in data_product_ids:
-            self.qc_publisher.publish_event(origin=data_product_id, qc_parameter=parameter, temporal_values=temporal_values, configuration=configuration)
+            self.qc_publisher.publish_event(origin=data_product_id, qc_parameter=parameter, temporal_values=temporal_values, configuration=configuration, description=description)
 
     @classmethod
-    def chop(cls, start_time, end_time):
+    def chop(cls, start_time, end_time, step=3600):
         while start_time < end_time:
-            yield (start_time, min(start_time+3600, end_time))
-            start_time = min(start_time+3600, end_time)
+            yield (start_time, min(start_time+step, end_time))
+            start_time = min(start_time+step, end_time)
         return
 
-
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/test/test_granule_batcher.py
+@brief Tests for transform micro-batching
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.processes.data.transforms.granule_batcher import GranuleBatcher
+from ion.services.dm.utility.granule import RecordDictionaryTool
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+
+@attr('UNIT', group='dm')
+class GranuleBatcherTest(PyonTestCase):
+    def test_batching(self):
+        callback = Mock()
+        batcher = GranuleBatcher(Mock(), callback, max_granules=3, max_latency=60)
+
+        with patch.object(RecordDictionaryTool, 'concatenate') as concatenate:
+            concatenate.side_effect = lambda rdts : sum(rdts, [])
+
+            batcher.add('stream1', [1, 2])
+            batcher.add('stream1', [])
+            batcher.add('stream1', [3])
+            batcher.add('stream2', [4])
+            self.assertFalse(callback.called)
+
+            batcher.add('stream1', [5, 6, 7])
+            callback.assert_called_once_with('stream1', [1, 2, 3, 5, 6, 7], [2, 1, 3])
+
+            # Only the batches older than max_age are processed
+            batcher.flush_all(max_age=60)
+            self.assertEquals(callback.call_count, 1)
+            batcher.stop()
+            callback.assert_called_with('stream2', [4], [1])
+
+        stats = batcher.stats()
+        self.assertEquals((stats['batches'], stats['granules'], stats['records'], stats['pending']), (2, 4, 7, 0))
@@ -24,6 +24,9 @@ from pyon.public import OT
 import time
 import numpy as np
 from gevent.queue import Queue, Empty
+from pyon.util.unit_test import PyonTestCase
+from ion.processes.data.transforms.qc_post_processing import QCPostProcessing
+from mock import Mock, patch
 
 @attr('INT',group='dm')
 class TestQCPostProcessing(DMTestCase):
@@ -213,9 +216,94 @@ class TestQCPostProcessing(DMTestCase):
         #--------------------------------------------------------------------------------
 
         try:
-            for i in xrange(2):
-                async_queue.get(timeout=10)
+            async_queue.get(timeout=10)
         except Empty:
             raise AssertionError('QC Events not raised')
+
+        # The following runs evaluate the flagged value again without raising another event
+        with self.assertRaises(Empty):
+            async_queue.get(timeout=10)
+        watermark = StoredValueManager(self.container).read_value('qc_post_processing_' + dataset_id)
+        self.assertEquals(len(watermark['flagged']['temp_glblrng_qc']), 1)
+
+
+class FakeRDT(dict):
+    temporal_parameter = 'time'
+    def __len__(self):
+        return len(self['time'])
+
+
+@attr('UNIT',group='dm')
+class TestQCPostProcessingRuns(PyonTestCase):
+    def setUp(self):
+        self.qc = QCPostProcessing()
+        self.qc.qc_params = ['glblrng_qc']
+        self.qc.chunk_size = 10
+        self.qc.data_retriever = Mock()
+        self.qc.qc_publisher = Mock()
+        self.qc.resource_registry = Mock()
+        self.qc.resource_registry.find_subjects.return_value = (['dp_id'], None)
+        self.qc.qc_fields = Mock(return_value=['temp_glblrng_qc'])
+
+    def test_failure_runs(self):
+        self.assertEquals(QCPostProcessing.failure_runs([1,0,0,1,0,1,1,0]), [(1,3), (4,5), (7,8)])
+        self.assertEquals(QCPostProcessing.failure_runs([1,1]), [])
+
+    @patch('ion.processes.data.transforms.qc_post_processing.RecordDictionaryTool')
+    def test_runs_across_chunks(self, rdt_cls):
+        qc = np.ones(30, dtype=np.uint8)
+        qc[[2, 8, 9, 10, 11, 25, 29]] = 0
+        chunks = [FakeRDT(time=np.arange(i, i+10), temp_glblrng_qc=qc[i:i+10]) for i in xrange(0, 30, 10)]
+        rdt_cls.load_from_granule.side_effect = chunks
+
+        self.qc.process('dataset_id', start_time=1000, end_time=1030)
+
+        # Only the QC fields and time are retrieved, one chunk at a time
+        self.assertEquals(self.qc.data_retriever.retrieve.call_count, 3)
+        self.assertEquals(self.qc.data_retriever.retrieve.call_args[1]['query'], {'start_time':1020, 'end_time':1030, 'parameters':['temp_glblrng_qc']})
+
+        flagged = [c[1]['temporal_values'] for c in self.qc.qc_publisher.publish_event.call_args_list]
+        self.assertEquals(flagged, [[2], [8, 9, 10, 11], [25], [29]])
+        self.assertEquals(self.qc.resource_registry.find_subjects.call_count, 1)
             
 
+
+    @patch('ion.processes.data.transforms.qc_post_processing.RecordDictionaryTool')
+    def test_watermark(self, rdt_cls):
+        self.qc.overlap = 10
+        self.qc.max_window = 0
+        self.qc.container = Mock()
+        self.qc.container.resource_registry.find_subjects.return_value = ([], None)
+        self.qc.stored_values = Mock()
+        self.qc.dataset_management = Mock()
+        # Times of the data, not of the run, bound the window
+        self.qc.dataset_management.dataset_temporal_bounds.return_value = [900, 1029.5]
+        self.qc.time_in_units = lambda rdt, timeval : timeval
+
+        qc = np.ones(30, dtype=np.uint8)
+        qc[[2, 25]] = 0
+        unreadable = set([1010])
+        def retrieve(dataset_id, query):
+            if query['start_time'] in unreadable:
+                raise BadRequest('Problems reading from the coverage')
+            return query['start_time']
+        self.qc.data_retriever.retrieve.side_effect = retrieve
+        rdt_cls.load_from_granule.side_effect = lambda st : FakeRDT(time=np.arange(st, st+10), temp_glblrng_qc=qc[st-1000:st-990])
+
+        # The chunk that can't be read is skipped and the watermark stops at its start
+        self.qc._process_dataset('dataset_id', {'watermark':1010})
+        self.assertEquals(self.qc.data_retriever.retrieve.call_count, 3)
+        flagged = [c[1]['temporal_values'] for c in self.qc.qc_publisher.publish_event.call_args_list]
+        self.assertEquals(flagged, [[1002], [1025]])
+        self.qc.stored_values.stored_value_cas.assert_called_once_with('qc_post_processing_dataset_id',
+                {'watermark':1010, 'flagged':{'temp_glblrng_qc':[1002, 1025]}})
+
+        # The next run reads the skipped chunk and evaluates the overlap again without flagging the same values twice
+        unreadable.clear()
+        qc[[12, 28]] = 0
+        self.qc._process_dataset('dataset_id', {'watermark':1010, 'flagged':{'temp_glblrng_qc':[1002, 1025]}})
+        self.assertEquals(self.qc.data_retriever.retrieve.call_args_list[3][1]['query']['start_time'], 1000)
+        flagged = [c[1]['temporal_values'] for c in self.qc.qc_publisher.publish_event.call_args_list]
+        self.assertEquals(flagged, [[1002], [1025], [1012], [1028]])
+        self.qc.stored_values.stored_value_cas.assert_called_with('qc_post_processing_dataset_id',
+                {'watermark':1030, 'flagged':{'temp_glblrng_qc':[1025, 1028]}})
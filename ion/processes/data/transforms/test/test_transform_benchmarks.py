@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+'''
+@file ion/processes/data/transforms/test/test_transform_benchmarks.py
+@brief Throughput benchmarks for TransformPrime routes
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+
+from ion.processes.data.transforms.transform_prime import TransformPrime, TransformRoute
+from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.services.dm.utility.granule.pdict_cache import pdict_cache
+
+from interface.objects import StreamDefinition
+
+from coverage_model import ParameterDictionary, ParameterContext, QuantityType, ParameterFunctionType, NumexprFunction, AxisTypeEnum
+from gevent.queue import Queue
+from collections import OrderedDict
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import numpy as np
+import time
+
+
+def ctd_pdict(width=50):
+    '''
+    Returns a CTD parameter dictionary with width parameters: time, position,
+    the L0 counts, the L1 and L2 functions and filler engineering parameters
+    '''
+    pdict = ParameterDictionary()
+    t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('float64')))
+    t_ctxt.axis = AxisTypeEnum.TIME
+    t_ctxt.uom = 'seconds since 1900-01-01'
+    pdict.add_context(t_ctxt, is_temporal=True)
+
+    for name in ('lat', 'lon', 'TEMPWAT_L0', 'CONDWAT_L0', 'PRESWAT_L0'):
+        pdict.add_context(ParameterContext(name, param_type=QuantityType(value_encoding=np.dtype('float32'))))
+
+    functions = [('TEMPWAT_L1', 'T / 10000 - 10', {'T':'TEMPWAT_L0'}),
+                 ('CONDWAT_L1', 'C / 100000 - 0.5', {'C':'CONDWAT_L0'}),
+                 ('PRESWAT_L1', 'P * 679.34 / (0.85 * 65536) - 0.05 * 679.34', {'P':'PRESWAT_L0'}),
+                 ('PRACSAL_L2', '0.0080 - 0.1692 * sqrt(C / 4.2914) + 25.3851 * C / 4.2914 + 0.0005 * T + 0.00001 * P', {'T':'TEMPWAT_L1', 'C':'CONDWAT_L1', 'P':'PRESWAT_L1'}),
+                 ('DENSITY_L2', '1000 + 0.8 * S - 0.2 * T + 0.004 * P', {'S':'PRACSAL_L2', 'T':'TEMPWAT_L1', 'P':'PRESWAT_L1'})]
+    for name, expression, param_map in functions:
+        func = NumexprFunction(name, expression, param_map.keys(), param_map=param_map)
+        pdict.add_context(ParameterContext(name, param_type=ParameterFunctionType(func, value_encoding='float32')))
+
+    for i in xrange(width - len(pdict.keys())):
+        ctxt = ParameterContext('eng_%02d' % i, param_type=QuantityType(value_encoding=np.dtype('float32')))
+        ctxt.fill_value = -9999.
+        pdict.add_context(ctxt)
+    return pdict
+
+
+@attr('UTIL', group='dm')
+class TransformPrimeBenchmark(PyonTestCase):
+    records = 10
+    granules = 200
+
+    def setUp(self):
+        pdict = ctd_pdict()
+        l0_fields = [f for f in pdict.keys() if not f.endswith('_L1') and not f.endswith('_L2')]
+        l1_fields = [f for f in pdict.keys() if not f.endswith('_L2')]
+        self.stream_defs = {}
+        for level, fields in (('L0', l0_fields), ('L1', l1_fields), ('L2', pdict.keys())):
+            stream_def = StreamDefinition(parameter_dictionary=pdict.dump(), available_fields=fields)
+            stream_def._id = stream_def._rev = 'ctd_%s' % level
+            self.stream_defs['ctd_%s' % level] = stream_def
+        self.addCleanup(pdict_cache.invalidate)
+
+        patcher = patch('ion.services.dm.utility.granule.pdict_cache.PubsubManagementServiceClient')
+        pubsub_cls = patcher.start()
+        self.addCleanup(patcher.stop)
+        pubsub_cls.return_value.read_stream_definition.side_effect = self.stream_defs.get
+
+        self.transform = TransformPrime()
+        self.transform.pubsub_management = Mock()
+        self.transform.pubsub_management.read_stream_definition.side_effect = lambda stream_id : self.stream_defs[stream_id]
+        self.transform.new_lookups = Queue()
+        self.transform.lookup_docs = []
+        self.transform._routes = {}
+
+    def l0_granule(self):
+        rdt = RecordDictionaryTool(stream_definition_id='ctd_L0')
+        rdt['time'] = np.arange(self.records, dtype='float64')
+        for field in rdt.fields:
+            if field != 'time':
+                rdt[field] = np.random.random(self.records).astype('float32') * 100000
+        return rdt.to_granule()
+
+    def run_chain(self, granules, compiled):
+        start = time.time()
+        for granule in granules:
+            if not compiled:
+                self.transform._routes.clear()
+            rdt_l1 = self.transform._execute_transform(granule, ('ctd_L0', 'ctd_L1'))
+            rdt_l2 = self.transform._execute_transform(rdt_l1.to_granule(), ('ctd_L1', 'ctd_L2'))
+        return time.time() - start, rdt_l2
+
+    def test_ctd_chain(self):
+        granules = [self.l0_granule() for i in xrange(self.granules)]
+
+        # The baseline loads every parameter dictionary, as without the parameter dictionary cache
+        with patch.object(pdict_cache, '_load', side_effect=lambda key, pdict_dump : ParameterDictionary.load(pdict_dump)):
+            t_uncompiled, rdt_a = self.run_chain(granules, compiled=False)
+        t_compiled, rdt_b = self.run_chain(granules, compiled=True)
+
+        log.info('CTD L0->L1->L2 %d parameters, %d granules x %d records: uncached per granule routes %.1f granules/s, compiled routes %.1f granules/s',
+                 len(rdt_b.fields), self.granules, self.records, self.granules / t_uncompiled, self.granules / t_compiled)
+        for field in rdt_b.fields:
+            np.testing.assert_array_equal(rdt_a[field], rdt_b[field])
+        self.assertIn('DENSITY_L2', rdt_b.fields)
+
+    def test_dependency_order(self):
+        arguments = OrderedDict([('DENSITY_L2', ['PRACSAL_L2', 'TEMPWAT_L1']),
+                                 ('PRACSAL_L2', ['TEMPWAT_L1', 'CONDWAT_L0']),
+                                 ('TEMPWAT_L1', ['TEMPWAT_L0'])])
+        self.assertEquals(TransformRoute._dependency_order(arguments), ['TEMPWAT_L1', 'PRACSAL_L2', 'DENSITY_L2'])
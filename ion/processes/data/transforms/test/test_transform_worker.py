@@ -11,6 +11,7 @@ import numpy as np
 
 from pyon.ion.stream import StandaloneStreamPublisher, StreamSubscriber, StandaloneStreamSubscriber
 from pyon.util.int_test import IonIntegrationTestCase
+from pyon.util.unit_test import PyonTestCase
 from pyon.util.file_sys import FileSystem, FS
 from pyon.event.event import EventSubscriber, EventPublisher
 from pyon.public import OT, RT, PRED, CFG
@@ -45,9 +46,11 @@ from coverage_model.coverage import AbstractCoverage
 from pyon.util.context import LocalContextMixin
 
 from gevent.event import Event
+from mock import Mock, patch
 
 import unittest
 import os
+import sys
 
 
 def validate_salinity_array(a, context={}):
@@ -682,3 +685,91 @@ class TestTransformWorker(IonIntegrationTestCase):
 
         a = add_arrays(1,2)
         self.assertEquals(a,3)
+
+
+def add_arrays(a, b):
+    return a + b
+
+@attr('UNIT', group='dm')
+class TestTransformWorkerPlans(PyonTestCase):
+    def setUp(self):
+        self.worker = TransformWorker()
+        self.worker._dataprocesses['dp1'] = DotDict({'module':__name__, 'function':'add_arrays', 'argument_map':{'a':'temp', 'b':'pressure'},
+                                                     'out_stream_def':'sd1', 'output_param':'sum', 'uri':''})
+        self.worker._streamid_map['stream1'] = ['dp1']
+        patcher = patch.object(RecordDictionaryTool, 'read_stream_def')
+        self.read_stream_def = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_plan_cache(self):
+        self.assertIsNone(self.worker.retrieve_plan('stream1', 'dp1'))
+        plan = self.worker.compile_plan('stream1', 'dp1')
+        self.assertEquals(plan.function, add_arrays)
+        self.assertEquals((plan.out_stream_definition, plan.output_parameter), ('sd1', 'sum'))
+        self.assertIs(plan.stream_definition, self.read_stream_def.return_value)
+        self.assertTrue(self.worker.retrieve_plan('stream1', 'dp1') is plan)
+
+        args = plan.arguments({'temp':np.array([1,2]), 'pressure':np.array([3,4])})
+        np.testing.assert_array_equal(plan.function(*args), np.array([4,6]))
+
+        # Modifying the data process drops the plan and the stream mapping
+        self.worker._dataprocess_modified(DotDict(origin='dp1'))
+        self.assertEquals(self.worker._plans, {})
+        self.assertNotIn('dp1', self.worker._dataprocesses)
+        self.assertNotIn('stream1', self.worker._streamid_map)
+
+    @patch('ion.processes.data.transforms.transform_worker.time')
+    def test_bad_function(self, time_mock):
+        time_mock.time.return_value = 1000.
+        self.worker._dataprocesses['dp1'].function = 'subtract_arrays'
+        self.assertIsNone(self.worker.compile_plan('stream1', 'dp1'))
+
+        # Compiled again once the back off has passed, backing off longer after every failure
+        with patch.object(self.worker, 'compile_plan', wraps=self.worker.compile_plan) as compile_plan:
+            self.assertIsNone(self.worker.retrieve_plan('stream1', 'dp1'))
+            self.assertFalse(compile_plan.called)
+            time_mock.time.return_value = 1001.
+            self.assertIsNone(self.worker.retrieve_plan('stream1', 'dp1'))
+            self.assertEquals(compile_plan.call_count, 1)
+            self.assertEquals(self.worker._plan_failures['dp1'], (2, 1003.))
+
+            # A fixed data process compiles on the next attempt
+            self.worker._dataprocesses['dp1'].function = 'add_arrays'
+            time_mock.time.return_value = 1003.
+            self.assertEquals(self.worker.retrieve_plan('stream1', 'dp1').function, add_arrays)
+            self.assertNotIn('dp1', self.worker._plan_failures)
+
+    @patch('ion.processes.data.transforms.transform_worker.StreamPublisher')
+    def test_reload_publisher(self, publisher_cls):
+        details = DotDict(out_stream_id='out1', out_stream_route='route1')
+        publisher_cls.side_effect = lambda process, stream_id, stream_route : Mock(stream_id=stream_id, stream_route=stream_route)
+        self.worker.create_publisher('dp1', details)
+        publisher = self.worker._publisher_map['dp1']
+
+        self.worker.create_publisher('dp1', details)
+        self.assertIs(self.worker._publisher_map['dp1'], publisher)
+
+        # A new output stream closes the old publisher
+        self.worker.create_publisher('dp1', DotDict(out_stream_id='out2', out_stream_route='route2'))
+        publisher.close.assert_called_once_with()
+        self.assertEquals(self.worker._publisher_map['dp1'].stream_id, 'out2')
+
+    @patch('ion.processes.data.transforms.transform_worker.egg_cache')
+    def test_new_egg(self, egg_cache):
+        egg_uri, egg = 'http://example.com/ion_example-0.1-py2.7.egg', '/nonexistent/ion_example-0.1-py2.7.egg'
+        for dp_id, stream_id in [('dp1', 'stream1'), ('dp2', 'stream2')]:
+            self.worker._dataprocesses[dp_id] = DotDict(self.worker._dataprocesses['dp1'], uri=egg_uri)
+            self.worker._streamid_map[stream_id] = [dp_id]
+        self.worker._eggs[egg_uri] = egg
+        for dp_id in ('dp1', 'dp2'):
+            self.worker._plans[self.worker._plan_key(dp_id)] = Mock()
+        self.assertEquals(self.worker._plan_key('dp2'), ('dp2', egg_uri, egg))
+        sys.modules['ion_example_stale'] = DotDict(__file__=os.path.join(egg, 'ion_example_stale.py'))
+        self.addCleanup(sys.modules.pop, 'ion_example_stale', None)
+
+        # Every data process of the egg is reloaded, importing its modules again
+        self.worker.invalidate_data_process('dp1')
+        self.assertEquals(self.worker._plans, {})
+        self.assertEquals(self.worker._streamid_map, {})
+        self.assertNotIn('ion_example_stale', sys.modules)
+        egg_cache.forget.assert_called_once_with(egg_uri)
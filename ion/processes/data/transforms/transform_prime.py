@@ -13,13 +13,70 @@ from coverage_model import get_value_class
 from coverage_model.parameter_types import ParameterFunctionType
 from pyon.util.memoize import memoize_lru
 from pyon.util.log import log
-from pyon.core.exception import NotFound
 from pyon.ion.event import EventSubscriber
 from ion.util.stored_values import StoredValueManager
+from ion.processes.data.transforms.granule_batcher import GranuleBatcher
 from pyon.public import OT
 
 from gevent.event import Event
 from gevent.queue import Queue
+from collections import OrderedDict
+
+
+class TransformRoute(object):
+    '''
+    What a route from an incoming stream to an outgoing stream needs per
+    granule, compiled once: the merged parameter dictionary, the fields copied
+    from the incoming granule, the parameter functions ordered so each one
+    comes after the functions it takes as arguments and the fields of the
+    outgoing granule (or the actor's execute method).
+    '''
+    def __init__(self, stream_in_id, stream_out_id, stream_def_out_id, merged_pdict=None, executor=None):
+        self.stream_in_id      = stream_in_id
+        self.stream_out_id     = stream_out_id
+        self.stream_def_out_id = stream_def_out_id
+        self.merged_pdict      = merged_pdict
+        self.executor          = executor
+        self.copy_fields       = []
+        self.functions         = []
+        self.out_fields        = []
+        if merged_pdict is not None:
+            self._compile()
+
+    def _compile(self):
+        arguments = OrderedDict()
+        for field in self.merged_pdict.keys():
+            param_type = self.merged_pdict.get_context(field).param_type
+            if isinstance(param_type, ParameterFunctionType):
+                param_map = getattr(param_type.function, 'param_map', None) or {}
+                arguments[field] = [v for v in param_map.itervalues() if isinstance(v, basestring)]
+            else:
+                self.copy_fields.append(field)
+        self.functions = self._dependency_order(arguments)
+        self.out_fields = RecordDictionaryTool(stream_definition_id=self.stream_def_out_id).fields
+
+    @classmethod
+    def _dependency_order(cls, arguments):
+        '''
+        Orders the functions (name -> names of the parameters they take) so
+        every function comes after the functions among its arguments, cycles
+        are left in parameter dictionary order
+        '''
+        ordered = []
+        visited = set()
+        def visit(field):
+            if field in visited:
+                return
+            visited.add(field)
+            for argument in arguments[field]:
+                if argument in arguments:
+                    visit(argument)
+            ordered.append(field)
+        for field in arguments:
+            visit(field)
+        return ordered
+
+
 class TransformPrime(TransformDataProcess):
     binding=['output']
     '''
@@ -31,7 +88,13 @@ class TransformPrime(TransformDataProcess):
       process.routing_key    Route's routing key.
       process.queue_name     Name of the queue to listen on.
       process.routes         streams,actor for each route {(stream_input_id, stream_output_id):actor} 
+      process.batching       enabled, max_granules, max_latency (seconds) and split, see below
     Either the stream_id or both the exchange_point and routing_key need to be provided.
+
+    With batching enabled the granules of each incoming stream are merged
+    into one record dictionary and transformed together. The result is
+    published as one granule or, with split, as one granule per incoming
+    granule. Actor routes always receive and publish merged granules.
     '''    
     def on_start(self):
         TransformDataProcess.on_start(self)
@@ -43,9 +106,25 @@ class TransformPrime(TransformDataProcess):
         self.new_lookups = Queue()
         self.lookup_monitor = EventSubscriber(event_type=OT.ExternalReferencesUpdatedEvent,callback=self._add_lookups, auto_delete=True)
         self.lookup_monitor.start()
+        self._routes = {}
+
+        self.batcher = None
+        if self.CFG.get_safe('process.batching.enabled', False):
+            self.batch_split = self.CFG.get_safe('process.batching.split', False)
+            self.batcher = GranuleBatcher(self, self._recv_batch,
+                                          max_granules=self.CFG.get_safe('process.batching.max_granules', 10),
+                                          max_latency=self.CFG.get_safe('process.batching.max_latency', 1.0))
+            self.batcher.start()
+
+    def _stat(self):
+        if self.batcher:
+            self._stats['batching'] = self.batcher.stats()
+        return self._stats
 
     def on_quit(self):
         self.lookup_monitor.stop()
+        if self.batcher:
+            self.batcher.stop()
         TransformDataProcess.on_quit(self)
 
     def _add_lookups(self, event, *args, **kwargs):
@@ -60,6 +139,9 @@ class TransformPrime(TransformDataProcess):
 
     
     def recv_packet(self, msg, stream_route, stream_id):
+        if self.batcher:
+            self.batcher.add(stream_id, RecordDictionaryTool.load_from_granule(msg))
+            return
         process_routes = self.CFG.get_safe('process.routes', {})
         for stream_in_id,routes in process_routes.iteritems():
             if stream_id == stream_in_id:
@@ -71,6 +153,28 @@ class TransformPrime(TransformDataProcess):
                         outgoing = self._execute_actor(msg, actor, (stream_in_id, stream_out_id))
                         self.publish(outgoing, stream_out_id)
 
+    def _recv_batch(self, stream_id, rdt, sizes):
+        '''
+        Transforms the merged record dictionary of a batch of granules
+        '''
+        process_routes = self.CFG.get_safe('process.routes', {})
+        routes = process_routes.get(stream_id, {})
+        if not routes:
+            return
+        msg = None
+        for stream_out_id, actor in routes.iteritems():
+            if actor is None:
+                rdt_out = self._transform_rdt(rdt, (stream_id, stream_out_id))
+                if self.batch_split:
+                    for part in rdt_out.split(sizes):
+                        self.publish(part.to_granule(), stream_out_id)
+                else:
+                    self.publish(rdt_out.to_granule(), stream_out_id)
+            else:
+                msg = msg or rdt.to_granule()
+                outgoing = self._execute_actor(msg, actor, (stream_id, stream_out_id))
+                self.publish(outgoing, stream_out_id)
+
     def publish(self, msg, stream_out_id):
         publisher = getattr(self, stream_out_id)
         publisher.publish(msg)
@@ -97,14 +201,31 @@ class TransformPrime(TransformDataProcess):
         return execute
 
    
-    def _execute_actor(self, msg, actor, streams):
+    def _compile_route(self, streams, actor=None):
+        '''
+        Returns the compiled route for the pair of streams
+        '''
+        route = self._routes.get(streams)
+        if route is not None:
+            return route
         stream_in_id,stream_out_id = streams
         stream_def_out = self.read_stream_def(stream_out_id)
+        if actor is None:
+            stream_def_in = self.read_stream_def(stream_in_id)
+            merged_pdict = self._merge_pdicts(stream_def_in.parameter_dictionary, stream_def_out.parameter_dictionary)
+            route = TransformRoute(stream_in_id, stream_out_id, stream_def_out._id, merged_pdict=merged_pdict)
+        else:
+            route = TransformRoute(stream_in_id, stream_out_id, stream_def_out._id, executor=self._load_actor(actor))
+        self._routes[streams] = route
+        return route
+
+    def _execute_actor(self, msg, actor, streams):
+        route = self._compile_route(streams, actor)
         params = self.CFG.get_safe('process.params', {})
         config = self.CFG.get_safe('process')
         #do the stuff with the actor
-        params['stream_def'] = stream_def_out._id
-        executor = self._load_actor(actor)
+        params['stream_def'] = route.stream_def_out_id
+        executor = route.executor
         try:
             rdt_out = executor(msg, None, config, params, None)
         except:
@@ -127,14 +248,6 @@ class TransformPrime(TransformDataProcess):
                 merged_pdict.add_context(v)
         return merged_pdict
 
-    def _merge_rdt(self, stream_def_in, stream_def_out):
-        incoming_pdict_dump = stream_def_in.parameter_dictionary
-        outgoing_pdict_dump = stream_def_out.parameter_dictionary
-
-        merged_pdict = self._merge_pdicts(incoming_pdict_dump, outgoing_pdict_dump)
-        rdt_temp = RecordDictionaryTool(param_dictionary=merged_pdict)
-        return rdt_temp
-
 
     def _get_lookup_value(self, lookup_value):
         if not self.new_lookups.empty():
@@ -142,30 +255,28 @@ class TransformPrime(TransformDataProcess):
             self.lookup_docs = new_values + self.lookup_docs
 
         lookup_value_document_keys = self.lookup_docs
-        for key in lookup_value_document_keys:
-            try:
-                document = self.stored_values.read_value(key)
-                if lookup_value in document:
-                    return document[lookup_value]
-            except NotFound:
+        documents = self.stored_values.read_value_mult(lookup_value_document_keys)
+        for document in documents:
+            if document is None:
                 log.warning('Specified lookup document does not exist')
+            elif lookup_value in document:
+                return document[lookup_value]
 
         return None
 
     def _execute_transform(self, msg, streams):
-        stream_in_id,stream_out_id = streams
-        stream_def_in = self.read_stream_def(stream_in_id)
-        stream_def_out = self.read_stream_def(stream_out_id)
+        rdt_in = RecordDictionaryTool.load_from_granule(msg)
+        return self._transform_rdt(rdt_in, streams)
 
-        rdt_temp = self._merge_rdt(stream_def_in, stream_def_out)
+    def _transform_rdt(self, rdt_in, streams):
+        route = self._compile_route(streams)
+        rdt_temp = RecordDictionaryTool(param_dictionary=route.merged_pdict)
         
-        rdt_in = RecordDictionaryTool.load_from_granule(msg)
-        for field in rdt_temp.fields:
-            if not isinstance(rdt_temp._pdict.get_context(field).param_type, ParameterFunctionType):
-                try:
-                    rdt_temp[field] = rdt_in[field]
-                except KeyError:
-                    pass
+        for field in route.copy_fields:
+            try:
+                rdt_temp[field] = rdt_in[field]
+            except KeyError:
+                pass
 
         rdt_temp.fetch_lookup_values()
 
@@ -175,16 +286,13 @@ class TransformPrime(TransformDataProcess):
             if stored_value is not None:
                 rdt_temp[s] = stored_value
         
-        for field in rdt_temp.fields:
-            if isinstance(rdt_temp._pdict.get_context(field).param_type, ParameterFunctionType):
-                rdt_temp[field] = rdt_temp[field]
+        for field in route.functions:
+            rdt_temp[field] = rdt_temp[field]
 
         
-        rdt_out = RecordDictionaryTool(stream_definition_id=stream_def_out._id)
+        rdt_out = RecordDictionaryTool(stream_definition_id=route.stream_def_out_id)
 
-        for field in rdt_out.fields:
+        for field in route.out_fields:
             rdt_out[field] = rdt_temp[field]
         
-        return rdt_out 
-
-
+        return rdt_out
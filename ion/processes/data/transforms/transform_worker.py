@@ -6,6 +6,8 @@
 '''
 from interface.objects import Granule, DataProcessStatusType
 from ion.core.process.transform import TransformStreamListener, TransformStreamProcess
+from ion.util.egg_cache import egg_cache
+from ion.processes.data.transforms.granule_batcher import GranuleBatcher
 from ion.services.dm.utility.granule.record_dictionary import RecordDictionaryTool
 from pyon.ion.stream import StreamPublisher
 from interface.services.sa.idata_process_management_service import DataProcessManagementServiceClient
@@ -20,11 +22,52 @@ from pyon.util.arg_check import validate_is_instance
 from pyon.event.event import EventPublisher
 from pyon.core.object import IonObjectSerializer
 from pyon.ion.stream import StreamSubscriber
-from pyon.ion.event import handle_stream_exception
+from pyon.ion.event import handle_stream_exception, EventSubscriber
 
-from tempfile import gettempdir
+import importlib
+import inspect
 import os
-import requests
+import pkg_resources
+import sys
+import time
+
+
+class DataProcessPlan(object):
+    '''
+    The resolved transform function of a data process along with everything
+    needed to call it and publish its result, compiled once per data process
+    when it is loaded.
+    '''
+    def __init__(self, dataprocess_id, function, argument_map, context, out_stream_definition, output_parameter, egg_uri='', stream_definition=None):
+        self.dataprocess_id        = dataprocess_id
+        self.function              = function
+        self.argument_map          = argument_map or {}
+        self.context               = context
+        self.out_stream_definition = out_stream_definition
+        self.output_parameter      = output_parameter
+        self.egg_uri               = egg_uri
+        self.stream_definition     = stream_definition
+        # input stream definition -> parameters copied to the output
+        self._output_fields        = {}
+
+    def arguments(self, rdt):
+        args = [rdt[record_param] for record_param in self.argument_map.itervalues()]
+        if self.context:
+            args.append(self.context)
+        return args
+
+    def output_rdt(self):
+        '''
+        Returns an empty record dictionary of the output stream definition
+        '''
+        return RecordDictionaryTool(stream_definition=self.stream_definition, stream_definition_id=self.out_stream_definition)
+
+    def output_fields(self, rdt, rdt_out):
+        key = rdt._stream_def or tuple(rdt._rd)
+        fields = self._output_fields.get(key)
+        if fields is None:
+            fields = self._output_fields[key] = [param for param in rdt if param in rdt_out]
+        return fields
 
 
 class TransformWorker(TransformStreamListener):
@@ -33,6 +76,10 @@ class TransformWorker(TransformStreamListener):
     # Status publishes after a set of granules has been processed
     STATUS_INTERVAL = 100
 
+    # Seconds before compiling a plan that failed again, doubled on every failure
+    PLAN_RETRY_INITIAL = 1
+    PLAN_RETRY_MAX     = 300
+
     def __init__(self, *args,**kwargs):
         super(TransformWorker, self).__init__(*args, **kwargs)
 
@@ -43,6 +90,16 @@ class TransformWorker(TransformStreamListener):
 
         self._transforms = {}
 
+        # compiled plans for the data processes, by data process id, egg uri and egg path (see _plan_key)
+        self._plans = {}
+        # data process id -> (failed attempts, time of the next attempt) for plans that didn't compile
+        self._plan_failures = {}
+        # paths of the eggs already added to the working set, by uri
+        self._eggs = {}
+
+        self.batcher = None
+        self.batch_split = False
+
 
     def on_start(self): #pragma no cover
         #super(TransformWorker,self).on_start()
@@ -64,17 +121,37 @@ class TransformWorker(TransformStreamListener):
         self._rpc_server = self.container.proc_manager._create_listening_endpoint(from_name=self.id, process=self)
         self.add_endpoint(self._rpc_server)
 
-        self.start_listener()
+        # Compiled plans are dropped when their data process changes
+        self.dataprocess_monitor = EventSubscriber(event_type=OT.ResourceModifiedEvent, origin_type=RT.DataProcess, callback=self._dataprocess_modified, auto_delete=True)
+        self.add_endpoint(self.dataprocess_monitor)
 
         #todo: determine and publish appropriate set of status events
         self.event_publisher = EventPublisher(OT.DataProcessStatusEvent)
 
+        # Micro-batching: granules on a stream are merged and processed together
+        self.batcher = None
+        if self.CFG.get_safe('process.batching.enabled', False):
+            self.batch_split = self.CFG.get_safe('process.batching.split', False)
+            self.batcher = GranuleBatcher(self, self.process_rdt,
+                                          max_granules=self.CFG.get_safe('process.batching.max_granules', 10),
+                                          max_latency=self.CFG.get_safe('process.batching.max_latency', 1.0))
+            self.batcher.start()
+
+        self.start_listener()
+
+    def _stat(self):
+        if self.batcher:
+            self._stats['batching'] = self.batcher.stats()
+        return self._stats
+
 
 
     def on_quit(self): #pragma no cover
-        self.event_publisher.close()
         if self.subscriber_thread:
             self.stop_listener()
+        if self.batcher:
+            self.batcher.stop()
+        self.event_publisher.close()
         super(TransformWorker, self).on_quit()
 
     def start_listener(self):
@@ -116,52 +193,60 @@ class TransformWorker(TransformStreamListener):
             log.debug('Empty granule for stream %s', stream_id)
             return
 
+        if self.batcher:
+            self.batcher.add(stream_id, rdt)
+        else:
+            self.process_rdt(stream_id, rdt)
+
+    def process_rdt(self, stream_id, rdt, sizes=None):
+        '''
+        Runs the data processes of the stream on the record dictionary, sizes
+        lists the records of each granule merged into it when batching
+        '''
         dp_id_list = self.retrieve_dataprocess_for_stream(stream_id)
 
+        # The input record dictionary is shared by every data process on the stream
         for dp_id in dp_id_list:
 
-            function, argument_list, context = self.retrieve_function_and_define_args(stream_id, dp_id)
-
-            args = []
-            rdt = RecordDictionaryTool.load_from_granule(msg)
+            plan = self.retrieve_plan(stream_id, dp_id)
+            if plan is None:
+                continue
 
             #create the input arguments list
             #todo: this logic is tied to the example function, generalize
             #todo: how to inject params not in the granule such as stream_id, dp_id, etc?
-            for func_param, record_param in argument_list.iteritems():
-                args.append(rdt[record_param])
-            if context:
-                args.append(context)
+            args = plan.arguments(rdt)
 
             try:
                 #run the calc
                 #todo: nothing in the data process resource to specify multi-out map
                 result = ''
                 try:
-                    result = function(*args)
+                    result = plan.function(*args)
                     log.debug('recv_packet  result: %s',result)
                 except:
                     log.error('Error running transform %s with args %s.', dp_id, args, exc_info=True)
                     raise
 
-                out_stream_definition, output_parameter = self.retrieve_dp_output_params(dp_id)
-
-                if out_stream_definition and output_parameter:
-                    rdt_out = RecordDictionaryTool(stream_definition_id=out_stream_definition)
+                if plan.stream_definition and plan.output_parameter:
+                    rdt_out = plan.output_rdt()
                     publisher = self._publisher_map.get(dp_id,'')
 
-                    for param in rdt:
-                        if param in rdt_out:
-                            rdt_out[param] = rdt[param]
-                    rdt_out[ output_parameter ] = result
+                    for param in plan.output_fields(rdt, rdt_out):
+                        rdt_out[param] = rdt[param]
+                    rdt_out[ plan.output_parameter ] = result
 
                     if publisher:
                         log.debug('output rdt: %s',rdt)
-                        publisher.publish(rdt_out.to_granule())
+                        if sizes and self.batch_split:
+                            for part in rdt_out.split(sizes):
+                                publisher.publish(part.to_granule())
+                        else:
+                            publisher.publish(rdt_out.to_granule())
                     else:
                         log.error('Publisher not found for data process %s', dp_id)
 
-                self.update_dp_metrics( dp_id )
+                self.update_dp_metrics( dp_id, len(sizes) if sizes else 1 )
 
             except ImportError:
                 log.error('Error running transform')
@@ -176,8 +261,106 @@ class TransformWorker(TransformStreamListener):
         return dp_id_list
 
 
+    def retrieve_plan(self, stream_id, dataprocess_id):
+        '''
+        Returns the plan compiled when the data process was loaded. A plan that
+        failed to compile is compiled again, backing off between attempts, and
+        None is returned until it compiles
+        '''
+        plan = self._plans.get(self._plan_key(dataprocess_id))
+        if plan is not None:
+            return plan
+        attempts, retry_at = self._plan_failures.get(dataprocess_id, (0, 0))
+        if time.time() < retry_at:
+            return None
+        return self.compile_plan(stream_id, dataprocess_id)
+
+    def _plan_key(self, dataprocess_id):
+        '''
+        Plans are keyed by the egg they were loaded from as well, the cached
+        egg's path is named after its digest
+        '''
+        dataprocess_info = self._dataprocesses.get(dataprocess_id)
+        egg_uri = dataprocess_info.get_safe('uri','') if dataprocess_info is not None else ''
+        return dataprocess_id, egg_uri, self._eggs.get(egg_uri, '')
+
+    def compile_plan(self, stream_id, dataprocess_id):
+        '''
+        Resolves the transform function and the output stream definition of the
+        data process, logs the error and returns None when they can't be
+        '''
+        try:
+            function, argument_list, context = self.retrieve_function_and_define_args(stream_id, dataprocess_id)
+            if not function:
+                return self._plan_failed(dataprocess_id)
+            out_stream_definition, output_parameter = self.retrieve_dp_output_params(dataprocess_id)
+            stream_definition = None
+            if out_stream_definition and output_parameter:
+                stream_definition = RecordDictionaryTool.read_stream_def(out_stream_definition)
+        except Exception:
+            log.error('Unable to load the transform of data process %s', dataprocess_id, exc_info=True)
+            return self._plan_failed(dataprocess_id)
+        egg_uri = self._dataprocesses[dataprocess_id].get_safe('uri','')
+        plan = DataProcessPlan(dataprocess_id, function, argument_list, context, out_stream_definition, output_parameter, egg_uri, stream_definition)
+        self._plans[self._plan_key(dataprocess_id)] = plan
+        self._plan_failures.pop(dataprocess_id, None)
+        return plan
+
+    def _plan_failed(self, dataprocess_id):
+        attempts, _ = self._plan_failures.get(dataprocess_id, (0, 0))
+        delay = min(self.PLAN_RETRY_INITIAL * 2 ** attempts, self.PLAN_RETRY_MAX)
+        log.warning('Data process %s will be loaded again in %s seconds', dataprocess_id, delay)
+        self._plan_failures[dataprocess_id] = (attempts + 1, time.time() + delay)
+        return None
+
+    def _dataprocess_modified(self, event, *args, **kwargs):
+        self.invalidate_data_process(event.origin)
+
+    def invalidate_data_process(self, dataprocess_id):
+        '''
+        Drops the compiled plan of the data process along with the plans using
+        the same egg, whose modules are imported again from its current version.
+        The data processes of their input streams are reloaded with the next granule
+        '''
+        stale = set([dataprocess_id])
+        dataprocess_info = self._dataprocesses.get(dataprocess_id)
+        egg_uri = dataprocess_info.get_safe('uri','') if dataprocess_info is not None else ''
+        if egg_uri:
+            stale.update(dp_id for dp_id, info in self._dataprocesses.iteritems() if info.get_safe('uri','') == egg_uri)
+            self.unload_egg(egg_uri)
+        for stream_id, dp_id_list in self._streamid_map.items():
+            if stale.intersection(dp_id_list):
+                stale.update(self._streamid_map.pop(stream_id))
+        for key in self._plans.keys():
+            if key[0] in stale:
+                del self._plans[key]
+        for dp_id in stale:
+            self._plan_failures.pop(dp_id, None)
+            self._dataprocesses.pop(dp_id, None)
+
+    def unload_egg(self, egg_uri):
+        '''
+        Removes the egg from the working set and the modules imported from it,
+        so the next import revalidates the egg and loads its current code
+        '''
+        egg_cache.forget(egg_uri)
+        egg = self._eggs.pop(egg_uri, None)
+        if egg is None:
+            return
+        working_set = pkg_resources.working_set
+        for dist in pkg_resources.find_distributions(egg, True):
+            if working_set.by_key.get(dist.key) == dist:
+                del working_set.by_key[dist.key]
+        working_set.entry_keys.pop(egg, None)
+        while egg in working_set.entries:
+            working_set.entries.remove(egg)
+        while egg in sys.path:
+            sys.path.remove(egg)
+        for name, module in sys.modules.items():
+            if module is not None and (getattr(module, '__file__', None) or '').startswith(egg + os.sep):
+                del sys.modules[name]
+
     def retrieve_function_and_define_args(self, stream_id, dataprocess_id):
-        import importlib
         argument_list = {}
         function = ''
         context = {}
@@ -191,9 +374,10 @@ class TransformWorker(TransformStreamListener):
             #load the associated transform function
             egg_uri = dataprocess_info.get_safe('uri','')
             if egg_uri:
-                egg = self.download_egg(egg_uri)
-                import pkg_resources
-                pkg_resources.working_set.add_entry(egg)
+                if egg_uri not in self._eggs:
+                    egg = self.download_egg(egg_uri)
+                    pkg_resources.working_set.add_entry(egg)
+                    self._eggs[egg_uri] = egg
             else:
                 log.warning('No uri provided for module in data process definition.')
 
@@ -218,11 +402,12 @@ class TransformWorker(TransformStreamListener):
         return out_stream_definition, output_parameter
 
 
-    def update_dp_metrics(self, dataprocess_id):
+    def update_dp_metrics(self, dataprocess_id, granules=1):
         #update metrics
         dataprocess_info = self._dataprocesses[dataprocess_id]
-        dataprocess_info.granule_counter += 1
-        if dataprocess_info.granule_counter % self.STATUS_INTERVAL == 0:
+        previous = dataprocess_info.granule_counter
+        dataprocess_info.granule_counter += granules
+        if dataprocess_info.granule_counter / self.STATUS_INTERVAL > previous / self.STATUS_INTERVAL:
             #publish a status update event
             self.event_publisher.publish_event(origin=dataprocess_id, origin_type='DataProcess', status=DataProcessStatusType.NORMAL,
                                    description='data process status update. %s granules processed'% dataprocess_info.granule_counter )
@@ -265,6 +450,8 @@ class TransformWorker(TransformStreamListener):
 
             #create a publisher for output stream
             self.create_publisher(dataprocess_id, dataprocess_details)
+            # Configuration errors are logged here rather than with every granule
+            self.compile_plan(stream_id, dataprocess_id)
             dataprocess_ids.append(dataprocess_id)
 
         return dataprocess_ids
@@ -276,6 +463,12 @@ class TransformWorker(TransformStreamListener):
         #todo: DataProcess, EventProcess get stream publishers
         out_stream_route = dataprocess_details.get('out_stream_route', '')
         out_stream_id = dataprocess_details.get('out_stream_id', '')
+        # A reloaded data process keeps its publisher unless its output stream changed
+        publisher = self._publisher_map.get(dataprocess_id)
+        if publisher is not None:
+            if publisher.stream_id == out_stream_id and publisher.stream_route == out_stream_route:
+                return
+            publisher.close()
         publisher = StreamPublisher(process=self, stream_id=out_stream_id, stream_route=out_stream_route)
 
         self._publisher_map[dataprocess_id] = publisher
@@ -283,27 +476,12 @@ class TransformWorker(TransformStreamListener):
     @classmethod
     def download_egg(cls, url):
         '''
-        Downloads an egg from the URL specified into the cache directory
-        Returns the full path to the egg
+        Downloads an egg from the URL specified into the egg cache, unless it's
+        already there. Returns the full path to the egg
         '''
-        # Get the filename based on the URL
-        filename = url.split('/')[-1]
-        # Store it in the $TMPDIR
-        egg_cache = gettempdir()
-        path = os.path.join(egg_cache, filename)
-        r = requests.get(url, stream=True)
-        if r.status_code == 200:
-            # Download the file using requests stream
-            with open(path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-            return path
-        raise IOError("Couldn't download the file at %s" % url)
+        return egg_cache.get(url)
 
     def has_context_arg(self, func , argument_map):
-        import inspect
         argspec = inspect.getargspec(func)
         return argspec.args != argument_map and 'context' in argspec.args
 
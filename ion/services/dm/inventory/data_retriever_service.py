@@ -8,6 +8,8 @@ from ion.core.function.transform_function import TransformFunction
 from ion.processes.data.replay.replay_process import ReplayProcess
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
 from ion.services.dm.utility.granule import RecordDictionaryTool
+from ion.services.dm.utility.coverage_pool import coverage_pool
+from ion.services.dm.utility.tail_buffer import tail_buffers
 
 from pyon.core.exception import BadRequest 
 from pyon.container.cc import Container
@@ -20,29 +22,29 @@ from pyon.event.event import EventSubscriber
 from interface.objects import Replay 
 from interface.services.dm.idata_retriever_service import BaseDataRetrieverService
 
-import collections
-import time
-import gevent
+import numpy as np
+
 
 class DataRetrieverService(BaseDataRetrieverService):
     REPLAY_PROCESS = 'replay_process'
 
-    _refresh_interval = 10
-    _cache_limit      = 5
-    _retrieve_cache   = collections.OrderedDict()
-    _cache_lock       = gevent.coros.RLock()
+    # Coverage handles shared with ReplayProcess.get_last_values, the pool
+    # invalidates the datasets named by DatasetModified events itself
+    _pool = coverage_pool
 
-    def on_start(self):
-        self.event_subscriber = EventSubscriber(event_type='DatasetModified', callback=lambda event,m : self._eject_cache(event.origin), auto_delete=True)
-        self.add_endpoint(self.event_subscriber)
+    # Recent rows of the datasets polled through retrieve_since, fed by ingestion
+    _tail = tail_buffers
 
     @classmethod
     def _eject_cache(cls, dataset_id):
-        with cls._cache_lock:
-            try:
-                cls._retrieve_cache.pop(dataset_id)
-            except KeyError:
-                pass
+        cls._pool.invalidate(dataset_id)
+
+    @classmethod
+    def _pool_stats(cls):
+        '''
+        Hit, miss, eviction and invalidation counts of the coverage pool
+        '''
+        return cls._pool.stats()
     
     def define_replay(self, dataset_id='', query=None, delivery_format='', stream_id=''):
         ''' Define the stream that will contain the data from data store by streaming to an exchange name.
@@ -119,40 +121,18 @@ class DataRetrieverService(BaseDataRetrieverService):
 
         self.clients.resource_registry.delete(replay_id)
 
-    @classmethod
-    def _get_coverage(cls,dataset_id):
-        '''
-        Memoized coverage instantiation and management
-        '''
-        # Cached get
-        retval = None
-        with cls._cache_lock:
-            try:
-                retval, age = cls._retrieve_cache.pop(dataset_id)
-                if (time.time() - age) > cls._refresh_interval:
-                    raise KeyError(dataset_id)
-            except KeyError: # Cache miss
-                #@TODO: Add in LRU logic (maybe some mem checking too!)
-                if len(cls._retrieve_cache) > cls._cache_limit:
-                    cls._retrieve_cache.popitem(0)
-                retval = DatasetManagementService._get_nonview_coverage(dataset_id, mode='r') 
-            age = time.time()
-            cls._retrieve_cache[dataset_id] = (retval, age)
-        return retval
-
     @classmethod
     def retrieve_oob(cls, dataset_id='', query=None, delivery_format=''):
         query = query or {}
-        coverage = None
         try:
-            coverage = cls._get_coverage(dataset_id)
-            if coverage is None:
-                raise BadRequest('no such coverage')
-            if coverage.num_timesteps == 0:
-                log.info('Reading from an empty coverage')
-                rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
-            else:
-                rdt = ReplayProcess._cov2granule(coverage=coverage, start_time=query.get('start_time', None), end_time=query.get('end_time',None), stride_time=query.get('stride_time',None), parameters=query.get('parameters',None), stream_def_id=delivery_format, tdoa=query.get('tdoa',None))
+            with cls._pool.coverage(dataset_id) as coverage:
+                if coverage is None:
+                    raise BadRequest('no such coverage')
+                if coverage.num_timesteps == 0:
+                    log.info('Reading from an empty coverage')
+                    rdt = RecordDictionaryTool(param_dictionary=coverage.parameter_dictionary)
+                else:
+                    rdt = ReplayProcess._cov2granule(coverage=coverage, start_time=query.get('start_time', None), end_time=query.get('end_time',None), stride_time=query.get('stride_time',None), parameters=query.get('parameters',None), stream_def_id=delivery_format, tdoa=query.get('tdoa',None))
         except:
             cls._eject_cache(dataset_id)
             data_products, _ = Container.instance.resource_registry.find_subjects(object=dataset_id, predicate=PRED.hasDataset, subject_type=RT.DataProduct)
@@ -181,6 +161,80 @@ class DataRetrieverService(BaseDataRetrieverService):
 
         return retrieve_data
 
+    @classmethod
+    def retrieve_since(cls, dataset_id='', cursor=None):
+        '''
+        Retrieves the rows appended to a dataset since the cursor.
+        @param dataset_id  Dataset identifier
+        @param cursor      Cursor returned by the previous call, None for the most recent rows
+        @retval            (granule, cursor) the rows and the cursor for the next call
+
+        Rows are served from an in-memory buffer of the most recently ingested
+        rows, which ingestion in the same container feeds (see TailBuffers). The
+        coverage is only read to start the buffer, to catch up with rows
+        ingested elsewhere and for cursors older than the buffer.
+        '''
+        buf = cls._tail.get(dataset_id)
+        if buf is not None and cls._tail.current(buf) and buf.covers(cls._cursor_index(buf, cursor)):
+            cls._tail.hits += 1
+            columns = buf.rows_since(cls._cursor_index(buf, cursor))
+        else:
+            cls._tail.misses += 1
+            with cls._pool.coverage(dataset_id) as coverage:
+                if coverage is None:
+                    raise BadRequest('no such coverage')
+                buf = cls._update_tail(dataset_id, coverage)
+                index = cls._cursor_index(buf, cursor)
+                if buf.covers(index):
+                    columns = buf.rows_since(index)
+                else:
+                    columns = cls._read_columns(coverage, slice(index, buf.end))
+
+        rdt = RecordDictionaryTool(param_dictionary=buf.parameter_dictionary)
+        tname = buf.parameter_dictionary.temporal_parameter_name
+        if tname in columns:
+            rdt[tname] = columns.pop(tname)
+            for k,v in columns.iteritems():
+                rdt[k] = v
+        return rdt.to_granule(), {'index':buf.end, 'generation':buf.generation}
+
+    @classmethod
+    def _cursor_index(cls, buf, cursor):
+        '''
+        Index to continue from, cursor indices are coverage indices valid
+        whichever buffer issued them
+        '''
+        if cursor and cursor.get('index') is not None:
+            return min(cursor['index'], buf.end)
+        return buf.start
+
+    @classmethod
+    def _update_tail(cls, dataset_id, coverage):
+        '''
+        Returns the dataset's tail buffer with the rows appended to the coverage
+        that weren't fed to it
+        '''
+        num_timesteps = coverage.num_timesteps
+        buf = cls._tail.get(dataset_id)
+        if buf is None or num_timesteps < buf.end:
+            # New, or the coverage shrank and the buffered rows can't be trusted
+            start = max(num_timesteps - cls._tail.capacity, 0)
+            buf = cls._tail.create(dataset_id, coverage.parameter_dictionary, start)
+        start = buf.end
+        if num_timesteps > start:
+            columns = cls._read_columns(coverage, slice(start, num_timesteps))
+            # Unless ingestion fed rows past them in the meantime
+            if buf.end == start:
+                buf.append(start, columns)
+        return buf
+
+    @classmethod
+    def _read_columns(cls, coverage, slice_):
+        if slice_.start >= slice_.stop:
+            return {}
+        rdt = ReplayProcess._coverage_to_granule(coverage, tdoa=slice_)
+        return dict((k, np.atleast_1d(rdt[k])) for k,v in rdt.iteritems())
+
     def retrieve_last_data_points(self, dataset_id='', number_of_points=100, delivery_format=''):
         return ReplayProcess.get_last_values(dataset_id, number_of_points, delivery_format)
 
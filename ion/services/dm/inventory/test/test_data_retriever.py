@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/inventory/test/test_data_retriever.py
+@brief Unit tests for polling datasets through retrieve_since
+'''
+
+from pyon.util.containers import DotDict
+from pyon.util.unit_test import PyonTestCase
+from ion.services.dm.inventory.data_retriever_service import DataRetrieverService
+from ion.services.dm.utility.coverage_pool import CoveragePool
+from ion.services.dm.utility.tail_buffer import TailBuffers
+from nose.plugins.attrib import attr
+from mock import Mock, MagicMock, patch
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class RetrieveSinceUnitTest(PyonTestCase):
+    def setUp(self):
+        self.coverage = Mock(num_timesteps=5)
+        self.reads = []
+        def read_columns(coverage, slice_):
+            self.reads.append((slice_.start, slice_.stop))
+            if slice_.start >= slice_.stop:
+                return {}
+            return {'time' : np.arange(slice_.start, slice_.stop)}
+
+        tail = TailBuffers(capacity=10)
+        tail._subscriber = Mock() # Monitoring dataset modifications, as in a container
+        for name, value in (('_pool', CoveragePool(opener=lambda dataset_id : self.coverage)),
+                            ('_tail', tail),
+                            ('_read_columns', Mock(side_effect=read_columns))):
+            patcher = patch.object(DataRetrieverService, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('ion.services.dm.inventory.data_retriever_service.RecordDictionaryTool', MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ingest(self, start, stop, fed=True):
+        self.coverage.num_timesteps = stop
+        if fed:
+            DataRetrieverService._tail.feed('ds1', start, {'time' : np.arange(start, stop)})
+        DataRetrieverService._tail._on_modified(DotDict(origin='ds1', extents=stop, window=(start, stop)))
+
+    def test_retrieve_since(self):
+        _, cursor = DataRetrieverService.retrieve_since('ds1')
+        self.assertEquals(cursor['index'], 5)
+        self.assertEquals(self.reads, [(0, 5)])
+
+        # Rows fed by ingestion are served from memory
+        del self.reads[:]
+        self.ingest(5, 8)
+        _, cursor = DataRetrieverService.retrieve_since('ds1', cursor)
+        self.assertEquals(cursor['index'], 8)
+        self.assertEquals(self.reads, [])
+        self.assertEquals(DataRetrieverService._tail.hits, 1)
+
+        # So is any cursor the buffer covers, whichever worker issued it
+        _, next_cursor = DataRetrieverService.retrieve_since('ds1', {'index':6, 'generation':'other'})
+        self.assertEquals(self.reads, [])
+        self.assertEquals(next_cursor['index'], 8)
+
+        # Another worker, with its own buffer, reads the coverage once and continues from the cursor
+        DataRetrieverService._tail = TailBuffers(capacity=10)
+        DataRetrieverService._tail._subscriber = Mock()
+        _, next_cursor = DataRetrieverService.retrieve_since('ds1', dict(cursor, index=6))
+        self.assertEquals(self.reads, [(0, 8)])
+        self.assertEquals(next_cursor['index'], 8)
+
+        # Rows ingested in another container are read on the next poll only
+        del self.reads[:]
+        self.ingest(8, 10, fed=False)
+        _, cursor = DataRetrieverService.retrieve_since('ds1', next_cursor)
+        self.assertEquals(self.reads, [(8, 10)])
+        _, cursor = DataRetrieverService.retrieve_since('ds1', cursor)
+        self.assertEquals(self.reads, [(8, 10)])
+        self.assertEquals(cursor['index'], 10)
+
+        # The coverage shrank
+        self.coverage.num_timesteps = 3
+        DataRetrieverService._tail._on_modified(DotDict(origin='ds1', extents=3, window=(0, 3)))
+        _, next_cursor = DataRetrieverService.retrieve_since('ds1', cursor)
+        self.assertNotEquals(next_cursor['generation'], cursor['generation'])
+        self.assertEquals(next_cursor['index'], 3)
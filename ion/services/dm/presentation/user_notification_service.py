@@ -8,13 +8,17 @@ from pyon.public import RT, PRED, get_sys_name, OT, IonObject, get_ion_ts, log,
 from pyon.core.governance import ORG_MEMBER_ROLE, ORG_MANAGER_ROLE, INSTRUMENT_OPERATOR, DATA_OPERATOR, OBSERVATORY_OPERATOR, GovernanceHeaderValues, has_org_role
 
 from ion.services.dm.utility.uns_utility_methods import setting_up_smtp_client, convert_events_to_email_message, \
-    get_event_computed_attributes, calculate_reverse_user_info
+    get_event_computed_attributes, calculate_reverse_user_info, reload_notification, SubscriptionIndex
+from ion.services.dm.utility.digest import iter_events, DigestBuffer
 
 from interface.services.coi.iresource_registry_service import ResourceRegistryServiceClient
 from interface.services.dm.iuser_notification_service import BaseUserNotificationService
 from interface.objects import ComputedValueAvailability, ComputedListValue
 from interface.objects import ProcessDefinition, TemporalBounds
 
+from gevent.coros import RLock
+from gevent.pool import Pool
+
 
 class EmailEventProcessor(object):
     """
@@ -62,6 +66,10 @@ class UserNotificationService(BaseUserNotificationService):
         # The reverse_user_info is calculated from the user_info dictionary
         self.reverse_user_info = {}
 
+        # The subscriptions of the users who get daily digests
+        self.digest_subscriptions = SubscriptionIndex(digest=True)
+        self._smtp_lock = RLock()
+
         self.event_publisher = EventPublisher(process=self)
 
         self.start_time = get_ion_ts()
@@ -75,13 +83,23 @@ class UserNotificationService(BaseUserNotificationService):
             Callback method for the subscriber to ReloadUserInfoEvent
             """
 
-            notification_id =  event_msg.notification_id
+            notification_id =  getattr(event_msg, 'notification_id', None)
             log.debug("(UNS instance) received a ReloadNotificationEvent. The relevant notification_id is %s" % notification_id)
 
-            try:
-                self.user_info = self.load_user_info()
-            except NotFound:
-                log.warning("ElasticSearch has not yet loaded the user_index.")
+            # A created or retired notification only changes the subscriptions of its users
+            reloaded = False
+            if notification_id and self.user_info:
+                try:
+                    reloaded = reload_notification(self.clients.resource_registry, self.user_info, notification_id, [self.digest_subscriptions])
+                except NotFound:
+                    log.warning("(UNS instance) Notification %s not found, reloading all the user info", notification_id)
+
+            if not reloaded:
+                try:
+                    self.user_info = self.load_user_info()
+                except NotFound:
+                    log.warning("ElasticSearch has not yet loaded the user_index.")
+                self.digest_subscriptions.load(self.user_info)
 
             self.reverse_user_info =  calculate_reverse_user_info(self.user_info)
 
@@ -96,6 +114,15 @@ class UserNotificationService(BaseUserNotificationService):
         )
         self.add_endpoint(self.reload_user_info_subscriber)
 
+        # the subscriber for the UserInfo resource update events, the delivery preferences may have changed
+        self.userinfo_rsc_mod_subscriber = EventSubscriber(
+            event_type=OT.ResourceModifiedEvent,
+            sub_type="UPDATE",
+            origin_type="UserInfo",
+            callback=reload_user_info
+        )
+        self.add_endpoint(self.userinfo_rsc_mod_subscriber)
+
     def on_quit(self):
         """
         Handles stop/terminate.
@@ -417,10 +444,13 @@ class UserNotificationService(BaseUserNotificationService):
 
     def process_batch(self, start_time = '', end_time = ''):
         """
-        This method is launched when an process_batch event is received. The user info dictionary maintained
-        by the User Notification Service is used to query the event repository for all events for a particular
-        user that have occurred in a provided time interval, and then an email is sent to the user containing
-        the digest of all the events.
+        This method is launched when an process_batch event is received. The events that occurred in the
+        provided time interval are read from the event repository once and matched against the subscriptions
+        of the users who want daily digests, then an email is sent to each user containing the digest of
+        the events.
+
+        The events are buffered per user, on disk past service.user_notification.digest.max_buffered_events,
+        and the emails are rendered by service.user_notification.digest.workers greenlets.
 
         @param start_time int milliseconds
         @param end_time int milliseconds
@@ -430,45 +460,33 @@ class UserNotificationService(BaseUserNotificationService):
         if end_time <= start_time:
             return
 
-        for user_id, value in self.user_info.iteritems():
-
-            notifications = self.get_user_notifications(user_info_id=user_id)
-            notifications_disabled = value['notifications_disabled']
-            notifications_daily_digest = value['notifications_daily_digest']
-
-
-            # Ignore users who do NOT want batch notifications or who have disabled the delivery switch
-            # However, if notification preferences have not been set for the user, use the default mechanism and do not bother
-            if notifications_disabled or not notifications_daily_digest:
-                    continue
-
-            events_for_message = []
-
-            search_time = "SEARCH 'ts_created' VALUES FROM %s TO %s FROM 'events_index'" % (start_time, end_time)
-
-            for notification in notifications:
-                # If the notification request has expired, then do not use it in the search
-                if notification.temporal_bounds.end_datetime:
-                    continue
-
-                event_tuples = self.container.event_repository.find_events(
-                    origin=notification.origin,
-                    event_type=notification.event_type,
-                    start_ts=start_time,
-                    end_ts=end_time)
-                events = [item[2] for item in event_tuples]
-
-                events_for_message.extend(events)
-
-            log.debug("Found following events of interest to user, %s: %s", user_id, events_for_message)
-
-            # send a notification email to each user using a _send_email() method
-            if events_for_message:
-                self.format_and_send_email(events_for_message = events_for_message,
-                                            user_id = user_id,
-                                            smtp_client=self.smtp_client)
-
-        self.smtp_client.quit()
+        digest_cfg = self.CFG.get_safe('service.user_notification.digest', {}) or {}
+        buffer = DigestBuffer(max_events=digest_cfg.get('max_buffered_events', 10000),
+                              directory=digest_cfg.get('spill_dir', None))
+        try:
+            for event in iter_events(self.container.event_repository, start_time, end_time,
+                                     page_size=digest_cfg.get('page_size', 1000)):
+                for user_id in self.digest_subscriptions.match(event):
+                    buffer.add(user_id, event)
+
+            pool = Pool(digest_cfg.get('workers', 4))
+            for user_id in buffer.users():
+                if user_id in self.user_info:
+                    pool.spawn(self._send_digest, buffer, user_id)
+            pool.join()
+        finally:
+            buffer.close()
+            self.smtp_client.quit()
+
+    def _send_digest(self, buffer, user_id):
+        events_for_message = buffer.events(user_id)
+        log.debug("Found following events of interest to user, %s: %s", user_id, events_for_message)
+        try:
+            self.format_and_send_email(events_for_message = events_for_message,
+                                       user_id = user_id,
+                                       smtp_client=self.smtp_client)
+        except Exception:
+            log.exception("Failed to send the digest email to user %s", user_id)
 
 
     def format_and_send_email(self, events_for_message=None, user_id=None, smtp_client=None):
@@ -509,7 +527,9 @@ class UserNotificationService(BaseUserNotificationService):
 
         smtp_sender = CFG.get_safe('server.smtp.sender')
 
-        smtp_client.sendmail(smtp_sender, [msg_recipient], msg.as_string())
+        # Digests are rendered concurrently but share one SMTP session
+        with self._smtp_lock:
+            smtp_client.sendmail(smtp_sender, [msg_recipient], msg.as_string())
 
     def update_user_info_object(self, user_id, new_notification):
         """
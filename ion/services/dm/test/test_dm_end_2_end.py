@@ -579,7 +579,6 @@ class TestDMEnd2End(IonIntegrationTestCase):
     @attr('LOCOINT')
     @unittest.skipIf(os.getenv('CEI_LAUNCH_TEST', False), 'Host requires file-system access to coverage files, CEI mode does not support.')
     def test_retrieve_cache(self):
-        DataRetrieverService._refresh_interval = 1
         datasets = [self.make_simple_dataset() for i in xrange(10)]
         for stream_id, route, stream_def_id, dataset_id in datasets:
             coverage = DatasetManagementService._get_simplex_coverage(dataset_id, mode='a')
@@ -587,30 +586,36 @@ class TestDMEnd2End(IonIntegrationTestCase):
             coverage.set_parameter_values('time', np.arange(10))
             coverage.set_parameter_values('temp', np.arange(10))
 
-        # Verify cache hit and refresh
+        pool = DataRetrieverService._pool
+        pool.clear()
+
+        # Verify cache hit
         dataset_ids = [i[3] for i in datasets]
-        self.assertTrue(dataset_ids[0] not in DataRetrieverService._retrieve_cache)
-        DataRetrieverService._get_coverage(dataset_ids[0]) # Hit the chache
-        cov, age = DataRetrieverService._retrieve_cache[dataset_ids[0]]
+        self.assertTrue(dataset_ids[0] not in pool)
+        DataRetrieverService.retrieve_oob(dataset_ids[0]) # Hit the chache
         # Verify that it was hit and it's now in there
-        self.assertTrue(dataset_ids[0] in DataRetrieverService._retrieve_cache)
-
-        gevent.sleep(DataRetrieverService._refresh_interval + 0.2)
+        self.assertTrue(dataset_ids[0] in pool)
+        hits = pool.hits
+        DataRetrieverService.retrieve_oob(dataset_ids[0])
+        self.assertEquals(pool.hits, hits + 1)
 
-        DataRetrieverService._get_coverage(dataset_ids[0]) # Hit the chache
-        cov, age2 = DataRetrieverService._retrieve_cache[dataset_ids[0]]
-        self.assertTrue(age2 != age)
+        # Modifications refresh the coverage
+        DataRetrieverService._eject_cache(dataset_ids[0])
+        self.assertTrue(dataset_ids[0] not in pool)
 
         for dataset_id in dataset_ids:
-            DataRetrieverService._get_coverage(dataset_id)
+            DataRetrieverService.retrieve_oob(dataset_id)
         
-        self.assertTrue(dataset_ids[0] not in DataRetrieverService._retrieve_cache)
+        # Least recently used are evicted
+        self.assertTrue(dataset_ids[0] not in pool)
+        self.assertTrue(dataset_ids[-1] in pool)
+        self.assertEquals(pool.stats()['handles'], pool.max_handles)
 
         stream_id, route, stream_def, dataset_id = datasets[0]
         self.start_ingestion(stream_id, dataset_id)
-        DataRetrieverService._get_coverage(dataset_id)
+        DataRetrieverService.retrieve_oob(dataset_id)
         
-        self.assertTrue(dataset_id in DataRetrieverService._retrieve_cache)
+        self.assertTrue(dataset_id in pool)
 
 
         
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/coverage_pool.py
+@description Pool of read-only coverage handles shared by retrieval
+'''
+
+from pyon.container.cc import Container
+from pyon.ion.event import EventSubscriber
+from pyon.public import CFG, OT
+from pyon.util.log import log
+
+from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
+
+from contextlib import contextmanager
+from gevent.coros import RLock
+
+import collections
+import os
+
+
+class CoverageHandle(object):
+    '''
+    A pooled coverage and the number of readers currently using it
+    '''
+    def __init__(self, dataset_id, coverage):
+        self.dataset_id = dataset_id
+        self.coverage   = coverage
+        self.refs       = 0
+        self.retired    = False
+
+
+class CoveragePool(object):
+    '''
+    LRU pool of read-only coverage handles keyed by dataset id.
+
+    Handles are evicted least recently used first when the pool holds more
+    than max_handles coverages. Evicted and invalidated coverages are closed
+    as soon as the last reader releases them.
+
+    If max_memory (MB) is set, opening a coverage while the resident memory of
+    the process exceeds it evicts one more handle, so the pool shrinks by a
+    handle per coverage opened until only the most recently used one is left.
+    Closing a coverage doesn't necessarily return its memory to the system, so
+    the pool never evicts until the resident memory drops, which would close
+    every handle on each open.
+
+    Coverages opened in read mode don't see data appended afterwards, so the
+    pool subscribes to DatasetModified events the first time it is used inside
+    a container and invalidates the datasets they name.
+    '''
+    def __init__(self, max_handles=5, max_memory=None, opener=None):
+        self.max_handles   = max_handles
+        self.max_memory    = max_memory
+        self._opener       = opener or self._open_coverage
+        self._handles      = collections.OrderedDict()
+        self._lock         = RLock()
+        self._subscriber   = None
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.invalidations = 0
+
+    @classmethod
+    def _open_coverage(cls, dataset_id):
+        return DatasetManagementService._get_nonview_coverage(dataset_id, mode='r')
+
+    @contextmanager
+    def coverage(self, dataset_id):
+        '''
+        Context manager providing a pooled coverage for the dataset
+        '''
+        handle = self.acquire(dataset_id)
+        try:
+            yield handle.coverage
+        finally:
+            self.release(handle)
+
+    def acquire(self, dataset_id):
+        '''
+        Returns a handle on the dataset's coverage, handles must be released
+        '''
+        self._start_monitor()
+        with self._lock:
+            handle = self._handles.pop(dataset_id, None)
+            opened = handle is None
+            if opened:
+                self.misses += 1
+                handle = CoverageHandle(dataset_id, self._opener(dataset_id))
+            else:
+                self.hits += 1
+            handle.refs += 1
+            if handle.coverage is None:
+                return handle
+            self._handles[dataset_id] = handle
+            self._evict(opened)
+            return handle
+
+    def release(self, handle):
+        with self._lock:
+            handle.refs -= 1
+            if handle.retired and handle.refs <= 0:
+                self._close(handle)
+
+    def invalidate(self, dataset_id):
+        '''
+        Drops the dataset's coverage, the next reader reopens it
+        '''
+        with self._lock:
+            handle = self._handles.pop(dataset_id, None)
+            if handle is not None:
+                self.invalidations += 1
+                self._retire(handle)
+
+    def clear(self):
+        with self._lock:
+            while self._handles:
+                _, handle = self._handles.popitem(last=False)
+                self._retire(handle)
+
+    def stats(self):
+        return {'handles'       : len(self._handles),
+                'hits'          : self.hits,
+                'misses'        : self.misses,
+                'evictions'     : self.evictions,
+                'invalidations' : self.invalidations,
+                'memory'        : self.resident_memory()}
+
+    def __contains__(self, dataset_id):
+        return dataset_id in self._handles
+
+    def _evict(self, opened=False):
+        if opened and self.max_memory and len(self._handles) > 1:
+            memory = self.resident_memory()
+            if memory is not None and memory > self.max_memory:
+                # The pool doesn't grow, the handle just opened replaces one
+                self._evict_lru()
+                if len(self._handles) > 1:
+                    self._evict_lru()
+        while len(self._handles) > self.max_handles:
+            self._evict_lru()
+
+    def _evict_lru(self):
+        _, handle = self._handles.popitem(last=False)
+        self.evictions += 1
+        self._retire(handle)
+
+    def _retire(self, handle):
+        handle.retired = True
+        if handle.refs <= 0:
+            self._close(handle)
+
+    def _close(self, handle):
+        try:
+            handle.coverage.close(timeout=5)
+        except:
+            log.exception('Problems closing the coverage for dataset %s', handle.dataset_id)
+
+    @classmethod
+    def resident_memory(cls):
+        '''
+        Resident memory of the process in MB, None if it can't be determined
+        '''
+        try:
+            with open('/proc/self/statm') as f:
+                pages = int(f.read().split()[1])
+            return pages * os.sysconf('SC_PAGE_SIZE') / (1024. * 1024.)
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+
+    def _on_modified(self, event, *args, **kwargs):
+        self.invalidate(event.origin)
+
+    def _start_monitor(self):
+        '''
+        Subscribes to dataset modifications the first time the pool is used
+        inside a container
+        '''
+        if self._subscriber is not None or Container.instance is None:
+            return
+        with self._lock:
+            # Another reader may have subscribed while this one waited
+            if self._subscriber is not None:
+                return
+            try:
+                self._subscriber = EventSubscriber(event_type=OT.DatasetModified,
+                                                   callback=self._on_modified,
+                                                   auto_delete=True)
+                self._subscriber.start()
+            except Exception:
+                log.exception('Unable to monitor dataset modifications, the coverage pool is disabled')
+                self._subscriber = False
+                self.max_handles = 0
+
+    def stop_monitor(self):
+        with self._lock:
+            if self._subscriber:
+                self._subscriber.stop()
+            self._subscriber = None
+
+
+coverage_pool = CoveragePool(max_handles=CFG.get_safe('service.data_retriever.coverage_pool.max_handles', 5),
+                             max_memory=CFG.get_safe('service.data_retriever.coverage_pool.max_memory', None))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/digest.py
+@description Scanning a window of events once and collecting the events of each daily digest
+'''
+
+from pyon.core.bootstrap import get_obj_registry
+from pyon.core.object import IonObjectSerializer, IonObjectDeserializer
+from pyon.util.log import log
+
+import msgpack
+import tempfile
+
+
+def iter_events(event_repository, start_ts, end_ts, page_size=1000):
+    '''
+    Yields the events created between start_ts and end_ts, oldest first, reading
+    page_size events per request. Each page starts at the time of the last event
+    read, skipping the events of that time already read, so the pages don't get
+    slower the further the scan goes.
+    '''
+    ts, skip = start_ts, 0
+    while True:
+        event_tuples = event_repository.find_events(start_ts=ts, end_ts=end_ts, limit=page_size, skip=skip)
+        for event_tuple in event_tuples:
+            yield event_tuple[2]
+        if len(event_tuples) < page_size:
+            return
+        last_ts = event_tuples[-1][2].ts_created
+        if last_ts == ts:
+            skip += len(event_tuples)
+        else:
+            ts, skip = last_ts, sum(1 for event_tuple in event_tuples if event_tuple[2].ts_created == last_ts)
+
+
+class DigestBuffer(object):
+    '''
+    Events grouped per user. Once more than max_events events are held in memory
+    they are serialized to a temporary file, in directory, and read back per user
+    when the digest is rendered.
+    '''
+    def __init__(self, max_events=10000, directory=None):
+        self.max_events = max_events
+        self.directory  = directory
+        self._events    = {} # user_id -> [event]
+        self._spilled   = {} # user_id -> [(offset, length)]
+        self._count     = 0
+        self._file      = None
+        self.spills     = 0
+
+    def add(self, user_id, event):
+        self._events.setdefault(user_id, []).append(event)
+        self._count += 1
+        if self._count > self.max_events:
+            self._spill()
+
+    def users(self):
+        return set(self._events) | set(self._spilled)
+
+    def events(self, user_id):
+        '''
+        Returns the events of the user in the order they were added
+        '''
+        events = []
+        if user_id in self._spilled:
+            decoder = IonObjectDeserializer(obj_registry=get_obj_registry())
+            for offset, length in self._spilled[user_id]:
+                self._file.seek(offset)
+                events.append(decoder.deserialize(msgpack.unpackb(self._file.read(length))))
+        events.extend(self._events.get(user_id, []))
+        return events
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._events.clear()
+        self._spilled.clear()
+        self._count = 0
+
+    def _spill(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='digest', dir=self.directory)
+        log.debug('Spilling %d digest events to disk', self._count)
+        encoder = IonObjectSerializer()
+        self._file.seek(0, 2)
+        offset = self._file.tell()
+        for user_id, events in self._events.iteritems():
+            positions = self._spilled.setdefault(user_id, [])
+            for event in events:
+                data = msgpack.packb(encoder.serialize(event))
+                self._file.write(data)
+                positions.append((offset, len(data)))
+                offset += len(data)
+        self._events.clear()
+        self._count = 0
+        self.spills += 1
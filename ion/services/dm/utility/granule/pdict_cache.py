@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''
+@package ion.services.dm.utility.granule.pdict_cache
+@file ion/services/dm/utility/granule/pdict_cache.py
+@brief Process-wide cache of stream definitions and loaded parameter dictionaries
+'''
+
+from pyon.container.cc import Container
+from pyon.core.interceptor.encode import encode_ion
+from pyon.ion.event import EventSubscriber
+from pyon.public import CFG, OT, RT
+from pyon.util.log import log
+
+from interface.services.dm.ipubsub_management_service import PubsubManagementServiceClient
+
+from coverage_model import ParameterDictionary
+
+from collections import OrderedDict
+import hashlib
+import msgpack
+
+
+class ParameterDictionaryCache(object):
+    '''
+    Bounded LRU cache of stream definitions and of the ParameterDictionary
+    objects loaded from them.
+
+    Parameter dictionaries are keyed by stream definition id and revision or,
+    for parameter dictionaries that aren't part of a registered stream
+    definition, by a hash of the dump. The cached objects are shared by every
+    record dictionary in the process and must be treated as read-only, copy
+    them (ParameterDictionary.load(pdict.dump())) before making changes.
+
+    Entries for a stream definition are dropped when a ResourceModifiedEvent
+    is received for it.
+    '''
+    def __init__(self, maxsize=100):
+        self.maxsize      = maxsize
+        self._pdicts      = OrderedDict()
+        self._stream_defs = OrderedDict()
+        self._subscriber  = None
+        self.hits         = 0
+        self.misses       = 0
+        self.evictions    = 0
+
+    def read_stream_def(self, stream_definition_id):
+        '''
+        Returns the stream definition object
+        '''
+        self._start_monitor()
+        try:
+            stream_def = self._stream_defs.pop(stream_definition_id)
+        except KeyError:
+            pubsub_cli = PubsubManagementServiceClient()
+            stream_def = pubsub_cli.read_stream_definition(stream_definition_id)
+            if len(self._stream_defs) >= self.maxsize:
+                self._stream_defs.popitem(last=False)
+        self._stream_defs[stream_definition_id] = stream_def
+        return stream_def
+
+    def load_stream_definition(self, stream_def):
+        '''
+        Returns the ParameterDictionary of the stream definition object
+        '''
+        stream_def_id = getattr(stream_def, '_id', None)
+        if stream_def_id:
+            key = (stream_def_id, getattr(stream_def, '_rev', None))
+        else:
+            key = self.dump_hash(stream_def.parameter_dictionary)
+        return self._load(key, stream_def.parameter_dictionary)
+
+    def load(self, pdict_dump):
+        '''
+        Returns the ParameterDictionary for the dump
+        '''
+        return self._load(self.dump_hash(pdict_dump), pdict_dump)
+
+    def _load(self, key, pdict_dump):
+        self._start_monitor()
+        try:
+            pdict = self._pdicts.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            pdict = ParameterDictionary.load(pdict_dump)
+            if len(self._pdicts) >= self.maxsize:
+                self._pdicts.popitem(last=False)
+                self.evictions += 1
+        self._pdicts[key] = pdict
+        return pdict
+
+    @classmethod
+    def dump_hash(cls, pdict_dump):
+        return hashlib.sha1(msgpack.packb(pdict_dump, default=encode_ion)).hexdigest()
+
+    def invalidate(self, stream_definition_id=None):
+        '''
+        Drops the entries for a stream definition, or every entry
+        '''
+        if stream_definition_id is None:
+            self._stream_defs.clear()
+            self._pdicts.clear()
+            return
+        self._stream_defs.pop(stream_definition_id, None)
+        for key in self._pdicts.keys():
+            if isinstance(key, tuple) and key[0] == stream_definition_id:
+                del self._pdicts[key]
+
+    def stats(self):
+        return {'hits'         : self.hits,
+                'misses'       : self.misses,
+                'evictions'    : self.evictions,
+                'pdicts'       : len(self._pdicts),
+                'stream_defs'  : len(self._stream_defs)}
+
+    def _on_modified(self, event, *args, **kwargs):
+        log.debug('Stream definition %s modified, invalidating cached parameter dictionary', event.origin)
+        self.invalidate(event.origin)
+
+    def _start_monitor(self):
+        '''
+        Subscribes to stream definition modifications the first time the cache
+        is used inside a container
+        '''
+        if self._subscriber is not None or Container.instance is None:
+            return
+        if not CFG.get_safe('container.pdict_cache.monitor', True):
+            self._subscriber = False
+            return
+        try:
+            self._subscriber = EventSubscriber(event_type=OT.ResourceModifiedEvent,
+                                               origin_type=RT.StreamDefinition,
+                                               callback=self._on_modified,
+                                               auto_delete=True)
+            self._subscriber.start()
+        except Exception:
+            log.exception('Unable to monitor stream definition modifications')
+            self._subscriber = False
+
+    def stop_monitor(self):
+        if self._subscriber:
+            self._subscriber.stop()
+        self._subscriber = None
+
+
+pdict_cache = ParameterDictionaryCache(CFG.get_safe('container.pdict_cache.size', 100))
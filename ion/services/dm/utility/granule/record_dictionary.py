@@ -14,11 +14,10 @@ from pyon.core.object import IonObjectSerializer
 from pyon.core.interceptor.encode import encode_ion
 from pyon.util.arg_check import validate_equal
 from pyon.util.log import log
-from pyon.util.memoize import memoize_lru
 
 from ion.util.stored_values import StoredValueManager
+from ion.services.dm.utility.granule.pdict_cache import pdict_cache
 
-from interface.services.dm.ipubsub_management_service import PubsubManagementServiceClient
 from interface.objects import Granule, StreamDefinition
 
 from coverage_model import ParameterDictionary, ConstantType, ConstantRangeType, get_value_class, SimpleDomainSet, QuantityType, Span, SparseConstantType
@@ -29,6 +28,80 @@ from coverage_model.parameter_types import ParameterFunctionType
 import numpy as np
 import msgpack
 import time
+import weakref
+
+
+class FieldIndex(object):
+    '''
+    Lookups for the fields of a parameter dictionary (name to context,
+    ordinal and parameter type classification). An index is computed once per
+    parameter dictionary and set of available fields and is shared by every
+    record dictionary built on the same ParameterDictionary instance.
+    '''
+    _cache = weakref.WeakKeyDictionary()
+
+    def __init__(self, pdict, available_fields=None):
+        keys = pdict.keys()
+        self.size = len(keys)
+        if available_fields is not None:
+            available = set(available_fields)
+            self.fields = [k for k in keys if k in available]
+        else:
+            self.fields = keys
+        self.field_set = frozenset(self.fields)
+        # Record dictionaries only filter by available fields when the list is not empty
+        self.available = frozenset(available_fields) if available_fields else None
+
+        self.contexts        = {}
+        self.param_types     = {}
+        self.fill_values     = {}
+        self.value_encodings = {}
+        self.ords            = {}
+        self.names           = {}
+        self.functions       = set()
+        self.sparse          = set()
+        self.constants       = set()
+        self.quantities      = set()
+        self.lookups         = []
+        for name in keys:
+            context = pdict.get_context(name)
+            ptype = context.param_type
+            ordinal = pdict.ord_from_key(name)
+            self.contexts[name] = context
+            self.param_types[name] = ptype
+            self.fill_values[name] = context.fill_value
+            self.value_encodings[name] = getattr(ptype, 'value_encoding', None)
+            self.ords[name] = ordinal
+            self.names[ordinal] = name
+            if isinstance(ptype, ParameterFunctionType):
+                self.functions.add(name)
+            if isinstance(ptype, SparseConstantType):
+                self.sparse.add(name)
+            if isinstance(ptype, (SparseConstantType, ConstantType, ConstantRangeType)):
+                self.constants.add(name)
+            if isinstance(ptype, QuantityType):
+                self.quantities.add(name)
+            if name in self.field_set and hasattr(context, 'lookup_value'):
+                self.lookups.append(name)
+
+    @classmethod
+    def get(cls, pdict, available_fields=None):
+        '''
+        Returns the shared index for the parameter dictionary
+        '''
+        key = tuple(available_fields) if available_fields is not None else None
+        try:
+            indices = cls._cache.get(pdict)
+            if indices is None:
+                indices = cls._cache[pdict] = {}
+        except TypeError: # Not weak referenceable
+            return cls(pdict, available_fields)
+        index = indices.get(key)
+        # Guard against contexts added to the dictionary after it was indexed
+        if index is None or index.size != len(pdict.keys()):
+            index = indices[key] = cls(pdict, available_fields)
+        return index
+
 
 class RecordDictionaryTool(object):
     """
@@ -50,6 +123,7 @@ class RecordDictionaryTool(object):
 
     _rd                 = None
     _pdict              = None
+    _index              = None
     _shp                = None
     _locator            = None
     _stream_def         = None
@@ -66,7 +140,7 @@ class RecordDictionaryTool(object):
         """
         """
         if type(param_dictionary) == dict:
-            self._pdict = ParameterDictionary.load(param_dictionary)
+            self._pdict = pdict_cache.load(param_dictionary)
         
         elif isinstance(param_dictionary,ParameterDictionary):
             self._pdict = param_dictionary
@@ -78,10 +152,9 @@ class RecordDictionaryTool(object):
                 self._definition = stream_definition
 
             stream_def_obj = stream_definition or RecordDictionaryTool.read_stream_def(stream_definition_id)
-            pdict = stream_def_obj.parameter_dictionary
             self._available_fields = stream_def_obj.available_fields or None
             self._stream_config = stream_def_obj.stream_configuration
-            self._pdict = ParameterDictionary.load(pdict)
+            self._pdict = pdict_cache.load_stream_definition(stream_def_obj)
             self._stream_def = stream_definition_id
 
         else:
@@ -93,6 +166,7 @@ class RecordDictionaryTool(object):
         self._shp = None
         self._rd = {}
         self._locator = locator
+        self._index = FieldIndex.get(self._pdict, self._available_fields)
 
         self._setup_params()
 
@@ -115,17 +189,39 @@ class RecordDictionaryTool(object):
         return paramval
 
     def lookup_values(self):
-        return [i for i in self._lookup_values() if not self.context(i).document_key]
+        return [i for i in self._index.lookups if not self._index.contexts[i].document_key]
 
     def _lookup_values(self):
-        lookup_values = []
-        for field in self.fields:
-            if hasattr(self.context(field), 'lookup_value'):
-                lookup_values.append(field)
-        return lookup_values
+        return list(self._index.lookups)
     
     @classmethod
     def spanify(cls,arr):
+        '''
+        Run length encodes the values of a sparse parameter into spans
+        '''
+        arr = np.atleast_1d(arr)
+        if not arr.shape[0]:
+            return []
+        if arr.dtype.kind == 'O':
+            return cls._spanify(arr)
+        # A new span starts wherever a record differs from the previous one
+        changed = arr[1:] != arr[:-1]
+        if changed.ndim > 1:
+            changed = changed.reshape(changed.shape[0], -1).any(axis=1)
+        starts = np.flatnonzero(changed) + 1
+
+        spans = [Span(None,None,0,arr[0])]
+        for i in starts:
+            i = int(i)
+            spans[-1].upper_bound = i
+            spans.append(Span(i,None,-i,arr[i]))
+        return spans
+
+    @classmethod
+    def _spanify(cls,arr):
+        '''
+        Element-wise run length encoding, used for object arrays
+        '''
         spans = []
         lastval = None
         for i,val in enumerate(arr):
@@ -144,33 +240,31 @@ class RecordDictionaryTool(object):
 
 
     def fetch_lookup_values(self):
-        doc_keys = []
+        doc_keys = {}
         for lv in self._lookup_values():
             context = self.context(lv)
             if context.document_key:
                 document_key = context.document_key
                 if '$designator' in context.document_key and 'reference_designator' in self._stream_config:
                     document_key = document_key.replace('$designator',self._stream_config['reference_designator'])
-                doc_keys.append(document_key)
+                doc_keys[lv] = document_key
 
-        lookup_docs = {}
-        if doc_keys:
-            svm = StoredValueManager(Container.instance)
-            doc_list = svm.read_value_mult(doc_keys)
-            lookup_docs = dict(zip(doc_keys, doc_list))
+        if not doc_keys:
+            return
+        # One request for every document the parameter dictionary needs
+        unique_keys = list(set(doc_keys.itervalues()))
+        svm = StoredValueManager(Container.instance)
+        doc_list = svm.read_value_mult(unique_keys)
+        lookup_docs = dict(zip(unique_keys, doc_list))
 
-        for lv in self._lookup_values():
+        for lv, document_key in doc_keys.iteritems():
             context = self.context(lv)
-            if context.document_key:
-                document_key = context.document_key
-                if '$designator' in context.document_key and 'reference_designator' in self._stream_config:
-                    document_key = document_key.replace('$designator',self._stream_config['reference_designator'])
-                doc = lookup_docs[document_key]
-                if doc is None:
-                    log.debug('Reference Document for %s not found', document_key)
-                    continue
-                if context.lookup_value in doc:
-                    self[lv] = [doc[context.lookup_value]] * self._shp[0] if self._shp else doc[context.lookup_value]
+            doc = lookup_docs[document_key]
+            if doc is None:
+                log.debug('Reference Document for %s not found', document_key)
+                continue
+            if context.lookup_value in doc:
+                self[lv] = [doc[context.lookup_value]] * self._shp[0] if self._shp else doc[context.lookup_value]
 
     @classmethod
     def load_from_granule(cls, g):
@@ -188,11 +282,13 @@ class RecordDictionaryTool(object):
         if g.creation_timestamp:
             instance._creation_timestamp = g.creation_timestamp
 
+        names = instance._index.names
+        param_types = instance._index.param_types
+        domain = instance.domain
         for k,v in g.record_dictionary.iteritems():
-            key = instance._pdict.key_from_ord(k)
+            key = names[k]
             if v is not None:
-                ptype = instance._pdict.get_context(key).param_type
-                paramval = cls.get_paramval(ptype, instance.domain, v)
+                paramval = cls.get_paramval(param_types[key], domain, v)
                 instance._rd[key] = paramval
         
         instance.connection_id = g.connection_id
@@ -200,15 +296,112 @@ class RecordDictionaryTool(object):
 
         return instance
 
+    @classmethod
+    def concatenate(cls, rdts):
+        '''
+        Returns a new record dictionary containing the records of each record
+        dictionary in rdts, appended in order. All of the record dictionaries
+        must share the same parameter dictionary. Fields that are not set in
+        some of the record dictionaries are padded with the fill value.
+        '''
+        rdts = [rdt for rdt in rdts if len(rdt)]
+        if not rdts:
+            return None
+        if len(rdts) == 1:
+            return rdts[0]
+
+        first, last = rdts[0], rdts[-1]
+        instance = cls(param_dictionary=first._pdict, locator=first._locator)
+        instance._stream_def       = first._stream_def
+        instance._definition       = first._definition
+        instance._available_fields = first._available_fields
+        instance._stream_config    = first._stream_config
+        instance._index            = first._index
+        instance._shp = (sum([len(rdt) for rdt in rdts]),)
+
+        for name in first._rd.iterkeys():
+            if all([rdt._rd[name] is None for rdt in rdts]):
+                continue
+            ptype = first._index.param_types[name]
+            if isinstance(ptype, ParameterFunctionType):
+                # Parameter functions are evaluated against the merged arrays
+                continue
+            if isinstance(ptype, (ConstantType, ConstantRangeType)):
+                value = [rdt for rdt in rdts if rdt._rd[name] is not None][-1][name]
+                instance._rd[name] = cls.get_paramval(ptype, instance.domain, value[-1])
+                continue
+            chunks = []
+            for rdt in rdts:
+                if rdt._rd[name] is None:
+                    chunks.append(None)
+                else:
+                    chunks.append(np.atleast_1d(rdt[name]))
+            template = [c for c in chunks if c is not None][0]
+            for i, rdt in enumerate(rdts):
+                if chunks[i] is None:
+                    fill = np.zeros((len(rdt),) + template.shape[1:], dtype=template.dtype)
+                    try:
+                        fill.fill(instance.fill_value(name))
+                    except (TypeError, ValueError):
+                        pass
+                    chunks[i] = fill
+            instance._rd[name] = cls.get_paramval(ptype, instance.domain, np.concatenate(chunks))
+
+        instance._creation_timestamp = first._creation_timestamp
+        instance.connection_id = last.connection_id
+        instance.connection_index = last.connection_index
+        return instance
+
+    def split(self, sizes):
+        '''
+        Returns a record dictionary for each consecutive run of sizes records,
+        the reverse of concatenate. Parameter functions are evaluated once and
+        their values are split like the other parameters.
+        '''
+        if not sizes or len(sizes) == 1:
+            return [self]
+        validate_equal(sum(sizes), len(self), 'Sizes do not add up to the number of records')
+        values = {}
+        for name in self._rd.iterkeys():
+            if self._rd[name] is None:
+                continue
+            value = self[name]
+            if value is not None:
+                values[name] = np.atleast_1d(value)
+
+        parts = []
+        offset = 0
+        for size in sizes:
+            instance = self.__class__(param_dictionary=self._pdict, locator=self._locator)
+            instance._stream_def       = self._stream_def
+            instance._definition       = self._definition
+            instance._available_fields = self._available_fields
+            instance._stream_config    = self._stream_config
+            instance._index            = self._index
+            instance._shp = (size,)
+            for name, value in values.iteritems():
+                ptype = self._index.param_types[name]
+                if isinstance(ptype, (ConstantType, ConstantRangeType)):
+                    instance._rd[name] = self.get_paramval(ptype, instance.domain, value[-1])
+                else:
+                    instance._rd[name] = self.get_paramval(ptype, instance.domain, value[offset:offset+size])
+            instance._creation_timestamp = self._creation_timestamp
+            instance.connection_id = self.connection_id
+            instance.connection_index = self.connection_index
+            parts.append(instance)
+            offset += size
+        return parts
+
     def to_granule(self, data_producer_id='',provider_metadata_update={}, connection_id='', connection_index=''):
         granule = Granule()
         granule.record_dictionary = {}
         
+        ords = self._index.ords
         for key,val in self._rd.iteritems():
             if val is not None:
-                granule.record_dictionary[self._pdict.ord_from_key(key)] = self[key]
+                granule.record_dictionary[ords[key]] = self[key]
             else:
-                granule.record_dictionary[self._pdict.ord_from_key(key)] = None
+                granule.record_dictionary[ords[key]] = None
         
         granule.param_dictionary = {} if self._stream_def else self._pdict.dump()
         if self._definition:
@@ -227,14 +420,11 @@ class RecordDictionaryTool(object):
 
 
     def _setup_params(self):
-        for param in self._pdict.keys():
-            self._rd[param] = None
+        self._rd = dict.fromkeys(self._index.ords)
 
     @property
     def fields(self):
-        if self._available_fields is not None:
-            return list(set(self._available_fields).intersection(self._pdict.keys()))
-        return self._pdict.keys()
+        return list(self._index.fields)
 
     @property
     def domain(self):
@@ -246,26 +436,29 @@ class RecordDictionaryTool(object):
         return self._pdict.temporal_parameter_name
 
     def fill_value(self,name):
-        return self._pdict.get_context(name).fill_value
+        return self._index.fill_values[name]
 
     def _replace_hook(self, name,vals):
         if vals is None:
             return None
-        if not isinstance(self._pdict.get_context(name).param_type, QuantityType):
+        if name not in self._index.quantities:
             return vals
+        fill_value = self._index.fill_values[name]
         if isinstance(vals, (list,tuple)):
-            vals = [i if i is not None else self.fill_value(name) for i in vals]
+            vals = [i if i is not None else fill_value for i in vals]
             if all([i is None for i in vals]):
                 return None
             return vals
         if isinstance(vals, np.ndarray):
-            np.place(vals,vals==np.array(None), self.fill_value(name))
+            if vals.dtype.kind == 'O':
+                # Only object arrays can hold None
+                np.place(vals,vals==np.array(None), fill_value)
             try:
-                if (vals == np.array(self.fill_value(name))).all():
+                if (vals == np.array(fill_value)).all():
                     return None
             except AttributeError:
                 pass
-            return np.asanyarray(vals, dtype=self._pdict.get_context(name).param_type.value_encoding)
+            return np.asanyarray(vals, dtype=self._index.value_encodings[name])
         return np.atleast_1d(vals)
 
     def __setitem__(self, name, vals):
@@ -275,15 +468,15 @@ class RecordDictionaryTool(object):
         """
         Set a parameter
         """
-        if name not in self.fields:
+        if name not in self._index.field_set:
             raise KeyError(name)
 
         if vals is None:
             self._rd[name] = None
             return
-        context = self._pdict.get_context(name)
+        ptype = self._index.param_types[name]
 
-        if self._shp is None and isinstance(context.param_type, (SparseConstantType, ConstantType, ConstantRangeType)):
+        if self._shp is None and name in self._index.constants:
             self._shp = (1,)
             self._dirty_shape = True
         
@@ -309,17 +502,17 @@ class RecordDictionaryTool(object):
                 validate_equal(len(vals), self._shp[0], 'Invalid shape on input')
 
         dom = self.domain
-        paramval = self.get_paramval(context.param_type, dom, vals)
+        paramval = self.get_paramval(ptype, dom, vals)
         self._rd[name] = paramval
 
     def param_type(self, name):
-        if name in self.fields:
-            return self._pdict.get_context(name).param_type
+        if name in self._index.field_set:
+            return self._index.param_types[name]
         raise KeyError(name)
 
     def context(self, name):
-        if name in self.fields:
-            return self._pdict.get_context(name)
+        if name in self._index.field_set:
+            return self._index.contexts[name]
         raise KeyError(name)
 
     def _reshape_const(self):
@@ -333,10 +526,11 @@ class RecordDictionaryTool(object):
         """
         if not self._shp:
             return None
-        if self._available_fields and name not in self._available_fields:
+        available = self._index.available
+        if available is not None and name not in available:
             raise KeyError(name)
-        ptype = self._pdict.get_context(name).param_type
-        if isinstance(ptype, ParameterFunctionType):
+        ptype = self._index.param_types[name]
+        if name in self._index.functions:
             if self._rd[name] is not None and getattr(self._rd[name],'memoized_values',None) is not None:
                 return self._rd[name].memoized_values[:]
             try:
@@ -351,8 +545,9 @@ class RecordDictionaryTool(object):
 
     def iteritems(self):
         """ D.iteritems() -> an iterator over the (key, value) items of D """
+        available = self._index.available
         for k,v in self._rd.iteritems():
-            if self._available_fields and k not in self._available_fields:
+            if available is not None and k not in available:
                 continue
             if v is not None:
                 yield k,v
@@ -371,8 +566,9 @@ class RecordDictionaryTool(object):
 
     def __contains__(self, key):
         """ D.__contains__(k) -> True if D has a key k, else False """
-        if self._available_fields:
-            return key in self._rd and key in self._available_fields
+        available = self._index.available
+        if available is not None:
+            return key in self._rd and key in available
         return key in self._rd
 
     def __delitem__(self, y):
@@ -439,10 +635,7 @@ class RecordDictionaryTool(object):
 
     
     @staticmethod
-    @memoize_lru(maxsize=100)
     def read_stream_def(stream_def_id):
-        pubsub_cli = PubsubManagementServiceClient()
-        stream_def_obj = pubsub_cli.read_stream_definition(stream_def_id)
-        return stream_def_obj
+        return pdict_cache.read_stream_def(stream_def_id)
 
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/qc_alerts.py
+@description Finding the failed values of QC parameters and coalescing them into alerts
+'''
+
+from collections import OrderedDict
+import numpy as np
+import time
+
+
+def failure_runs(values):
+    '''
+    Returns the (start, stop) indexes of each contiguous run of failed (0) values
+    '''
+    failed = np.concatenate(([0], (np.asarray(values) == 0).astype(np.int8), [0]))
+    edges = np.diff(failed)
+    return zip(np.where(edges == 1)[0].tolist(), np.where(edges == -1)[0].tolist())
+
+
+class QCAlert(object):
+    '''
+    Failed values of one QC parameter of a dataset, as ranges of
+    [first timestamp, last timestamp, number of values]
+    '''
+    def __init__(self, dataset_id, parameter):
+        self.dataset_id  = dataset_id
+        self.parameter   = parameter
+        self.created     = time.time()
+        self.timestamps  = []
+        self.ranges      = []
+        self.open        = False # the last range reaches the end of the last values added
+
+    def add(self, timestamps, values):
+        runs = failure_runs(values)
+        for start, stop in runs:
+            run = timestamps[start:stop].tolist()
+            self.timestamps.extend(run)
+            if start == 0 and self.open:
+                self.ranges[-1][1] = run[-1]
+                self.ranges[-1][2] += len(run)
+            else:
+                self.ranges.append([run[0], run[-1], len(run)])
+        self.open = bool(runs) and runs[-1][1] == len(values)
+        return bool(runs)
+
+    def age(self):
+        return time.time() - self.created
+
+
+class QCAlertAggregator(object):
+    '''
+    Collects the failed QC values of each dataset parameter for window
+    seconds and hands them to publish as one QCAlert. With no window every
+    call to add with failed values is published right away.
+    '''
+    def __init__(self, publish, window=0):
+        self.publish = publish
+        self.window  = window
+        self._alerts = OrderedDict() # (dataset_id, parameter) -> QCAlert
+
+    def add(self, dataset_id, parameter, timestamps, values):
+        key = (dataset_id, parameter)
+        alert = self._alerts.get(key) or QCAlert(dataset_id, parameter)
+        if not alert.add(timestamps, values) and not alert.ranges:
+            return
+        self._alerts[key] = alert
+        if not self.window:
+            self.flush()
+
+    def flush(self, max_age=None):
+        '''
+        Publishes the alerts, or only the ones collected for at least max_age seconds
+        '''
+        for key, alert in self._alerts.items():
+            if max_age is None or alert.age() >= max_age:
+                del self._alerts[key]
+                self.publish(alert)
+
+    def __len__(self):
+        return len(self._alerts)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/smtp_delivery.py
+@description Pooled SMTP sessions and a queue delivering notification emails in the background
+'''
+
+from pyon.public import CFG
+from pyon.util.log import log
+
+from ion.services.dm.utility.uns_utility_methods import setting_up_smtp_client
+
+from contextlib import contextmanager
+from gevent.coros import RLock
+from gevent.event import Event
+from gevent.queue import Queue, Empty
+
+import gevent
+import time
+
+
+ION_NOTIFICATION_EMAIL_ADDRESS = 'data_alerts@oceanobservatories.org'
+
+
+class SMTPConnectionPool(object):
+    '''
+    Keeps up to size SMTP sessions open between messages. Sessions idle for
+    more than max_idle seconds are closed and reopened on their next use, a
+    session that fails while in use is discarded.
+    '''
+    def __init__(self, factory=None, size=1, max_idle=60):
+        self.factory  = factory or setting_up_smtp_client
+        self.size     = size
+        self.max_idle = max_idle
+        self._idle    = [] # (client, last use)
+        self._lock    = RLock()
+        self.opened   = 0
+
+    @contextmanager
+    def connection(self):
+        client = self.acquire()
+        try:
+            yield client
+        except:
+            self.discard(client)
+            raise
+        else:
+            self.release(client)
+
+    def acquire(self):
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                client, last_use = self._idle.pop()
+                if now - last_use <= self.max_idle:
+                    return client
+                self._quit(client)
+        self.opened += 1
+        return self.factory()
+
+    def release(self, client):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((client, time.time()))
+                return
+        self._quit(client)
+
+    def discard(self, client):
+        self._quit(client)
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                client, _ = self._idle.pop()
+                self._quit(client)
+
+    def _quit(self, client):
+        try:
+            client.quit()
+        except:
+            log.debug('Problems closing the SMTP session', exc_info=True)
+
+
+class EmailDeliveryQueue(object):
+    '''
+    Bounded queue of rendered notification emails delivered by a background
+    greenlet, so matching events to users doesn't wait on the SMTP server.
+
+    A message is sent once per group of up to max_recipients recipients.
+    Failed sends are retried up to retries times, waiting backoff seconds
+    and doubling the wait after every attempt.
+    '''
+    def __init__(self, process, pool=None, sender=None, maxsize=1000, max_recipients=50, retries=3, backoff=1.0):
+        self.process        = process
+        self.pool           = pool or SMTPConnectionPool()
+        self.sender         = sender or CFG.get_safe('server.smtp.sender', ION_NOTIFICATION_EMAIL_ADDRESS)
+        self.max_recipients = max_recipients
+        self.retries        = retries
+        self.backoff        = backoff
+        self._queue         = Queue(maxsize=maxsize)
+        self._quit          = Event()
+        self._idle          = Event()
+        self._idle.set()
+        self._thread        = None
+
+        self.sent           = 0
+        self.failed         = 0
+        self.retried        = 0
+
+    def start(self):
+        self._quit.clear()
+        self._thread = self.process._process.thread_manager.spawn(self._deliver, thread_name='%s-email' % self.process.id)
+
+    def stop(self, timeout=10):
+        '''
+        Delivers the queued messages, for up to timeout seconds, and closes the SMTP sessions
+        '''
+        self.flush(timeout)
+        self._quit.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        self.pool.close()
+
+    def put(self, msg, recipients):
+        '''
+        Queues the email message for the recipients, blocks while the queue is full
+        '''
+        if recipients:
+            self._idle.clear()
+            self._queue.put((msg, list(recipients)))
+
+    def flush(self, timeout=None):
+        '''
+        Waits until every queued message has been handled
+        '''
+        return self._idle.wait(timeout)
+
+    def stats(self):
+        return {'queued'  : self._queue.qsize(),
+                'sent'    : self.sent,
+                'failed'  : self.failed,
+                'retried' : self.retried,
+                'opened'  : self.pool.opened}
+
+    def _deliver(self):
+        while not self._quit.is_set():
+            try:
+                msg, recipients = self._queue.get(timeout=1)
+            except Empty:
+                self._idle.set()
+                continue
+            try:
+                for i in xrange(0, len(recipients), self.max_recipients):
+                    self.send(msg, recipients[i:i+self.max_recipients])
+            except:
+                log.exception('Failed to deliver email')
+            finally:
+                if self._queue.empty():
+                    self._idle.set()
+
+    def send(self, msg, recipients):
+        '''
+        Sends the message to the recipients in one SMTP transaction, with retries
+        '''
+        del msg['From']
+        del msg['To']
+        msg['From'] = self.sender
+        msg['To'] = recipients[0] if len(recipients) == 1 else 'undisclosed-recipients:;'
+        text = msg.as_string()
+        wait = self.backoff
+        for attempt in xrange(self.retries + 1):
+            try:
+                with self.pool.connection() as client:
+                    client.sendmail(self.sender, recipients, text)
+                self.sent += len(recipients)
+                return True
+            except:
+                if attempt == self.retries:
+                    log.exception('Giving up sending email to %s', recipients)
+                    self.failed += len(recipients)
+                    return False
+                log.warning('Failed to send email to %s, retrying in %ss', recipients, wait, exc_info=True)
+                self.retried += 1
+                gevent.sleep(wait)
+                wait *= 2
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/tail_buffer.py
+@description In-memory buffers of the most recently ingested rows of datasets
+'''
+
+from pyon.container.cc import Container
+from pyon.ion.event import EventSubscriber
+from pyon.public import CFG, OT
+from pyon.util.log import log
+
+from gevent.coros import RLock
+
+import collections
+import numpy as np
+import time
+import uuid
+
+
+class TailBuffer(object):
+    '''
+    Ring buffer of the most recent rows of a dataset.
+
+    Rows are addressed by their index in the coverage. The generation
+    identifies the coverage the indices refer to and changes whenever the
+    buffer can no longer vouch for them (the coverage shrank or was replaced).
+    known_end is the end of the dataset as last announced, rows between end
+    and known_end were appended where the buffer wasn't fed.
+    '''
+    def __init__(self, parameter_dictionary, index, capacity=1000):
+        self.parameter_dictionary = parameter_dictionary
+        self.capacity   = capacity
+        self.generation = uuid.uuid4().hex
+        self.start      = index # Index of the first buffered row
+        self.end        = index # Index after the last buffered row
+        self.known_end  = index
+        self._chunks    = collections.deque() # (start index, { name : values })
+        self.polled     = time.time()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, index, columns):
+        '''
+        Appends the rows starting at index, rows that don't directly follow the
+        buffered ones restart the buffer at index
+        '''
+        if not columns:
+            return
+        size = len(columns.itervalues().next())
+        if not size:
+            return
+        if index != self.end:
+            self._chunks.clear()
+            self.start = index
+        self._chunks.append((index, columns))
+        self.end = index + size
+        self.known_end = max(self.known_end, self.end)
+        # Drop whole chunks beyond the capacity, the newest chunk is always kept
+        while len(self._chunks) > 1 and (self.end - self._chunks[1][0]) >= self.capacity:
+            self._chunks.popleft()
+        self.start = self._chunks[0][0]
+
+    def covers(self, index):
+        return self.start <= index <= self.end
+
+    def current(self):
+        return self.known_end <= self.end
+
+    def rows_since(self, index):
+        '''
+        Returns the buffered values of every parameter from index onward
+        '''
+        index = max(index, self.start)
+        selected = []
+        for start, columns in self._chunks:
+            size = len(columns.itervalues().next())
+            if start + size <= index:
+                continue
+            offset = max(index - start, 0)
+            selected.append(dict((k, v[offset:]) for k,v in columns.iteritems()))
+        if not selected:
+            return {}
+        fields = set(selected[0].keys())
+        for columns in selected[1:]:
+            fields.intersection_update(columns.keys())
+        return dict((k, np.concatenate([c[k] for c in selected])) for k in fields)
+
+
+class TailBuffers(object):
+    '''
+    Tail buffers of the datasets being polled, shared by the container.
+
+    Ingestion feeds the rows it appends to the buffers of the datasets polled
+    in its container, which are then served without reading the coverage.
+    DatasetModified events, from ingestion in any container, announce how far
+    each dataset extends: a buffer that wasn't fed the announced rows isn't
+    current and the next poll reads them from the coverage. Without a
+    subscription to those events (outside a container) no buffer is current.
+
+    The least recently polled datasets are dropped beyond max_datasets, and
+    datasets that haven't been polled for max_idle seconds are dropped.
+    '''
+    def __init__(self, max_datasets=20, capacity=1000, max_idle=600):
+        self.max_datasets = max_datasets
+        self.capacity     = capacity
+        self.max_idle     = max_idle
+        self._buffers     = collections.OrderedDict() # least recently polled first
+        self._lock        = RLock()
+        self._subscriber  = None
+        self.hits         = 0
+        self.misses       = 0
+        self.expirations  = 0
+
+    def get(self, dataset_id):
+        with self._lock:
+            self._expire()
+            buf = self._buffers.pop(dataset_id, None)
+            if buf is not None:
+                buf.polled = time.time()
+                self._buffers[dataset_id] = buf
+            return buf
+
+    def create(self, dataset_id, parameter_dictionary, index):
+        self._start_monitor()
+        with self._lock:
+            self._expire()
+            buf = TailBuffer(parameter_dictionary, index, self.capacity)
+            self._buffers.pop(dataset_id, None)
+            self._buffers[dataset_id] = buf
+            while len(self._buffers) > self.max_datasets:
+                self._buffers.popitem(last=False)
+            return buf
+
+    def __contains__(self, dataset_id):
+        return dataset_id in self._buffers
+
+    def current(self, buf):
+        '''
+        True when the buffer holds every row announced for its dataset
+        '''
+        return bool(self._subscriber) and buf.current()
+
+    def feed(self, dataset_id, index, columns):
+        '''
+        Appends the rows ingestion appended to the dataset at index, when the
+        dataset is being polled
+        '''
+        buf = self._buffers.get(dataset_id)
+        if buf is not None:
+            buf.append(index, columns)
+
+    def drop(self, dataset_id):
+        with self._lock:
+            self._buffers.pop(dataset_id, None)
+
+    def _expire(self):
+        if not self.max_idle:
+            return
+        oldest = time.time() - self.max_idle
+        while self._buffers and self._buffers.itervalues().next().polled < oldest:
+            self._buffers.popitem(last=False)
+            self.expirations += 1
+
+    def _on_modified(self, event, *args, **kwargs):
+        buf = self._buffers.get(event.origin)
+        if buf is None:
+            return
+        window = getattr(event, 'window', None)
+        extents = getattr(event, 'extents', None)
+        if not window or extents is None or extents < buf.end:
+            # Not an append, the buffered rows can't be trusted
+            self.drop(event.origin)
+        else:
+            buf.known_end = max(buf.known_end, window[1])
+
+    def _start_monitor(self):
+        '''
+        Subscribes to dataset modifications the first time a dataset is polled
+        inside a container
+        '''
+        if self._subscriber is not None or Container.instance is None:
+            return
+        try:
+            self._subscriber = EventSubscriber(event_type=OT.DatasetModified,
+                                               callback=self._on_modified,
+                                               auto_delete=True)
+            self._subscriber.start()
+        except Exception:
+            log.exception('Unable to monitor dataset modifications, tail buffers are read from the coverages')
+            self._subscriber = False
+
+    def stop_monitor(self):
+        if self._subscriber:
+            self._subscriber.stop()
+        self._subscriber = None
+
+    def stats(self):
+        return {'datasets'    : len(self._buffers),
+                'hits'        : self.hits,
+                'misses'      : self.misses,
+                'expirations' : self.expirations}
+
+
+tail_buffers = TailBuffers(max_datasets=CFG.get_safe('service.data_retriever.tail.max_datasets', 20),
+                           capacity=CFG.get_safe('service.data_retriever.tail.capacity', 1000),
+                           max_idle=CFG.get_safe('service.data_retriever.tail.max_idle', 600))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_coverage_pool.py
+@brief Unit tests for the coverage handle pool
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.services.dm.utility.coverage_pool import CoveragePool
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+
+@attr('UNIT', group='dm')
+class CoveragePoolUnitTest(PyonTestCase):
+    def setUp(self):
+        self.opened = {}
+        def opener(dataset_id):
+            coverage = Mock()
+            self.opened.setdefault(dataset_id, []).append(coverage)
+            return coverage
+        self.pool = CoveragePool(max_handles=2, opener=opener)
+
+    def test_lru(self):
+        with self.pool.coverage('ds1') as cov1:
+            pass
+        with self.pool.coverage('ds1') as coverage:
+            self.assertTrue(coverage is cov1)
+        self.assertEquals((self.pool.hits, self.pool.misses), (1, 1))
+
+        with self.pool.coverage('ds2'):
+            pass
+        with self.pool.coverage('ds1'):
+            pass
+        # ds2 is the least recently used
+        with self.pool.coverage('ds3'):
+            pass
+        self.assertTrue('ds2' not in self.pool)
+        self.assertTrue('ds1' in self.pool)
+        self.assertEquals(self.pool.evictions, 1)
+        self.opened['ds2'][0].close.assert_called_once_with(timeout=5)
+        self.assertFalse(cov1.close.called)
+
+    def test_close_on_release(self):
+        with self.pool.coverage('ds1') as cov1:
+            # Invalidated while in use
+            self.pool.invalidate('ds1')
+            self.assertFalse(cov1.close.called)
+            with self.pool.coverage('ds1') as coverage:
+                self.assertFalse(coverage is cov1)
+        cov1.close.assert_called_once_with(timeout=5)
+        self.assertEquals(self.pool.invalidations, 1)
+
+    @patch.object(CoveragePool, 'resident_memory')
+    def test_memory(self, memory_mock):
+        self.pool.max_handles = 5
+        self.pool.max_memory = 100
+        memory_mock.return_value = 50
+        for dataset_id in ('ds1', 'ds2', 'ds3'):
+            with self.pool.coverage(dataset_id):
+                pass
+        self.assertEquals(self.pool.stats()['handles'], 3)
+
+        # Over the limit hits don't evict, each coverage opened shrinks the pool by one
+        memory_mock.return_value = 150
+        with self.pool.coverage('ds1'):
+            pass
+        self.assertEquals(self.pool.evictions, 0)
+        with self.pool.coverage('ds4'):
+            pass
+        self.assertEquals(self.pool.evictions, 2)
+        self.assertEquals([d for d in ('ds1', 'ds2', 'ds3', 'ds4') if d in self.pool], ['ds1', 'ds4'])
+        with self.pool.coverage('ds5'):
+            pass
+        # The most recently used coverage is kept
+        with self.pool.coverage('ds6'):
+            pass
+        self.assertEquals([d for d in ('ds1', 'ds4', 'ds5', 'ds6') if d in self.pool], ['ds6'])
+
+    @patch('ion.services.dm.utility.coverage_pool.EventSubscriber')
+    @patch('ion.services.dm.utility.coverage_pool.Container')
+    def test_monitor(self, container_mock, subscriber_mock):
+        with self.pool.coverage('ds1') as cov1:
+            pass
+        with self.pool.coverage('ds2'):
+            pass
+        self.assertEquals(subscriber_mock.call_count, 1)
+        callback = subscriber_mock.call_args[1]['callback']
+
+        callback(Mock(origin='ds1'))
+        self.assertTrue('ds1' not in self.pool)
+        self.assertTrue('ds2' in self.pool)
+        cov1.close.assert_called_once_with(timeout=5)
+        self.assertEquals(self.pool.invalidations, 1)
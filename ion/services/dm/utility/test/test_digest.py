@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_digest.py
+@brief Tests for scanning the events of a digest window and buffering them per user
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.public import OT, IonObject
+
+from ion.services.dm.utility.digest import iter_events, DigestBuffer
+from nose.plugins.attrib import attr
+from mock import Mock
+
+
+class FakeEventRepository(object):
+    '''
+    Sorted list of events answering find_events the way the event repository does
+    '''
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda e : e.ts_created)
+        self.find_events = Mock(side_effect=self._find_events)
+
+    def _find_events(self, start_ts, end_ts, limit, skip):
+        events = [e for e in self.events if start_ts <= e.ts_created <= end_ts]
+        return [(e._id, None, e) for e in events[skip:skip+limit]]
+
+
+def event(i, ts):
+    e = IonObject(OT.ResourceLifecycleEvent, origin='instrument_%d' % i, ts_created=ts)
+    e._id = 'event_%d' % i
+    return e
+
+
+@attr('UNIT', group='dm')
+class DigestTest(PyonTestCase):
+    def test_iter_events(self):
+        # Several events share a time, across page boundaries
+        events = [event(i, str(1000 + i / 3)) for i in xrange(20)]
+        repository = FakeEventRepository(events)
+
+        found = list(iter_events(repository, '1000', '1010', page_size=4))
+        self.assertEquals([e._id for e in found], [e._id for e in repository.events])
+        self.assertEquals(repository.find_events.call_count, 6)
+
+        # Every page after the first starts at the last time read
+        kwargs = repository.find_events.call_args_list[1][1]
+        self.assertEquals((kwargs['start_ts'], kwargs['skip']), ('1001', 1))
+
+        found = list(iter_events(repository, '1002', '1003', page_size=100))
+        self.assertEquals([e._id for e in found], ['event_%d' % i for i in xrange(6, 12)])
+
+    def test_spill(self):
+        buf = DigestBuffer(max_events=3)
+        self.addCleanup(buf.close)
+        for i in xrange(8):
+            buf.add('user_%d' % (i % 2), event(i, str(1000 + i)))
+
+        self.assertEquals(buf.spills, 2)
+        self.assertEquals(buf.users(), set(['user_0', 'user_1']))
+
+        events = buf.events('user_0')
+        self.assertEquals([e.origin for e in events], ['instrument_0', 'instrument_2', 'instrument_4', 'instrument_6'])
+        self.assertEquals(events[0].type_, OT.ResourceLifecycleEvent)
+        self.assertEquals(events[0].ts_created, '1000')
+        self.assertEquals(buf.events('user_2'), [])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_granule_benchmarks.py
+@brief Micro-benchmarks for the record dictionary encode/decode paths
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+
+from ion.services.dm.utility.granule import RecordDictionaryTool
+
+from coverage_model import ParameterDictionary, ParameterContext, QuantityType, SparseConstantType, AxisTypeEnum
+from nose.plugins.attrib import attr
+
+import numpy as np
+import time
+
+
+def timeit(fn, repeat=10):
+    '''
+    Returns the best wall clock time in seconds of repeat calls to fn
+    '''
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def wide_pdict(width):
+    '''
+    Returns a parameter dictionary with a time axis and width float32 fields
+    '''
+    pdict = ParameterDictionary()
+    t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('float64')))
+    t_ctxt.axis = AxisTypeEnum.TIME
+    t_ctxt.uom = 'seconds since 1900-01-01'
+    pdict.add_context(t_ctxt, is_temporal=True)
+    for i in xrange(width):
+        ctxt = ParameterContext('field_%04d' % i, param_type=QuantityType(value_encoding=np.dtype('float32')))
+        ctxt.fill_value = -9999.
+        pdict.add_context(ctxt)
+    return pdict
+
+
+@attr('UTIL', group='dm')
+class RecordDictionaryBenchmark(PyonTestCase):
+    records = 100
+
+    def fill_rdt(self, pdict):
+        rdt = RecordDictionaryTool(param_dictionary=pdict)
+        rdt['time'] = np.arange(self.records, dtype='float64')
+        for field in rdt.fields:
+            if field == 'time':
+                continue
+            rdt[field] = np.random.random(self.records).astype('float32')
+        return rdt
+
+    def test_rdt_width(self):
+        for width in (10, 100, 1000):
+            pdict = wide_pdict(width)
+            rdt = self.fill_rdt(pdict)
+            granule = rdt.to_granule()
+
+            t_create = timeit(lambda : RecordDictionaryTool(param_dictionary=pdict))
+            t_fill   = timeit(lambda : self.fill_rdt(pdict))
+            t_encode = timeit(lambda : rdt.to_granule())
+            t_decode = timeit(lambda : RecordDictionaryTool.load_from_granule(granule))
+
+            log.info('RDT %4d fields x %d records: create %.6fs fill %.6fs to_granule %.6fs load_from_granule %.6fs',
+                     width, self.records, t_create, t_fill, t_encode, t_decode)
+
+            rdt2 = RecordDictionaryTool.load_from_granule(granule)
+            self.assertEquals(len(rdt2.fields), width + 1)
+            np.testing.assert_array_equal(rdt2['field_0000'], rdt['field_0000'])
+
+    def test_sparse_decode(self):
+        pdict = ParameterDictionary()
+        t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('float64')))
+        t_ctxt.axis = AxisTypeEnum.TIME
+        pdict.add_context(t_ctxt, is_temporal=True)
+        for name in ('lat', 'lon'):
+            ctxt = ParameterContext(name, param_type=SparseConstantType(value_encoding=np.dtype('float64')))
+            ctxt.fill_value = -9999.
+            pdict.add_context(ctxt)
+
+        for records in (1000, 10000, 100000):
+            rdt = RecordDictionaryTool(param_dictionary=pdict)
+            rdt['time'] = np.arange(records, dtype='float64')
+            # Position changes every 100 records
+            rdt['lat'] = np.repeat(np.arange(records / 100, dtype='float64'), 100)
+            rdt['lon'] = np.repeat(np.arange(records / 100, dtype='float64'), 100)
+            granule = rdt.to_granule()
+            values = np.atleast_1d(granule.record_dictionary[pdict.ord_from_key('lat')])
+
+            t_loop   = timeit(lambda : RecordDictionaryTool._spanify(values), repeat=3)
+            t_vector = timeit(lambda : RecordDictionaryTool.spanify(values), repeat=3)
+            t_decode = timeit(lambda : RecordDictionaryTool.load_from_granule(granule), repeat=3)
+
+            log.info('Sparse %6d records: spanify loop %.6fs vectorized %.6fs load_from_granule %.6fs',
+                     records, t_loop, t_vector, t_decode)
+            self.assertEquals(len(RecordDictionaryTool.spanify(values)), records / 100)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_pdict_cache.py
+@brief Tests for the parameter dictionary cache
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.services.dm.utility.granule.pdict_cache import ParameterDictionaryCache
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+
+@attr('UNIT', group='dm')
+class ParameterDictionaryCacheTest(PyonTestCase):
+    def setUp(self):
+        self.cache = ParameterDictionaryCache(maxsize=2)
+        self.cache._subscriber = False # No container
+
+    def stream_def(self, stream_def_id, rev, dump):
+        stream_def = Mock()
+        stream_def._id = stream_def_id
+        stream_def._rev = rev
+        stream_def.parameter_dictionary = dump
+        return stream_def
+
+    @patch('ion.services.dm.utility.granule.pdict_cache.ParameterDictionary')
+    def test_cache(self, pdict_cls):
+        pdict_cls.load.side_effect = lambda dump : Mock(dump=dump)
+
+        sd1 = self.stream_def('sd1', '1', {'a':1})
+        pdict = self.cache.load_stream_definition(sd1)
+        self.assertTrue(self.cache.load_stream_definition(sd1) is pdict)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+        # A new revision is a different parameter dictionary
+        sd1_2 = self.stream_def('sd1', '2', {'a':2})
+        self.assertFalse(self.cache.load_stream_definition(sd1_2) is pdict)
+
+        # Dumps are keyed by content
+        pdict = self.cache.load({'b':1})
+        self.assertTrue(self.cache.load({'b':1}) is pdict)
+        self.assertEquals(self.cache.evictions, 1)
+        self.assertEquals(self.cache.stats()['pdicts'], 2)
+
+        self.cache.invalidate('sd1')
+        self.assertEquals(self.cache.stats()['pdicts'], 1)
+        self.cache.invalidate()
+        self.assertEquals(self.cache.stats()['pdicts'], 0)
+
+    @patch('ion.services.dm.utility.granule.pdict_cache.PubsubManagementServiceClient')
+    def test_stream_definition_events(self, pubsub_cls):
+        pubsub_cls.return_value.read_stream_definition.side_effect = lambda sd_id : self.stream_def(sd_id, '1', {})
+        sd = self.cache.read_stream_def('sd1')
+        self.assertTrue(self.cache.read_stream_def('sd1') is sd)
+        self.assertEquals(pubsub_cls.return_value.read_stream_definition.call_count, 1)
+
+        self.cache._on_modified(Mock(origin='sd1'))
+        self.assertFalse(self.cache.read_stream_def('sd1') is sd)
+        self.assertEquals(pubsub_cls.return_value.read_stream_definition.call_count, 2)
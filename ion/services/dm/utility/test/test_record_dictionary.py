@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_record_dictionary.py
+@brief Unit tests for the record dictionary
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.services.dm.utility.granule import RecordDictionaryTool
+from coverage_model import ParameterDictionary, ParameterContext, QuantityType, ParameterFunctionType, NumexprFunction, AxisTypeEnum
+from nose.plugins.attrib import attr
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class RecordDictionaryUnitTest(PyonTestCase):
+    def assert_spans_equal(self, spans1, spans2):
+        self.assertEquals(len(spans1), len(spans2))
+        for s1, s2 in zip(spans1, spans2):
+            self.assertEquals(s1.lower_bound, s2.lower_bound)
+            self.assertEquals(s1.upper_bound, s2.upper_bound)
+            self.assertEquals(s1.offset, s2.offset)
+            np.testing.assert_array_equal(s1.value, s2.value)
+
+    def test_spanify(self):
+        arrays = [
+            np.array([1.]),
+            np.array([1., 1., 2., 2., 2., 3., 1.]),
+            np.array([np.nan, np.nan, 1.]),
+            np.array(['a', 'a', 'b']),
+            np.array([[1, 2], [1, 2], [1, 3], [1, 3], [1, 2]]),
+            np.repeat(np.arange(100), 10),
+        ]
+        for arr in arrays:
+            self.assert_spans_equal(RecordDictionaryTool.spanify(arr), RecordDictionaryTool._spanify(arr))
+
+        spans = RecordDictionaryTool.spanify(np.array([1., 1., 2.]))
+        self.assertEquals(len(spans), 2)
+        self.assertEquals((spans[0].lower_bound, spans[0].upper_bound, spans[0].value), (None, 2, 1.))
+        self.assertEquals((spans[1].lower_bound, spans[1].upper_bound, spans[1].offset, spans[1].value), (2, None, -2, 2.))
+
+        self.assertEquals(RecordDictionaryTool.spanify(np.array([])), [])
+
+    def test_split(self):
+        pdict = ParameterDictionary()
+        t_ctxt = ParameterContext('time', param_type=QuantityType(value_encoding=np.dtype('float64')))
+        t_ctxt.axis = AxisTypeEnum.TIME
+        pdict.add_context(t_ctxt, is_temporal=True)
+        pdict.add_context(ParameterContext('temp', param_type=QuantityType(value_encoding=np.dtype('float32'))))
+        func = NumexprFunction('temp_L1', 'temp * 2', ['temp'], param_map={'temp':'temp'})
+        pdict.add_context(ParameterContext('temp_L1', param_type=ParameterFunctionType(func, value_encoding='float32')))
+
+        rdts = []
+        for start, stop in ((0, 3), (3, 4), (4, 10)):
+            rdt = RecordDictionaryTool(param_dictionary=pdict)
+            rdt['time'] = np.arange(start, stop, dtype='float64')
+            rdt['temp'] = np.arange(start, stop, dtype='float32')
+            rdts.append(rdt)
+
+        merged = RecordDictionaryTool.concatenate(rdts)
+        self.assertEquals(len(merged), 10)
+        np.testing.assert_array_equal(merged['temp_L1'], np.arange(10, dtype='float32') * 2)
+
+        parts = merged.split([len(rdt) for rdt in rdts])
+        self.assertEquals(len(parts), 3)
+        for rdt, part in zip(rdts, parts):
+            np.testing.assert_array_equal(part['time'], rdt['time'])
+            np.testing.assert_array_equal(part['temp'], rdt['temp'])
+            np.testing.assert_array_equal(part['temp_L1'], rdt['temp'] * 2)
+        self.assertTrue(merged.split([10])[0] is merged)
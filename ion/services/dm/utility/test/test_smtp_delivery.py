@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_smtp_delivery.py
+@brief Tests for the pooled SMTP delivery of notification emails, against a local fake SMTP server
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.services.dm.utility.smtp_delivery import SMTPConnectionPool, EmailDeliveryQueue
+from email.mime.text import MIMEText
+from gevent.server import StreamServer
+from nose.plugins.attrib import attr
+from mock import Mock
+
+import gevent
+import smtplib
+
+
+class FakeSMTPServer(object):
+    '''
+    Minimal SMTP server recording the messages it accepts, the first fail
+    messages are rejected with a temporary error
+    '''
+    def __init__(self, fail=0):
+        self.fail        = fail
+        self.messages    = [] # (sender, recipients, data)
+        self.connections = 0
+        self.server      = StreamServer(('127.0.0.1', 0), self.handle)
+
+    def start(self):
+        self.server.start()
+        self.port = self.server.server_port
+
+    def stop(self):
+        self.server.stop()
+
+    def handle(self, sock, address):
+        self.connections += 1
+        f = sock.makefile()
+        def reply(line):
+            f.write(line + '\r\n')
+            f.flush()
+        reply('220 localhost fake SMTP')
+        sender, recipients = None, []
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command in ('HELO', 'EHLO'):
+                reply('250 localhost')
+            elif command == 'MAIL':
+                sender, recipients = line.split(':', 1)[1].strip().strip('<>'), []
+                reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.split(':', 1)[1].strip().strip('<>'))
+                reply('250 OK')
+            elif command == 'DATA':
+                reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = f.readline()
+                    if line in ('.\r\n', '.\n', ''):
+                        break
+                    data.append(line)
+                if self.fail:
+                    self.fail -= 1
+                    reply('451 Try again later')
+                else:
+                    self.messages.append((sender, recipients, ''.join(data)))
+                    reply('250 OK')
+            elif command in ('RSET', 'NOOP'):
+                reply('250 OK')
+            elif command == 'QUIT':
+                reply('221 Bye')
+                break
+            else:
+                reply('502 Not implemented')
+        sock.close()
+
+
+@attr('UNIT', group='dm')
+class EmailDeliveryTest(PyonTestCase):
+    def setUp(self):
+        self.server = FakeSMTPServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        process = Mock()
+        process.id = 'notification_worker'
+        process._process.thread_manager.spawn.side_effect = lambda fn, thread_name=None : gevent.spawn(fn)
+        pool = SMTPConnectionPool(factory=lambda : smtplib.SMTP('127.0.0.1', self.server.port))
+        self.delivery = EmailDeliveryQueue(process, pool, sender='alerts@localhost', max_recipients=2, backoff=0.01)
+        self.delivery.start()
+        self.addCleanup(self.delivery.stop)
+
+    def test_delivery(self):
+        self.delivery.put(MIMEText('event 1'), ['a@localhost', 'b@localhost', 'c@localhost'])
+        self.delivery.put(MIMEText('event 2'), ['d@localhost'])
+        self.assertTrue(self.delivery.flush(timeout=10))
+
+        # Recipients are batched per transaction over a single session
+        self.assertEquals([m[1] for m in self.server.messages], [['a@localhost', 'b@localhost'], ['c@localhost'], ['d@localhost']])
+        self.assertEquals(self.server.connections, 1)
+        self.assertIn('To: d@localhost', self.server.messages[2][2])
+        self.assertEquals(self.delivery.stats()['sent'], 4)
+
+    def test_retry(self):
+        self.server.fail = 2
+        self.delivery.put(MIMEText('event'), ['a@localhost'])
+        self.assertTrue(self.delivery.flush(timeout=10))
+
+        self.assertEquals(len(self.server.messages), 1)
+        self.assertEquals(self.delivery.stats()['retried'], 2)
+        self.assertEquals(self.delivery.stats()['failed'], 0)
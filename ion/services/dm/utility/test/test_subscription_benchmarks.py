@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_subscription_benchmarks.py
+@brief Benchmark of matching events to subscribed users, with the subscription index and the reverse user info
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+from pyon.public import OT
+
+from ion.services.dm.utility.uns_utility_methods import SubscriptionIndex, calculate_reverse_user_info, check_user_notification_interest
+from ion.services.dm.utility.test.test_subscription_index import notification, event, user
+from nose.plugins.attrib import attr
+
+import random
+import time
+
+
+@attr('UTIL', group='dm')
+class SubscriptionIndexBenchmark(PyonTestCase):
+    users         = 10000
+    subscriptions = 100000
+    origins       = 5000
+    events        = 10000
+
+    def setUp(self):
+        random.seed(0)
+        event_types = [OT.ResourceLifecycleEvent, OT.ResourceModifiedEvent, OT.DeviceStatusEvent, OT.DetectionEvent]
+        self.user_info = dict(('user_%05d' % i, user()) for i in xrange(self.users))
+        user_ids = sorted(self.user_info)
+        for i in xrange(self.subscriptions):
+            n = notification('notification_%06d' % i,
+                             event_type=random.choice(event_types + ['']),
+                             origin='instrument_%04d' % random.randrange(self.origins),
+                             origin_type='InstrumentDevice')
+            self.user_info[random.choice(user_ids)]['notifications'].append(n)
+        self.stream = [event(random.choice(event_types), 'instrument_%04d' % random.randrange(self.origins), 'InstrumentDevice')
+                       for i in xrange(self.events)]
+
+    def test_match(self):
+        start = time.time()
+        index = SubscriptionIndex(self.user_info)
+        build = time.time() - start
+
+        start = time.time()
+        matched = sum(len(index.match(e)) for e in self.stream)
+        match = time.time() - start
+
+        start = time.time()
+        reverse_user_info = calculate_reverse_user_info(self.user_info)
+        reverse_build = time.time() - start
+
+        start = time.time()
+        for e in self.stream[:self.events / 10]:
+            check_user_notification_interest(e, reverse_user_info)
+        reverse_match = (time.time() - start) * 10
+
+        log.info('%d users, %d subscriptions, %d events (%d deliveries)', self.users, self.subscriptions, self.events, matched)
+        log.info('Subscription index: build %.3fs, match %.1fus/event', build, match / self.events * 1e6)
+        log.info('Reverse user info:  build %.3fs, match %.1fus/event (estimated from a tenth of the events)',
+                 reverse_build, reverse_match / self.events * 1e6)
+
+        start = time.time()
+        for i in xrange(1000):
+            user_id = 'user_%05d' % i
+            index.update_user(user_id, self.user_info[user_id])
+        log.info('Subscription index: %.1fus per user update', (time.time() - start) / 1000 * 1e6)
+        self.assertEquals(len(index), self.subscriptions)
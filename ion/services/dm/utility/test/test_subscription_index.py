@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_subscription_index.py
+@brief Tests for matching events to the users subscribed to them
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.public import OT, IonObject
+
+from ion.services.dm.utility.uns_utility_methods import SubscriptionIndex, calculate_reverse_user_info, check_user_notification_interest
+from interface.objects import NotificationRequest
+from nose.plugins.attrib import attr
+
+
+def notification(notification_id, event_type='', origin='', origin_type='', event_subtype=''):
+    n = NotificationRequest(name=notification_id, event_type=event_type, origin=origin, origin_type=origin_type, event_subtype=event_subtype)
+    n._id = notification_id
+    return n
+
+def event(event_type, origin='', origin_type='', sub_type=''):
+    return IonObject(event_type, origin=origin, origin_type=origin_type, sub_type=sub_type)
+
+def user(*notifications, **preferences):
+    value = {'user_contact' : None, 'notifications' : list(notifications),
+             'notifications_daily_digest' : False, 'notifications_disabled' : False}
+    value.update(preferences)
+    return value
+
+
+@attr('UNIT', group='dm')
+class SubscriptionIndexTest(PyonTestCase):
+    def setUp(self):
+        self.user_info = {
+            'user_1'   : user(notification('n1', OT.ResourceLifecycleEvent, 'instrument_1', 'type_1', 'subtype_1'),
+                              notification('n2', OT.DetectionEvent, 'instrument_2')),
+            'user_2'   : user(notification('n3', origin='instrument_1')),
+            'digest'   : user(notification('n4', origin='instrument_1'), notifications_daily_digest=True),
+            'disabled' : user(notification('n5', origin='instrument_1'), notifications_disabled=True),
+        }
+        self.index = SubscriptionIndex(self.user_info)
+
+    def test_match(self):
+        self.assertEquals(self.index.match(event(OT.ResourceLifecycleEvent, 'instrument_1', 'type_1', 'subtype_1')), set(['user_1', 'user_2']))
+        self.assertEquals(self.index.match(event(OT.ResourceLifecycleEvent, 'instrument_1', 'type_1', 'subtype_2')), set(['user_2']))
+        # An event without a sub type isn't filtered on it
+        self.assertEquals(self.index.match(event(OT.ResourceLifecycleEvent, 'instrument_1', 'type_1')), set(['user_1', 'user_2']))
+        self.assertEquals(self.index.match(event(OT.DetectionEvent, 'instrument_2', 'type_2')), set(['user_1']))
+        # Subscriptions match on their own, not combined with the user's other subscriptions
+        self.assertEquals(self.index.match(event(OT.DetectionEvent, 'instrument_1', 'type_1', 'subtype_1')), set(['user_2']))
+        self.assertEquals(self.index.match(event(OT.DetectionEvent, 'instrument_3')), set())
+
+        digest = SubscriptionIndex(self.user_info, digest=True)
+        self.assertEquals(digest.match(event(OT.DetectionEvent, 'instrument_1')), set(['digest']))
+
+    def test_updates(self):
+        self.assertEquals(len(self.index), 3)
+
+        self.index.add('user_2', notification('n6', OT.DetectionEvent, 'instrument_2'))
+        self.assertEquals(self.index.match(event(OT.DetectionEvent, 'instrument_2')), set(['user_1', 'user_2']))
+
+        self.index.remove('user_1', 'n2')
+        self.assertEquals(self.index.match(event(OT.DetectionEvent, 'instrument_2')), set(['user_2']))
+
+        self.index.remove('user_2', 'n6')
+        self.assertEquals(self.index.match(event(OT.DetectionEvent, 'instrument_2')), set())
+        self.assertNotIn(OT.DetectionEvent, self.index._root)
+
+        expired = notification('n1', OT.ResourceLifecycleEvent, 'instrument_1', 'type_1', 'subtype_1')
+        expired.temporal_bounds.end_datetime = '1'
+        self.index.update_user('user_1', user(expired))
+        self.assertNotIn('user_1', self.index)
+        self.assertEquals(self.index.match(event(OT.ResourceLifecycleEvent, 'instrument_1', 'type_1', 'subtype_1')), set(['user_2']))
+
+    def test_reverse_user_info(self):
+        reverse_user_info = calculate_reverse_user_info(self.user_info)
+        self.assertEquals(set(reverse_user_info['event_origin']['instrument_1']), set(['user_1', 'user_2']))
+        self.assertNotIn('digest', reverse_user_info['event_origin']['instrument_1'])
+
+        reverse_user_info['event_type'][''] = ['user_2']
+        check_user_notification_interest(event(OT.ResourceLifecycleEvent, 'instrument_1', 'type_1', 'subtype_1'), reverse_user_info)
+        # Matching leaves the reverse user info as it was
+        self.assertEquals(reverse_user_info['event_type'][OT.ResourceLifecycleEvent], ['user_1'])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+'''
+@file ion/services/dm/utility/test/test_tail_buffer.py
+@brief Unit tests for the dataset tail buffers
+'''
+
+from pyon.util.containers import DotDict
+from pyon.util.unit_test import PyonTestCase
+from ion.services.dm.utility.tail_buffer import TailBuffer, TailBuffers
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class TailBufferUnitTest(PyonTestCase):
+    def rows(self, start, stop):
+        return {'time':np.arange(start, stop), 'temp':np.arange(start, stop) * 2}
+
+    def test_tail_buffer(self):
+        buf = TailBuffer(None, 0, capacity=10)
+        buf.append(0, self.rows(0, 4))
+        buf.append(4, self.rows(4, 8))
+        self.assertEquals((buf.start, buf.end), (0, 8))
+
+        rows = buf.rows_since(2)
+        np.testing.assert_array_equal(rows['time'], np.arange(2, 8))
+        np.testing.assert_array_equal(rows['temp'], np.arange(2, 8) * 2)
+        self.assertEquals(buf.rows_since(8), {})
+
+        # The oldest chunks are dropped beyond the capacity
+        buf.append(8, self.rows(8, 14))
+        self.assertEquals((buf.start, buf.end), (4, 14))
+        self.assertFalse(buf.covers(2))
+        self.assertTrue(buf.covers(4))
+        np.testing.assert_array_equal(buf.rows_since(0)['time'], np.arange(4, 14))
+
+        # Rows that don't follow the buffered rows restart the buffer
+        generation = buf.generation
+        buf.append(20, self.rows(20, 22))
+        self.assertEquals((buf.start, buf.end), (20, 22))
+        self.assertEquals(buf.generation, generation)
+
+    def test_tail_buffers(self):
+        buffers = TailBuffers(max_datasets=2, capacity=10)
+        buffers.create('ds1', None, 0)
+        buffers.create('ds2', None, 0)
+        buffers.get('ds1')
+        buffers.create('ds3', None, 0)
+        self.assertIn('ds1', buffers)
+        self.assertNotIn('ds2', buffers)
+        self.assertEquals(buffers.stats()['datasets'], 2)
+
+    def test_feed(self):
+        buffers = TailBuffers(capacity=10)
+        buffers.feed('ds1', 0, self.rows(0, 4))
+        self.assertNotIn('ds1', buffers)
+
+        buf = buffers.create('ds1', None, 0)
+        buffers.feed('ds1', 0, self.rows(0, 4))
+        self.assertEquals(buf.end, 4)
+        # Only current while subscribed to the announcements
+        self.assertFalse(buffers.current(buf))
+        buffers._subscriber = Mock()
+        self.assertTrue(buffers.current(buf))
+
+        # Rows announced without being fed
+        buffers._on_modified(DotDict(origin='ds1', extents=6, window=(4, 6)))
+        self.assertFalse(buffers.current(buf))
+        buffers.feed('ds1', 4, self.rows(4, 6))
+        self.assertTrue(buffers.current(buf))
+
+        # Anything but an append drops the buffer
+        buffers._on_modified(DotDict(origin='ds1', extents=2, window=(0, 2)))
+        self.assertNotIn('ds1', buffers)
+
+    @patch('ion.services.dm.utility.tail_buffer.time')
+    def test_expiration(self, time_mock):
+        time_mock.time.return_value = 0
+        buffers = TailBuffers(max_datasets=5, capacity=10, max_idle=60)
+        buffers.create('ds1', None, 0)
+        buffers.create('ds2', None, 0)
+        time_mock.time.return_value = 50
+        buffers.get('ds1')
+        time_mock.time.return_value = 100
+        # ds2 wasn't polled for more than a minute
+        self.assertIsNotNone(buffers.get('ds1'))
+        self.assertNotIn('ds2', buffers)
+        self.assertEquals(buffers.stats()['expirations'], 1)
@@ -3,7 +3,7 @@
 @file ion/services/dm/utility/uns_utility_methods.py
 @description A module containing common utility methods used by UNS and the notification workers.
 """
-from pyon.public import get_sys_name, OT, IonObject, CFG
+from pyon.public import get_sys_name, OT, RT, PRED, IonObject, CFG
 from pyon.util.ion_time import IonTime
 from pyon.util.log import log
 from pyon.core.exception import BadRequest, NotFound
@@ -32,7 +32,8 @@ class fake_smtplib(object):
     def sendmail(self, msg_sender= None, msg_recipients=None, msg=None):
         log.warning('Sending fake message from: %s, to: "%s"', msg_sender,  msg_recipients)
         log.info("Fake message sent: %s", msg)
-        self.sent_mail.put((msg_sender, msg_recipients[0], msg))
+        for msg_recipient in msg_recipients:
+            self.sent_mail.put((msg_sender, msg_recipient, msg))
         log.debug("size of the sent_mail queue::: %s", self.sent_mail.qsize())
 
     def quit(self):
@@ -226,10 +227,10 @@ def check_user_notification_interest(event, reverse_user_info):
 
     if event.type_: # for an incoming event with origin type specified
         if reverse_user_info['event_type'].has_key(event.type_):
-            user_list_1 = reverse_user_info['event_type'][event.type_]
+            user_list_1 = set(reverse_user_info['event_type'][event.type_])
             if reverse_user_info['event_type'].has_key(''): # for users who subscribe to any event types
-                user_list_1.extend(reverse_user_info['event_type'][''])
-            users = set(user_list_1)
+                user_list_1.update(reverse_user_info['event_type'][''])
+            users = user_list_1
 #            log.debug("For event_type = %s, UNS got interested users here  %s", event.type_, users)
         else:
 #            log.debug("After checking event_type = %s, UNS got no interested users here", event.type_)
@@ -239,7 +240,7 @@ def check_user_notification_interest(event, reverse_user_info):
         if reverse_user_info['event_origin'].has_key(event.origin):
             user_list_2 = set(reverse_user_info['event_origin'][event.origin])
             if reverse_user_info['event_origin'].has_key(''): # for users who subscribe to any event origins
-                user_list_2.extend(reverse_user_info['event_origin'][''])
+                user_list_2.update(reverse_user_info['event_origin'][''])
             users = set.intersection(users, user_list_2)
 #            log.debug("For event origin = %s too, UNS got interested users here  %s", event.origin, users)
         else:
@@ -248,9 +249,9 @@ def check_user_notification_interest(event, reverse_user_info):
 
     if event.sub_type:  # for an incoming event with the sub type specified
         if reverse_user_info['event_subtype'].has_key(event.sub_type):
-            user_list_3 = reverse_user_info['event_subtype'][event.sub_type]
+            user_list_3 = set(reverse_user_info['event_subtype'][event.sub_type])
             if reverse_user_info['event_subtype'].has_key(''): # for users who subscribe to any event subtypes
-                user_list_3.extend(reverse_user_info['event_subtype'][''])
+                user_list_3.update(reverse_user_info['event_subtype'][''])
             users = set.intersection(users, user_list_3)
 #        else:
 #            log.debug("After checking event_subtype = %s, UNS got no interested users here", event.sub_type)
@@ -258,9 +259,9 @@ def check_user_notification_interest(event, reverse_user_info):
 
     if event.origin_type:  # for an incoming event with origin type specified
         if reverse_user_info['event_origin_type'].has_key(event.origin_type):
-            user_list_4 = reverse_user_info['event_origin_type'][event.origin_type]
+            user_list_4 = set(reverse_user_info['event_origin_type'][event.origin_type])
             if reverse_user_info['event_origin_type'].has_key(''): # for users who subscribe to any event origin types
-                user_list_4.extend(reverse_user_info['event_origin_type'][''])
+                user_list_4.update(reverse_user_info['event_origin_type'][''])
             users = set.intersection(users, user_list_4)
         else:
 #            log.debug("After checking event_origin_type = %s, UNS got no interested users here", event.origin_type)
@@ -296,70 +297,191 @@ def calculate_reverse_user_info(user_info=None):
 
     reverse_user_info = {}
 
-    dict_1 = {}
-    dict_2 = {}
-    dict_3 = {}
-    dict_4 = {}
+    # Users are collected in sets and turned into lists once at the end
+    attributes = [('event_type', 'event_type'),
+                  ('event_subtype', 'event_subtype'),
+                  ('event_origin', 'origin'),
+                  ('event_origin_type', 'origin_type')]
+    user_sets = dict((key, {}) for key, _ in attributes)
+    found = False
 
     for user_id, value in user_info.iteritems():
 
-        notifications = value['notifications']
-
-        notifications_disabled = value.get('notifications_disabled', False)
-        notifications_daily_digest = value.get('notifications_daily_digest', False)
-
         # Ignore users who do NOT want REALTIME notifications or who have disabled the delivery switch
         # However, if notification preferences have not been set at all for the user, do not bother
+        for notification in active_notifications(value):
+            found = True
+            for key, attribute in attributes:
+                attribute_value = getattr(notification, attribute)
+                if attribute_value != '':
+                    user_sets[key].setdefault(attribute_value, set()).add(user_id)
+
+    if found:
+        for key, users in user_sets.iteritems():
+            reverse_user_info[key] = dict((k, list(v)) for k, v in users.iteritems())
+
+    return reverse_user_info
+
+def active_notifications(value, digest=False):
+    """
+    Returns the active NotificationRequests of a user_info entry, those of users who disabled
+    notifications or who get the other kind of delivery (real time or daily digest) are left out
 
-        if notifications_disabled or not not notifications_daily_digest:
+    @param value    dict, a user_info entry
+    @param digest   bool, True for the daily digest subscriptions
+    @retval notifications list
+    """
+    if value.get('notifications_disabled', False) or bool(value.get('notifications_daily_digest', False)) != digest:
+        return []
+
+    notifications = []
+    for notification in value.get('notifications') or []:
+        # If the notification has expired, do not keep it
+        if not isinstance(notification, NotificationRequest) or notification.temporal_bounds.end_datetime:
             continue
+        notifications.append(notification)
+    return notifications
 
-        if notifications:
-
-            for notification in notifications:
-
-                # If the notification has expired, do not keep it in the reverse user info that the notification
-                # workers use
-                if notification.temporal_bounds.end_datetime:
-                    continue
-
-                if not isinstance(notification, NotificationRequest):
-                    continue
-
-                if dict_1.has_key(notification.event_type) and notification.event_type != '':
-                    dict_1[notification.event_type].append(user_id)
-                    # to remove duplicate user names
-                    dict_1[notification.event_type] = list(set(dict_1[notification.event_type]))
-                elif notification.event_type != '':
-                    dict_1[notification.event_type] = [user_id]
-
-                if dict_2.has_key(notification.event_subtype) and notification.event_subtype != '':
-                    dict_2[notification.event_subtype].append(user_id)
-                    # to remove duplicate user names
-                    dict_2[notification.event_subtype] = list(set(dict_2[notification.event_subtype]))
-                elif notification.event_subtype != '':
-                    dict_2[notification.event_subtype] = [user_id]
-
-                if dict_3.has_key(notification.origin) and notification.origin != '':
-                    dict_3[notification.origin].append(user_id)
-                    # to remove duplicate user names
-                    dict_3[notification.origin] = list(set(dict_3[notification.origin]))
-                elif notification.origin != '':
-                    dict_3[notification.origin] = [user_id]
-
-                if dict_4.has_key(notification.origin_type) and notification.origin_type != '':
-                    dict_4[notification.origin_type].append(user_id)
-                    # to remove duplicate user names
-                    dict_4[notification.origin_type] = list(set(dict_4[notification.origin_type]))
-                elif notification.origin_type != '':
-                    dict_4[notification.origin_type] = [user_id]
-
-                reverse_user_info['event_type'] = dict_1
-                reverse_user_info['event_subtype'] = dict_2
-                reverse_user_info['event_origin'] = dict_3
-                reverse_user_info['event_origin_type'] = dict_4
 
-    return reverse_user_info
+class SubscriptionIndex(object):
+    """
+    Index of the active subscriptions of the users, matching an event to the interested users
+    without going through every subscription.
+
+    Every NotificationRequest is a key of (event_type, origin, origin_type, event_subtype), an
+    empty attribute subscribes to any value. The keys are stored in a tree with one level per
+    attribute and the users in frozensets at the leaves, matching an event visits the branches
+    for the event's value and for the wildcard at each level. An attribute the event leaves empty
+    doesn't filter the subscriptions, as in check_user_notification_interest.
+
+    Matching never yields to other greenlets, so the index can be updated in place by event
+    callbacks while other callbacks match events against it.
+    """
+    ATTRIBUTES = ('event_type', 'origin', 'origin_type', 'event_subtype')
+
+    def __init__(self, user_info=None, digest=False):
+        self.digest = digest
+        self.load(user_info or {})
+
+    @classmethod
+    def key(cls, notification):
+        return tuple(getattr(notification, attribute) or '' for attribute in cls.ATTRIBUTES)
+
+    def load(self, user_info):
+        """
+        Replaces the whole index with the subscriptions in user_info
+        """
+        self._root = {}
+        self._keys = {} # user_id -> {notification_id : key}
+        for user_id, value in user_info.iteritems():
+            self.update_user(user_id, value)
+
+    def update_user(self, user_id, value):
+        """
+        Replaces the subscriptions of a user with the ones in its user_info entry
+        """
+        self.remove_user(user_id)
+        for notification in active_notifications(value, self.digest):
+            self.add(user_id, notification)
+
+    def remove_user(self, user_id):
+        for notification_id in self._keys.get(user_id, {}).keys():
+            self.remove(user_id, notification_id)
+
+    def add(self, user_id, notification):
+        notification_id = notification._id
+        key = self.key(notification)
+        subscriptions = self._keys.setdefault(user_id, {})
+        if subscriptions.get(notification_id) == key:
+            return
+        if notification_id in subscriptions:
+            self.remove(user_id, notification_id)
+            subscriptions = self._keys.setdefault(user_id, {})
+        subscriptions[notification_id] = key
+
+        node = self._root
+        for value in key[:-1]:
+            node = node.setdefault(value, {})
+        node[key[-1]] = node.get(key[-1], frozenset()) | frozenset([user_id])
+
+    def remove(self, user_id, notification_id):
+        subscriptions = self._keys.get(user_id, {})
+        key = subscriptions.pop(notification_id, None)
+        if not subscriptions:
+            self._keys.pop(user_id, None)
+        # The user stays at the leaf while another of its subscriptions has the same key
+        if key is None or key in subscriptions.itervalues():
+            return
+
+        path = [self._root]
+        for value in key[:-1]:
+            path.append(path[-1][value])
+        leaf = path[-1][key[-1]] - frozenset([user_id])
+        if leaf:
+            path[-1][key[-1]] = leaf
+            return
+        # Prune the branches left empty
+        del path[-1][key[-1]]
+        for depth in xrange(len(key) - 2, -1, -1):
+            if path[depth + 1]:
+                break
+            del path[depth][key[depth]]
+
+    def match(self, event):
+        """
+        Returns the set of ids of the users interested in the event
+        """
+        values = (event.type_, event.origin, event.origin_type, event.sub_type)
+        users = set()
+        nodes = [self._root]
+        for value in values:
+            children = []
+            for node in nodes:
+                if value:
+                    for child in (node.get(value), node.get('')):
+                        if child is not None:
+                            children.append(child)
+                else:
+                    children.extend(node.itervalues())
+            if not children:
+                return users
+            nodes = children
+        for leaf in nodes:
+            users.update(leaf)
+        return users
+
+    def __len__(self):
+        return sum(len(subscriptions) for subscriptions in self._keys.itervalues())
+
+    def __contains__(self, user_id):
+        return user_id in self._keys
+
+
+def reload_notification(rr_client, user_info, notification_id, indexes=()):
+    """
+    Brings user_info and the subscription indexes up to date with a notification that was created
+    or retired, reading only that notification and its users.
+
+    @param rr_client        resource registry client
+    @param user_info        dict
+    @param notification_id  str
+    @param indexes          SubscriptionIndex objects built from user_info
+    @retval bool False when a user of the notification is not in user_info, which then needs a full reload
+    """
+    notification = rr_client.read(notification_id)
+    user_ids, _ = rr_client.find_subjects(RT.UserInfo, PRED.hasNotification, notification_id, True)
+    if any(user_id not in user_info for user_id in user_ids):
+        return False
+
+    for user_id in user_ids:
+        value = user_info[user_id]
+        notifications = [n for n in value['notifications'] if n._id != notification_id]
+        if not notification.temporal_bounds.end_datetime:
+            notifications.append(notification)
+        value['notifications'] = notifications
+        for index in indexes:
+            index.update_user(user_id, value)
+    return True
 
 def get_event_computed_attributes(event, include_event=False, include_special=False, include_formatted=False):
     """
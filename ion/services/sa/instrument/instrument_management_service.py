@@ -34,7 +34,7 @@ from ion.services.sa.instrument.agent_configuration_builder import InstrumentAge
 from ion.services.dm.inventory.dataset_management_service import DatasetManagementService
 from ion.services.sa.instrument.flag import KeywordFlag
 
-from ion.services.sa.observatory.observatory_util import ObservatoryUtil
+from ion.services.sa.observatory.observatory_util import ObservatoryUtil, status_rollup_tree
 from ion.services.sa.observatory.deployment_util import describe_deployments
 from ion.util.agent_launcher import AgentLauncher
 from ion.util.module_uploader import RegisterModulePreparerEgg
@@ -1575,7 +1575,7 @@ class InstrumentManagementService(BaseInstrumentManagementService):
             raise BadRequest("The instrument_device_id parameter is empty")
 
         RR2 = EnhancedResourceRegistryClient(self.clients.resource_registry)
-        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager())
+        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager(), status_tree=status_rollup_tree)
 
         extended_resource_handler = ExtendedResourceContainer(self)
 
@@ -1741,7 +1741,7 @@ class InstrumentManagementService(BaseInstrumentManagementService):
         t = Timer() if stats.is_log_enabled() else None
 
         RR2 = EnhancedResourceRegistryClient(self.clients.resource_registry)
-        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager())
+        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager(), status_tree=status_rollup_tree)
 
         if not platform_device_id:
             raise BadRequest("The platform_device_id parameter is empty")
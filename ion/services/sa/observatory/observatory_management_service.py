@@ -18,7 +18,8 @@ from ion.services.sa.instrument.rollx_builder import RollXBuilder
 from ion.services.sa.instrument.status_builder import AgentStatusBuilder
 from ion.services.sa.observatory.deployment_activator import DeploymentActivatorFactory, DeploymentResourceCollectorFactory
 from ion.util.enhanced_resource_registry_client import EnhancedResourceRegistryClient
-from ion.services.sa.observatory.observatory_util import ObservatoryUtil
+from ion.util.resource_cache import resource_cache
+from ion.services.sa.observatory.observatory_util import ObservatoryUtil, status_rollup_tree
 from ion.processes.event.device_state import DeviceStateManager
 from ion.util.geo_utils import GeoUtils
 from ion.util.related_resources_crawler import RelatedResourcesCrawler
@@ -670,6 +671,7 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
             self.assign_device_to_site(device_id, site_id)
             log.info("Adding geo and updating temporal attrs for device '%s'", device_id)
             self._update_device_add_geo_add_temporal(device_id, site_id, depl_obj)
+        status_rollup_tree.invalidate()
 
         if depl_obj.lcstate != LCS.DEPLOYED:
             self.RR.execute_lifecycle_transition(deployment_id, LCE.DEPLOY)
@@ -724,6 +726,8 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
                     log.info("Removing geo and updating temporal attrs for device '%s'", d)
                     self._update_device_remove_geo_update_temporal(d, deployment_obj)
                     self.RR.execute_lifecycle_transition(d, LCE.INTEGRATE)
+        resource_cache.invalidate_associations(PRED.hasDevice)
+        status_rollup_tree.invalidate()
 
         # This should set the deployment resource to retired.
         # Michael needs to fix the RR retire logic so it does not
@@ -865,7 +869,7 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
         else:
             raise BadRequest("Illegal parent_resource_id type. Expected Org/Site, given:%s" % parent_resource.type_)
 
-        RR2 = EnhancedResourceRegistryClient(self.RR)
+        RR2 = EnhancedResourceRegistryClient(self.RR, shared_cache=resource_cache)
         RR2.cache_resources(RT.Observatory)
         RR2.cache_resources(RT.PlatformSite)
         RR2.cache_resources(RT.InstrumentSite)
@@ -897,13 +901,13 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
 
         result_dict = {}
 
-        RR2 = EnhancedResourceRegistryClient(self.RR)
+        RR2 = EnhancedResourceRegistryClient(self.RR, shared_cache=resource_cache)
         RR2.cache_resources(RT.Observatory)
         RR2.cache_resources(RT.PlatformSite)
         RR2.cache_resources(RT.InstrumentSite)
         RR2.cache_resources(RT.PlatformDevice)
         RR2.cache_resources(RT.InstrumentDevice)
-        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager())
+        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager(), status_tree=status_rollup_tree)
         parent_resource_objs = RR2.read_mult(parent_resource_ids)
         res_by_id = dict(zip(parent_resource_ids, parent_resource_objs))
 
@@ -1056,8 +1060,8 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
                 ext_exclude=ext_exclude,
                 user_id=user_id)
 
-            RR2 = EnhancedResourceRegistryClient(self.clients.resource_registry)
-            outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager())
+            RR2 = EnhancedResourceRegistryClient(self.clients.resource_registry, shared_cache=resource_cache)
+            outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager(), status_tree=status_rollup_tree)
 
             # Find all subsites and devices
             site_resources, site_children = outil.get_child_sites(parent_site_id=site_id, include_parents=False, id_only=False)
@@ -1065,7 +1069,7 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
             device_relations = outil.get_device_relations(site_ids)
 
             # Set parent immediate child sites
-            parent_site_ids = [a.s for a in RR2.filter_cached_associations(PRED.hasSite, lambda a: a.p ==PRED.hasSite and a.o == site_id)]
+            parent_site_ids = [a.s for a in RR2.filter_cached_associations(PRED.hasSite, lambda a: a.p ==PRED.hasSite, object_id=site_id)]
             if parent_site_ids:
                 extended_site.parent_site = RR2.read(parent_site_ids[0])
             else:
@@ -1293,7 +1297,7 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
             #raise Inconsistent('deployment %s should be associated with a device and a site' % deployment_id)
 
         log.debug('have device: %r\nand site: %r', extended_deployment.device.__dict__, extended_deployment.site.__dict__)
-        RR2 = EnhancedResourceRegistryClient(self.clients.resource_registry)
+        RR2 = EnhancedResourceRegistryClient(self.clients.resource_registry, shared_cache=resource_cache)
         finder = RelatedResourcesCrawler()
         get_assns = finder.generate_related_resources_partial(RR2, [PRED.hasDevice])
         # search from PlatformDevice to subplatform or InstrumentDevice
@@ -1413,10 +1417,10 @@ class ObservatoryManagementService(BaseObservatoryManagementService):
             user_id=user_id,
             negotiation_status=NegotiationStatusEnum.OPEN)
 
-        RR2 = EnhancedResourceRegistryClient(self.RR)
+        RR2 = EnhancedResourceRegistryClient(self.RR, shared_cache=resource_cache)
         RR2.cache_predicate(PRED.hasModel)
         RR2.cache_predicate(PRED.hasDevice)
-        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager())
+        outil = ObservatoryUtil(self, enhanced_rr=RR2, device_status_mgr=DeviceStateManager(), status_tree=status_rollup_tree)
 
         #Fill out service request information for requesting data products
         extended_org.data_products_request.service_name = 'resource_registry'
@@ -6,18 +6,25 @@ __author__ = 'Michael Meisinger, Maurice Manning'
 
 from pyon.core import bootstrap
 from pyon.core.exception import BadRequest
-from pyon.public import RT, PRED, log
+from pyon.ion.event import EventSubscriber
+from pyon.public import RT, PRED, OT, CFG, log
+
+from ion.processes.event.device_state import DeviceStateManager, STATE_PREFIX
 
 from interface.objects import DeviceStatusType, AggregateStatusType
 
+from gevent.coros import RLock
+import time
+
 
 class ObservatoryUtil(object):
-    def __init__(self, process=None, container=None, enhanced_rr=None, device_status_mgr=None):
+    def __init__(self, process=None, container=None, enhanced_rr=None, device_status_mgr=None, status_tree=None):
         self.process = process
         self.container = container or bootstrap.container_instance
         self.RR2 = enhanced_rr
         self.RR = enhanced_rr or self.container.resource_registry if self.container else None
         self.device_status_mgr = device_status_mgr
+        self.status_tree = status_tree
 
 
     # -------------------------------------------------------------------------
@@ -326,11 +333,17 @@ class ObservatoryUtil(object):
         For given parent device/site/org res_id compute the status roll ups.
         The result is a dict of id with value dict of status values.
         Includes all parents of given site as well.
+        With a status_tree the roll ups are read from it, unless include_structure is set.
         """
         if not res_type:
             res_obj = self.container.resource_registry.read(res_id)
             res_type = res_obj._get_type()
 
+        if self.status_tree is not None and not include_structure:
+            status_rollup = self.status_tree.get_status_roll_ups(res_id, res_type)
+            if status_rollup is not None:
+                return status_rollup
+
         def get_site_status(site_id, status_rollup, site_ancestors, site_devices, status_by_device):
             """For one site, compute the aggregate status and recurse to child sites if necessary"""
             if site_id in status_rollup:
@@ -486,3 +499,267 @@ class ObservatoryUtil(object):
         # 0 results are OK, 0 or more are unknown
         return DeviceStatusType.STATUS_UNKNOWN
 
+
+class StatusRollupTree(object):
+    """
+    Materialized status roll ups of all orgs, sites and devices, shared by the
+    ObservatoryUtil objects given it as their status_tree.
+
+    The tree is built from the hasResource, hasSite and hasDevice associations
+    and the persisted device states the first time it is read. Device status
+    events are applied to the state of their device and the roll ups are
+    recomputed along the path from the device to the roots only, stopping where
+    a roll up doesn't change. Creating, deleting or reassociating sites, devices
+    or deployments marks the tree stale and it is rebuilt on the next read, as is
+    a tree older than max_age seconds. Activating a deployment only changes
+    hasDevice associations, so deployment lifecycle transitions mark the tree
+    stale as well and the deployment operations call invalidate directly.
+
+    Unlike a computed roll up, the parents of a site always roll up all of their
+    children, not only the ones on the path to the site.
+    """
+    SITE_TYPES = {RT.Org, RT.Observatory, RT.Subsite, RT.PlatformSite, RT.InstrumentSite}
+    DEVICE_TYPES = {RT.PlatformDevice, RT.InstrumentDevice}
+    STRUCTURE_TYPES = SITE_TYPES | DEVICE_TYPES | {RT.Deployment}
+
+    def __init__(self, container=None, device_status_mgr=None, enabled=True, max_age=3600):
+        self.container = container
+        self.device_status_mgr = device_status_mgr
+        self.enabled = enabled
+        self.max_age = max_age
+        self._outil = ObservatoryUtil(container=container, device_status_mgr=device_status_mgr)
+        self._lock = RLock()
+        self._subscribers = None
+        self._built = 0         # time of the last build, 0 when stale
+        self.builds = 0
+        self.updates = 0
+
+        self._orgs = set()
+        self._site_parents = {}     # site id -> [parent site/org ids]
+        self._site_children = {}    # site/org id -> [child site ids]
+        self._site_device = {}      # site id -> primary device id
+        self._device_sites = {}     # device id -> [site ids]
+        self._device_parents = {}   # device id -> [parent device ids]
+        self._device_children = {}  # device id -> [child device ids]
+        self._states = {}           # device id -> device state
+        self._own = {}              # device id -> status of the device itself
+        self._device_rollup = {}    # device id -> status rolled up over the child devices
+        self._site_rollup = {}      # site/org id -> status rolled up over the child sites
+
+    # -------------------------------------------------------------------------
+    # Reading
+
+    def get_status_roll_ups(self, res_id, res_type):
+        """
+        Returns the status roll ups like ObservatoryUtil.get_status_roll_ups, or None
+        when disabled or when res_id isn't part of the tree
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if not self._built or time.time() - self._built > self.max_age:
+                self.build()
+
+            if res_type in self.DEVICE_TYPES:
+                if res_id not in self._device_rollup:
+                    return None
+                device_ids = self._walk(res_id, self._device_children)
+                return dict((d, dict(self._device_rollup[d])) for d in device_ids)
+
+            if res_type in self.SITE_TYPES:
+                if res_id not in self._site_rollup:
+                    return None
+                # Like get_child_sites, the parents of a site stop below its orgs
+                parent_ids = set(s for s in self._walk(res_id, self._site_parents) if s not in self._orgs)
+                site_ids = self._walk(res_id, self._site_children) | parent_ids
+                status_rollup = dict((s, dict(self._site_rollup[s])) for s in site_ids)
+                for site_id in site_ids:
+                    device_id = self._site_device.get(site_id)
+                    if device_id:
+                        status_rollup[device_id] = dict(self._own[device_id])
+                return status_rollup
+
+            raise BadRequest("Unsupported resource type: %s" % res_type)
+
+    def _walk(self, node_id, edges):
+        """Returns node_id and every node reachable from it"""
+        seen = {node_id}
+        stack = [node_id]
+        while stack:
+            for next_id in edges.get(stack.pop(), ()):
+                if next_id not in seen:
+                    seen.add(next_id)
+                    stack.append(next_id)
+        return seen
+
+    # -------------------------------------------------------------------------
+    # Building
+
+    def build(self):
+        """Loads the structure and device states and computes every roll up"""
+        container = self.container or bootstrap.container_instance
+        if self.device_status_mgr is None:
+            self.device_status_mgr = DeviceStateManager(container)
+        self._start_monitor()
+        outil = self._outil = ObservatoryUtil(container=container, device_status_mgr=self.device_status_mgr)
+
+        with self._lock:
+            built = time.time()
+            orgs, site_parents, site_children = set(), {}, {}
+            for assoc in container.resource_registry.find_associations(predicate=PRED.hasResource, id_only=False):
+                if assoc.st == RT.Org and assoc.ot == RT.Observatory:
+                    orgs.add(assoc.s)
+                    site_parents.setdefault(assoc.o, []).append(assoc.s)
+                    site_children.setdefault(assoc.s, []).append(assoc.o)
+            for site_id, (_, parent_id, _) in outil._get_site_parents().iteritems():
+                site_parents.setdefault(site_id, []).append(parent_id)
+                site_children.setdefault(parent_id, []).append(site_id)
+
+            site_device, device_sites = {}, {}
+            for site_id, (_, device_id, _) in outil._get_site_devices().iteritems():
+                site_device[site_id] = device_id
+                device_sites.setdefault(device_id, []).append(site_id)
+
+            device_parents, device_children = {}, {}
+            for device_id, children in outil._get_child_devices().iteritems():
+                for _, child_id, _ in children:
+                    device_parents.setdefault(child_id, []).append(device_id)
+                    device_children.setdefault(device_id, []).append(child_id)
+
+            device_ids = list(set(device_sites) | set(device_parents) | set(device_children))
+            states = dict(zip(device_ids, outil._get_device_status_list(device_ids)))
+
+            self._orgs, self._site_parents, self._site_children = orgs, site_parents, site_children
+            self._site_device, self._device_sites = site_device, device_sites
+            self._device_parents, self._device_children = device_parents, device_children
+            self._states = dict((d, s) for d, s in states.iteritems() if s is not None)
+            self._own = dict((d, outil._compute_status(d, self._states)) for d in device_ids)
+            self._device_rollup, self._site_rollup = {}, {}
+            for device_id in device_ids:
+                self._compute(device_id, self._device_rollup, self._rollup_device)
+            for site_id in set(site_parents) | set(site_children) | set(site_device):
+                self._compute(site_id, self._site_rollup, self._rollup_site)
+            self._built = built
+            self.builds += 1
+            log.debug("Built status roll ups of %d sites and %d devices", len(self._site_rollup), len(device_ids))
+
+    def _compute(self, node_id, rollups, rollup_fn):
+        """Computes the roll ups of node_id and, first, of the nodes it depends on"""
+        children = self._device_children if rollups is self._device_rollup else self._site_children
+        stack = [(node_id, False)]
+        visiting = set()
+        while stack:
+            node_id, ready = stack.pop()
+            if node_id in rollups:
+                continue
+            if ready:
+                rollups[node_id] = rollup_fn(node_id)
+                continue
+            if node_id in visiting:
+                continue    # a cycle, the roll up uses the children computed so far
+            visiting.add(node_id)
+            stack.append((node_id, True))
+            stack.extend((ch_id, False) for ch_id in children.get(node_id, ()) if ch_id not in rollups)
+
+    def _rollup_device(self, device_id):
+        statuses = [self._device_rollup[ch_id] for ch_id in self._device_children.get(device_id, ()) if ch_id in self._device_rollup]
+        statuses.append(self._own[device_id])
+        return self._outil._rollup_statuses(statuses)
+
+    def _rollup_site(self, site_id):
+        statuses = [self._site_rollup[ch_id] for ch_id in self._site_children.get(site_id, ()) if ch_id in self._site_rollup]
+        device_id = self._site_device.get(site_id)
+        if device_id:
+            statuses.append(self._own[device_id])
+        return self._outil._rollup_statuses(statuses)
+
+    # -------------------------------------------------------------------------
+    # Updating
+
+    def update_device(self, device_id):
+        """
+        Recomputes the status of the device and the roll ups on its paths to the roots.
+        Returns the number of roll ups that changed.
+        """
+        with self._lock:
+            if device_id not in self._own:
+                return 0
+            own = self._outil._compute_status(device_id, self._states)
+            if own == self._own[device_id]:
+                return 0
+            self._own[device_id] = own
+            changed = self._propagate([device_id], self._device_rollup, self._device_parents, self._rollup_device)
+            changed += self._propagate(self._device_sites.get(device_id, []), self._site_rollup, self._site_parents, self._rollup_site)
+            self.updates += 1
+            return changed
+
+    def _propagate(self, node_ids, rollups, parents, rollup_fn):
+        changed = 0
+        seen = set()
+        stack = list(node_ids)
+        while stack:
+            node_id = stack.pop()
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+            rollup = rollup_fn(node_id)
+            if rollup == rollups.get(node_id):
+                continue
+            rollups[node_id] = rollup
+            changed += 1
+            stack.extend(parents.get(node_id, ()))
+        return changed
+
+    def _on_device_status(self, event, *args, **kwargs):
+        device_id = event.origin
+        with self._lock:
+            if not self._built or device_id not in self._own:
+                return
+            state = self._states.get(device_id)
+            if state is None:
+                state = self.device_status_mgr.create_device_state(STATE_PREFIX + device_id, device_id)
+                self._states[device_id] = state
+            self.device_status_mgr.update_device_state(state, device_id, event)
+            self.update_device(device_id)
+
+    def _on_resource_modified(self, event, *args, **kwargs):
+        if event.origin_type in self.STRUCTURE_TYPES and event.sub_type != 'UPDATE':
+            log.debug("%s %s modified (%s), status roll ups are stale", event.origin_type, event.origin, event.sub_type)
+            self._built = 0
+
+    def _on_resource_lifecycle(self, event, *args, **kwargs):
+        if event.origin_type == RT.Deployment:
+            log.debug("Deployment %s is %s, status roll ups are stale", event.origin, event.lcstate)
+            self._built = 0
+
+    def invalidate(self):
+        """Marks the tree stale, it is rebuilt on the next read"""
+        with self._lock:
+            self._built = 0
+
+    def _start_monitor(self):
+        """Subscribes to device status, resource modification and lifecycle events the first time the tree is built"""
+        if self._subscribers is not None or bootstrap.container_instance is None:
+            return
+        self._subscribers = []
+        try:
+            for event_type, callback in [(OT.DeviceStatusEvent, self._on_device_status),
+                                         (OT.DeviceAggregateStatusEvent, self._on_device_status),
+                                         (OT.ResourceModifiedEvent, self._on_resource_modified),
+                                         (OT.ResourceLifecycleEvent, self._on_resource_lifecycle)]:
+                subscriber = EventSubscriber(event_type=event_type, callback=callback, auto_delete=True)
+                subscriber.start()
+                self._subscribers.append(subscriber)
+        except Exception:
+            log.exception("Unable to monitor device status, disabling the status roll up tree")
+            self.stop_monitor()
+            self.enabled = False
+
+    def stop_monitor(self):
+        for subscriber in self._subscribers or []:
+            subscriber.stop()
+        self._subscribers = None
+
+
+status_rollup_tree = StatusRollupTree(enabled=CFG.get_safe('container.status_rollups.enabled', False),
+                                      max_age=CFG.get_safe('container.status_rollups.max_age', 3600))
@@ -2,14 +2,16 @@
 
 __author__ = 'Michael Meisinger'
 
+import copy
 import unittest
 from nose.plugins.attrib import attr
 
-from pyon.public import RT, log
+from pyon.public import RT, OT, LCS, IonObject, log
 from pyon.util.unit_test import IonUnitTestCase
 
 from ion.services.sa.observatory.mockutil import MockUtil
-from ion.services.sa.observatory.observatory_util import ObservatoryUtil
+from ion.services.sa.observatory.observatory_util import ObservatoryUtil, StatusRollupTree
+from ion.processes.event.device_state import DeviceStateManager
 
 from interface.objects import DeviceStatusType, DeviceCommsType, AggregateStatusType
 DST = DeviceStatusType
@@ -436,6 +438,66 @@ class TestObservatoryUtil(IonUnitTestCase):
         self._assert_status(status_rollups, 'IS_1')
         self._assert_status(status_rollups, 'ID_1')
 
+    def test_status_rollup_tree(self):
+        self.mu.load_mock_resources(self.res_list)
+        self.mu.load_mock_associations(self.assoc_list + self.assoc_list1 + self.assoc_list2)
+        self.mu.assign_mockres_find_objects(filter_predicate="hasResource")
+        self.mu.load_mock_device_statuses(copy.deepcopy(self.status_by_device_1))
+
+        dsm = DeviceStateManager(self.container_mock)
+        dsm.read_states = self.dsm_mock.read_states
+        tree = StatusRollupTree(self.container_mock, dsm)
+
+        self.obs_util = ObservatoryUtil(self.process_mock, self.container_mock, device_status_mgr=self.dsm_mock)
+        tree_util = ObservatoryUtil(self.process_mock, self.container_mock, device_status_mgr=self.dsm_mock, status_tree=tree)
+        resources = [('ID_1', RT.InstrumentDevice), ('PD_1', RT.PlatformDevice), ('IS_1', RT.InstrumentSite),
+                     ('PS_1', RT.PlatformSite), ('Sub_1', RT.Subsite), ('Obs_1', RT.Observatory), ('Org_1', RT.Org)]
+
+        for res_id, res_type in resources:
+            self.assertEquals(tree_util.get_status_roll_ups(res_id, res_type), self.obs_util.get_status_roll_ups(res_id, res_type))
+        self.assertEquals(tree.builds, 1)
+
+        # ID_1 power critical, applied to the tree and to the states read by the computed roll ups
+        event = IonObject(OT.DeviceAggregateStatusEvent, origin='ID_1',
+                          status_name=AggregateStatusType.AGGREGATE_POWER, status=DST.STATUS_CRITICAL)
+        tree._on_device_status(event)
+        self.assertEquals(tree.updates, 1)
+
+        status_rollups = tree_util.get_status_roll_ups('Obs_1', RT.Observatory)
+        for res_id in ['Obs_1', 'Sub_1', 'PS_1', 'IS_1', 'ID_1']:
+            self._assert_status(status_rollups, res_id, agg=DST.STATUS_CRITICAL, power=DST.STATUS_CRITICAL)
+        self._assert_status(status_rollups, 'PD_1')
+        self._assert_status(tree_util.get_status_roll_ups('PD_1', RT.PlatformDevice), 'PD_1', agg=DST.STATUS_CRITICAL, power=DST.STATUS_CRITICAL)
+
+        for res_id, res_type in resources:
+            self.assertEquals(tree_util.get_status_roll_ups(res_id, res_type), self.obs_util.get_status_roll_ups(res_id, res_type))
+        self.assertEquals(tree.builds, 1)
+
+        # The same status again changes nothing
+        self.assertEquals(tree.update_device('ID_1'), 0)
+
+        # Structure changes rebuild the tree on the next read
+        tree._on_resource_modified(IonObject(OT.ResourceModifiedEvent, origin='PD_1', origin_type=RT.PlatformDevice, sub_type='UPDATE'))
+        tree_util.get_status_roll_ups('PS_1', RT.PlatformSite)
+        self.assertEquals(tree.builds, 1)
+        tree._on_resource_modified(IonObject(OT.ResourceModifiedEvent, origin='D_1', origin_type=RT.Deployment, sub_type='CREATE'))
+        tree_util.get_status_roll_ups('PS_1', RT.PlatformSite)
+        self.assertEquals(tree.builds, 2)
+
+        # Deployment activation only changes associations, its lifecycle transition or an explicit invalidate rebuilds
+        tree._on_resource_lifecycle(IonObject(OT.ResourceLifecycleEvent, origin='D_1', origin_type=RT.Deployment, lcstate=LCS.DEPLOYED))
+        tree_util.get_status_roll_ups('PS_1', RT.PlatformSite)
+        self.assertEquals(tree.builds, 3)
+        tree._on_resource_lifecycle(IonObject(OT.ResourceLifecycleEvent, origin='ID_1', origin_type=RT.InstrumentDevice, lcstate=LCS.DEPLOYED))
+        tree_util.get_status_roll_ups('PS_1', RT.PlatformSite)
+        self.assertEquals(tree.builds, 3)
+        tree.invalidate()
+        tree_util.get_status_roll_ups('PS_1', RT.PlatformSite)
+        self.assertEquals(tree.builds, 4)
+
+        # Resources the tree doesn't know are computed
+        self.assertIsNone(tree.get_status_roll_ups('XXX', RT.InstrumentDevice))
+
     def _assert_status(self, status_rollups, res_id=None, agg=DST.STATUS_OK, loc=DST.STATUS_OK,
                        data=DST.STATUS_OK, comms=DST.STATUS_OK, power=DST.STATUS_OK):
         res_status = status_rollups[res_id] if res_id else status_rollups
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+'''
+@file ion/util/egg_cache.py
+@description Local content-addressed cache of downloaded python eggs
+'''
+
+from pyon.public import CFG
+from ooi.logging import log
+
+from gevent.event import AsyncResult
+from tempfile import gettempdir, mkstemp
+
+import hashlib
+import os
+import requests
+import shutil
+import simplejson as json
+import urlparse
+
+
+class EggCache(object):
+    '''
+    Cache of eggs downloaded by URL.
+
+    Eggs are stored by the sha256 of their contents under
+    <path>/objects/<sha256>/<egg filename>. Files are written to a temporary
+    file and renamed into place so that processes sharing the directory never
+    see partial eggs.
+
+    A digest can be given explicitly or in the URL fragment (#sha256=<hex>),
+    in which case the egg is verified against it and served from the cache
+    without contacting the server. Eggs without a digest are revalidated the
+    first time a process asks for them: the ETag and Last-Modified the server
+    sent for the egg, kept in <path>/urls, make the download conditional, so
+    an unchanged egg isn't transferred again and one uploaded again to the
+    same URL is. forget() has the process revalidate a URL again.
+
+    Concurrent requests for the same URL share a single download. When
+    max_size (MB) is set the least recently used eggs are removed, except the
+    ones handed out by this process.
+    '''
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path=None, max_size=None):
+        self.path       = path or os.path.join(gettempdir(), 'egg_cache')
+        self.max_size   = max_size
+        self._inflight  = {} # url -> AsyncResult of the download
+        self._urls      = {} # url -> digest of the egg validated by this process
+        self._verified  = set()
+        self.hits       = 0
+        self.misses     = 0
+        self.revalidations = 0
+        self.evictions  = 0
+
+    def get(self, url, sha256=None):
+        '''
+        Returns the local path to the egg at url, downloading it if needed
+        '''
+        expected = sha256 or self.url_digest(url)
+        path = self._cached(url, expected or self._urls.get(url))
+        if path:
+            self.hits += 1
+            return path
+
+        result = self._inflight.get(url)
+        if result is not None:
+            return result.get()
+
+        self.misses += 1
+        result = self._inflight[url] = AsyncResult()
+        try:
+            path = self._download(url, expected)
+            result.set(path)
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(url, None)
+        return path
+
+    def forget(self, url):
+        '''
+        Has the next request for url revalidate the egg with the server
+        '''
+        self._urls.pop(url, None)
+
+    def store(self, url, contents):
+        '''
+        Adds the egg contents as the egg served at url, returns its path
+        '''
+        digest = hashlib.sha256(contents).hexdigest()
+        fd, tmp_path = self._mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contents)
+        return self._commit(url, tmp_path, digest)
+
+    @classmethod
+    def url_digest(cls, url):
+        fragment = urlparse.urlparse(url).fragment
+        if fragment.startswith('sha256='):
+            return fragment[len('sha256='):].lower()
+        return None
+
+    @classmethod
+    def file_digest(cls, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda : f.read(cls.CHUNK_SIZE), ''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def stats(self):
+        return {'hits'          : self.hits,
+                'misses'        : self.misses,
+                'revalidations' : self.revalidations,
+                'evictions'     : self.evictions,
+                'size'          : self.size()}
+
+    def size(self):
+        '''
+        Size of the cached eggs in MB
+        '''
+        return sum(size for _, size, _ in self._entries()) / (1024. * 1024.)
+
+    def _filename(self, url):
+        return urlparse.urlparse(url).path.split('/')[-1]
+
+    def _object_path(self, digest, filename):
+        return os.path.join(self.path, 'objects', digest, filename)
+
+    def _url_path(self, url):
+        return os.path.join(self.path, 'urls', hashlib.sha1(url.split('#')[0]).hexdigest())
+
+    def _lookup(self, url):
+        '''
+        Returns the digest, ETag and Last-Modified of the egg last served at url
+        '''
+        try:
+            with open(self._url_path(url)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _cached(self, url, digest):
+        if not digest:
+            return None
+        path = self._object_path(digest, self._filename(url))
+        if not os.path.exists(path):
+            return None
+        if path not in self._verified:
+            if self.file_digest(path) != digest:
+                log.warning('Cached egg %s is corrupt, removing it', path)
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                return None
+            self._verified.add(path)
+        try:
+            os.utime(path, None) # Marks the egg as recently used
+        except OSError:
+            pass
+        return path
+
+    def _mkstemp(self):
+        tmp_dir = os.path.join(self.path, 'tmp')
+        if not os.path.exists(tmp_dir):
+            try:
+                os.makedirs(tmp_dir)
+            except OSError:
+                pass # Created concurrently
+        return mkstemp(dir=tmp_dir)
+
+    def _download(self, url, expected):
+        headers = {}
+        validators = {} if expected else self._lookup(url)
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        r = requests.get(url, stream=True, headers=headers)
+        if r.status_code == 304:
+            path = self._cached(url, validators.get('sha256'))
+            if path:
+                self.revalidations += 1
+                self._urls[url] = validators['sha256']
+                return path
+            r = requests.get(url, stream=True)
+        if r.status_code != 200:
+            raise IOError("Couldn't download the file at %s" % url)
+        sha = hashlib.sha256()
+        fd, tmp_path = self._mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                    if chunk:
+                        sha.update(chunk)
+                        f.write(chunk)
+            digest = sha.hexdigest()
+            if expected and digest != expected:
+                raise IOError("Checksum mismatch for the file at %s: expected %s, got %s" % (url, expected, digest))
+        except:
+            os.unlink(tmp_path)
+            raise
+        return self._commit(url, tmp_path, digest, etag=r.headers.get('etag'), last_modified=r.headers.get('last-modified'))
+
+    def _commit(self, url, tmp_path, digest, etag=None, last_modified=None):
+        path = self._object_path(digest, self._filename(url))
+        object_dir = os.path.dirname(path)
+        if not os.path.exists(object_dir):
+            try:
+                os.makedirs(object_dir)
+            except OSError:
+                pass
+        os.rename(tmp_path, path)
+        self._verified.add(path)
+        self._urls[url] = digest
+
+        url_dir = os.path.dirname(self._url_path(url))
+        if not os.path.exists(url_dir):
+            try:
+                os.makedirs(url_dir)
+            except OSError:
+                pass
+        fd, tmp_path = self._mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'sha256':digest, 'etag':etag, 'last_modified':last_modified}, f)
+        os.rename(tmp_path, self._url_path(url))
+
+        self._evict()
+        return path
+
+    def _entries(self):
+        '''
+        Returns (object directory, size in bytes, last use) of the cached eggs
+        '''
+        objects = os.path.join(self.path, 'objects')
+        if not os.path.exists(objects):
+            return []
+        entries = []
+        for digest in os.listdir(objects):
+            object_dir = os.path.join(objects, digest)
+            try:
+                files = [os.path.join(object_dir, f) for f in os.listdir(object_dir)]
+                size = sum(os.path.getsize(f) for f in files)
+                used = max([os.path.getmtime(f) for f in files] or [0])
+            except OSError:
+                continue # Removed concurrently
+            entries.append((object_dir, size, used))
+        return entries
+
+    def _evict(self):
+        if not self.max_size:
+            return
+        max_bytes = self.max_size * 1024 * 1024
+        entries = sorted(self._entries(), key=lambda e : e[2])
+        total = sum(size for _, size, _ in entries)
+        pinned = set(os.path.dirname(p) for p in self._verified)
+        for object_dir, size, _ in entries:
+            if total <= max_bytes:
+                break
+            if object_dir in pinned:
+                continue
+            shutil.rmtree(object_dir, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+
+egg_cache = EggCache(path=CFG.get_safe('container.egg_cache.path', None),
+                     max_size=CFG.get_safe('container.egg_cache.max_size', 500))
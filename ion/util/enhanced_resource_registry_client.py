@@ -16,6 +16,34 @@ from pyon.util.config import Config
 errc_lookups = None
 
 
+class CachedAssociations(list):
+    """
+    The cached associations of a predicate, in the order the resource registry returned them,
+    indexed by subject id, object id, (subject id, object type) and (object id, subject type)
+    """
+    def __init__(self, assocs):
+        list.__init__(self, assocs)
+        self._by_subject = {}
+        self._by_object = {}
+        self._by_subject_ot = {}
+        self._by_object_st = {}
+        for a in self:
+            self._by_subject.setdefault(a.s, []).append(a)
+            self._by_object.setdefault(a.o, []).append(a)
+            self._by_subject_ot.setdefault((a.s, a.ot), []).append(a)
+            self._by_object_st.setdefault((a.o, a.st), []).append(a)
+
+    def by_subject(self, subject_id, object_type=''):
+        if object_type:
+            return self._by_subject_ot.get((subject_id, object_type), [])
+        return self._by_subject.get(subject_id, [])
+
+    def by_object(self, object_id, subject_type=''):
+        if subject_type:
+            return self._by_object_st.get((object_id, subject_type), [])
+        return self._by_object.get(object_id, [])
+
+
 class EnhancedResourceRegistryClient(object):
     """
     This class provides enhanced resource registry client functionality by wrapping the "real" client.
@@ -54,10 +82,11 @@ class EnhancedResourceRegistryClient(object):
      find method name can include "_using_has_model" ("_using_", and the predicate type with underscores)
     """
 
-    def __init__(self, rr_client):
+    def __init__(self, rr_client, shared_cache=None):
         self.id = id(self)
         log.debug("EnhancedResourceRegistryClient init")
         self.RR = rr_client
+        self._shared_cache = shared_cache
 
         global errc_lookups
         if not errc_lookups:
@@ -66,7 +95,6 @@ class EnhancedResourceRegistryClient(object):
 
         self._cached_dynamics = {}
 
-        self._cached_predicates = {}
         self._cached_predicates = {}
         self._cached_resources = {}
         self._all_cached_resources = {}
@@ -327,6 +355,19 @@ class EnhancedResourceRegistryClient(object):
                                         predicate=association_type,
                                         object=object_id)
         self.RR.delete_association(assoc)
+        self._associations_changed(association_type)
+
+
+    def _associations_changed(self, predicate=None):
+        """
+        Drops the associations of the predicate (of every predicate if None) from the container's
+        resource cache, and from the shared cache if this client was given another one, after
+        creating or deleting associations through this client, whether or not it reads the cache
+        """
+        from ion.util.resource_cache import resource_cache  # imports this module
+        resource_cache.invalidate_associations(predicate)
+        if self._shared_cache is not None and self._shared_cache is not resource_cache:
+            self._shared_cache.invalidate_associations(predicate)
 
 
     def find_resource_by_name(self, resource_type, name, id_only=False):
@@ -375,27 +416,9 @@ class EnhancedResourceRegistryClient(object):
 
         log.debug("Using %s cached results for 'find (%s) subjects'", len(self._cached_predicates[predicate]), predicate)
 
-        def filter_fn(assoc):
-            if object != assoc.o:
-                return False
-
-            if "" != subject_type and subject_type != assoc.st:
-                return False
-
-            return True
-
         log.debug("Checking object_id=%s, subject_type=%s", object_id, subject_type)
         preds = self._cached_predicates[predicate]
-        time_search_start = get_ion_ts()
-        subject_ids = [a.s for a in self.filter_cached_associations(predicate, filter_fn)]
-        time_search_stop = get_ion_ts()
-        total_time = int(time_search_stop) - int(time_search_start)
-        log.debug("Processed %s %s predicates for %s subjects in %s seconds",
-                 len(preds),
-                 predicate,
-                 len(subject_ids),
-                 total_time / 1000.0)
-
+        subject_ids = [a.s for a in preds.by_object(object_id, subject_type)]
 
         if id_only:
             return subject_ids
@@ -416,26 +439,9 @@ class EnhancedResourceRegistryClient(object):
 
         log.debug("Using %s cached results for 'find (%s) objects'", len(self._cached_predicates[predicate]), predicate)
 
-        def filter_fn(assoc):
-            if subject_id != assoc.s:
-                return False
-
-            if "" != object_type and object_type != assoc.ot:
-                return False
-
-            return True
-
         log.debug("Checking subject_id=%s, object_type=%s", subject_id, object_type)
         preds = self._cached_predicates[predicate]
-        time_search_start = get_ion_ts()
-        object_ids = [a.o for a in self.filter_cached_associations(predicate, filter_fn)]
-        time_search_stop = get_ion_ts()
-        total_time = int(time_search_stop) - int(time_search_start)
-        log.debug("Processed %s %s predicates for %s objects in %s seconds",
-                  len(preds),
-                  predicate,
-                  len(object_ids),
-                  total_time / 1000.0)
+        object_ids = [a.o for a in preds.by_subject(subject_id, object_type)]
 
         if id_only:
             return object_ids
@@ -516,6 +522,7 @@ class EnhancedResourceRegistryClient(object):
 
         for a in associations:
             self.RR.delete_association(a)
+        self._associations_changed(association_type or None)
 
 
     def delete_subject_associations(self, association_type='', object_id=''):
@@ -529,6 +536,7 @@ class EnhancedResourceRegistryClient(object):
 
         for a in associations:
             self.RR.delete_association(a)
+        self._associations_changed(association_type or None)
 
 
     def advance_lcs(self, resource_id, transition_event):
@@ -556,7 +564,8 @@ class EnhancedResourceRegistryClient(object):
         Save all associations of a given predicate type to memory, for in-memory find_subjects/objects ops
 
         This is a PREFETCH operation, and EnhancedResourceRegistryClient objects that use the cache functionality
-        should NOT be persisted across service calls.
+        should NOT be persisted across service calls.  Clients given a shared_cache (see ion.util.resource_cache)
+        take the associations from it, where they stay cached across calls.
         """
         #log.debug("Caching predicates: %s", predicate)
         if self.has_cached_predicate(predicate):
@@ -564,7 +573,10 @@ class EnhancedResourceRegistryClient(object):
             return
 
         time_caching_start = get_ion_ts()
-        preds = self.RR.find_associations(predicate=predicate, id_only=False)
+        if self._shared_cache is not None:
+            preds = self._shared_cache.associations(predicate, self.RR)
+        else:
+            preds = CachedAssociations(self.RR.find_associations(predicate=predicate, id_only=False))
         time_caching_stop = get_ion_ts()
 
         total_time = int(time_caching_stop) - int(time_caching_start)
@@ -573,11 +585,22 @@ class EnhancedResourceRegistryClient(object):
         self._cached_predicates[predicate] = preds
 
 
-    def filter_cached_associations(self, predicate, is_match_fn):
+    def filter_cached_associations(self, predicate, is_match_fn, subject_id=None, object_id=None):
+        """
+        Returns the cached associations of the predicate matching is_match_fn. Giving the subject_id
+        or the object_id narrows the associations checked to the ones of that subject or object.
+        """
         if not self.has_cached_predicate(predicate):
             raise BadRequest("Attempted to filter cached associations of uncached predicate '%s'" % predicate)
 
-        return [a for a in self._cached_predicates[predicate] if is_match_fn(a)]
+        assocs = self._cached_predicates[predicate]
+        if subject_id is not None:
+            assocs = assocs.by_subject(subject_id)
+            if object_id is not None:
+                assocs = [a for a in assocs if a.o == object_id]
+        elif object_id is not None:
+            assocs = assocs.by_object(object_id)
+        return [a for a in assocs if is_match_fn(a)]
 
     def get_cached_associations(self, predicate):
         return self.filter_cached_associations(predicate, lambda x: True)
@@ -593,14 +616,17 @@ class EnhancedResourceRegistryClient(object):
         Save all resources of a given type to memory, for in-memory lookup ops
 
         This is a PREFETCH operation, and EnhancedResourceRegistryClient objects that use the cache functionality
-        should NOT be kept across service calls.
+        should NOT be kept across service calls.  Clients given a shared_cache take all the resources of a type
+        from it, the objects are shared with every other client and must not be modified.
         """
         #log.info("Caching resources: %s", resource_type)
         #log.debug("This cache is %s", self)
         time_caching_start = get_ion_ts()
 
         resource_objs = []
-        if specific_ids is None:
+        if specific_ids is None and self._shared_cache is not None:
+            resource_objs = self._shared_cache.resources(resource_type, self.RR)
+        elif specific_ids is None:
             resource_objs, _ = self.RR.find_resources(restype=resource_type, id_only=False)
         else:
             assert type(specific_ids) is list
@@ -790,6 +816,7 @@ class EnhancedResourceRegistryClient(object):
                 log.debug("Dynamically creating association %s -> %s -> %s", isubj, ipred, iobj)
                 log.debug("%s -> %s -> %s", subj_id, ipred, obj_id)
                 self.RR.create_association(subj_id, ipred, obj_id)
+                self._associations_changed(ipred)
 
             return ret_fn
 
@@ -833,6 +860,7 @@ class EnhancedResourceRegistryClient(object):
                         return
 
                 self.RR.create_association(subj_id, ipred, obj_id)
+                self._associations_changed(ipred)
 
             return ret_fn
 
@@ -878,6 +906,7 @@ class EnhancedResourceRegistryClient(object):
                         return
 
                 self.RR.create_association(subj_id, ipred, obj_id)
+                self._associations_changed(ipred)
 
             return ret_fn
 
@@ -1190,3 +1219,5 @@ class EnhancedResourceRegistryClient(object):
         for assn in sbj_assns:
             log.debug("pluck deleting subject association %s", assn)
             self.RR.delete_association(assn)
+
+        self._associations_changed()
@@ -1,11 +1,13 @@
 import os
 import stat
 import base64
+import hashlib
 import tempfile
 import subprocess
 
 from ion.util.zip import zip_of_b64
 from ion.util.path import path_subtract
+from ion.util.egg_cache import egg_cache
 
 from ooi.logging import log
 
@@ -33,6 +35,7 @@ class RegisterModulePreparerBase(object):
         self.modules["subprocess"] = subprocess
         self.modules["tempfile"]   = tempfile
         self.modules["os"]         = os
+        self.modules["egg_cache"]  = egg_cache
 
 
     def get_uploader_class(self):
@@ -195,6 +198,7 @@ class RegisterModuleUploader(object):
         self.subprocess = modules["subprocess"] # for mock purposes
         self.tempfile   = modules["tempfile"]
         self.os         = modules["os"]
+        self.egg_cache  = modules.get("egg_cache")
 
         self.dest_user     = dest_user
         self.dest_host     = dest_host
@@ -274,6 +278,34 @@ class RegisterModuleUploader(object):
 
 class RegisterModuleUploaderEgg(RegisterModuleUploader):
 
+    def upload(self):
+        """
+        upload the egg and add it to the local egg cache, so that it isn't
+        downloaded again by processes on this host
+
+        return boolean success of uploading, message
+        """
+        success, msg = RegisterModuleUploader.upload(self)
+        if success and self.egg_cache is not None:
+            try:
+                self.egg_cache.store(self.dest_url, base64.decodestring(self.dest_contents))
+            except (IOError, OSError):
+                log.warning("Couldn't add '%s' to the egg cache", self.dest_url, exc_info=True)
+        return success, msg
+
+    def get_destination_url(self):
+        """
+        return the download URL pinned to the egg's contents (#sha256=<digest>),
+        so that the egg cache verifies it and serves it without asking the server
+        """
+        return "%s#sha256=%s" % (self.dest_url, self.get_egg_sha256())
+
+    def get_egg_sha256(self):
+        """
+        return the sha256 of the egg
+        """
+        return hashlib.sha256(base64.decodestring(self.dest_contents)).hexdigest()
+
     def set_egg_urlfile_name(self, name):
         self.egg_urlfile_name = name
 
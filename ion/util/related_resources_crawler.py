@@ -66,6 +66,7 @@ class RelatedResourcesCrawler(object):
 
                 for rt in resource_whitelist:
                     RR2.cache_resources(rt)
+                whitelist = set(resource_whitelist)
 
                 def lookup_fn(resource_id):
                     """
@@ -75,15 +76,15 @@ class RelatedResourcesCrawler(object):
                     """
                     retval = {}
 
-                    sto_match = lambda assn: assn.s == resource_id and assn.ot in resource_whitelist
-                    ots_match = lambda assn: assn.o == resource_id and assn.st in resource_whitelist
+                    sto_match = lambda assn: assn.ot in whitelist
+                    ots_match = lambda assn: assn.st in whitelist
                     for p, (search_sto, search_ots) in predicate_dictionary.iteritems():
                         if search_sto:
-                            for a in RR2.filter_cached_associations(p, sto_match):
+                            for a in RR2.filter_cached_associations(p, sto_match, subject_id=resource_id):
                                 log.trace("lookup_fn matched %s object", a.ot)
                                 retval[a.o] = a
                         if search_ots:
-                            for a in RR2.filter_cached_associations(p, ots_match):
+                            for a in RR2.filter_cached_associations(p, ots_match, object_id=resource_id):
                                 log.trace("lookup_fn matched %s subject", a.st)
                                 retval[a.s] = a
 
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+'''
+@file ion/util/resource_cache.py
+@description Container wide cache of resources by type and associations by predicate
+'''
+
+from pyon.container.cc import Container
+from pyon.core.exception import Inconsistent
+from pyon.core.object import IonObjectSerializer
+from pyon.ion.event import EventSubscriber
+from pyon.public import CFG, OT
+from pyon.util.log import log
+
+from ion.util.enhanced_resource_registry_client import CachedAssociations
+
+from collections import OrderedDict
+from gevent.coros import RLock
+import hashlib
+import json
+import time
+
+
+# Events that may come with association changes made in other containers
+DEFAULT_ASSOCIATION_EVENTS = [OT.ResourceLifecycleEvent]
+
+
+class ResourceRegistryCache(object):
+    '''
+    Bounded LRU cache of the resources of a type and of the associations of a
+    predicate, shared across service calls by the EnhancedResourceRegistryClient
+    objects given it as their shared_cache.
+
+    Cached tables are never changed, an invalidation replaces them, so a client
+    keeps reading the snapshot it got for the rest of its call. The resources
+    and associations in them are handed to every client and are read-only: a
+    client that needs to change one reads it from the resource registry first.
+
+    Tables are dropped when:
+     - any EnhancedResourceRegistryClient in this container creates or
+       deletes an association (the assign_*/unassign_* functions), which drops
+       the predicate
+     - a ResourceModifiedEvent arrives, which drops the resources of the origin
+       type and, unless it is an UPDATE, every cached predicate, since resource
+       creation and deletion don't say which predicates they affect
+     - one of the association_events arrives, which drops the predicate of the
+       event or, when the event has none, every cached predicate. Association
+       changes made through the resource registry directly don't come with a
+       ResourceModifiedEvent, so the events announcing them are configured
+       (container.resource_cache.association_events). By default these are
+       the ResourceLifecycleEvents, deployments are activated and deactivated
+       along with a lifecycle transition of the deployment.
+    Tables are also reloaded after ttl seconds, the bound on how stale an
+    association changed in another container without an event can be, and once
+    more than max_entries resources and associations are held the least
+    recently used tables are dropped.
+
+    When disabled every call reads the resource registry. With check set every
+    cache hit is compared to the resource registry and to the table as it was
+    loaded, and Inconsistent is raised when the registry changed without an
+    invalidation or a client modified a cached object, for use in tests.
+    '''
+    def __init__(self, enabled=False, max_entries=500000, ttl=300, check=False, association_events=None):
+        self.enabled            = enabled
+        self.max_entries        = max_entries
+        self.ttl                = ttl
+        self.check              = check
+        self.association_events = association_events or []
+        self.version            = 0  # bumped on every invalidation
+        self._tables            = OrderedDict() # ('resource', type) or ('predicate', predicate) -> (table, expiry, fingerprint)
+        self._entries           = 0
+        self._lock              = RLock()
+        self._subscribers       = None
+        self.hits               = 0
+        self.misses             = 0
+        self.invalidations      = 0
+        self.evictions          = 0
+        self.inconsistencies    = 0
+
+    def resources(self, resource_type, rr_client):
+        '''
+        Returns a tuple of all the resources of the type
+        '''
+        def load():
+            resource_objs, _ = rr_client.find_resources(restype=resource_type, id_only=False)
+            return tuple(resource_objs)
+        return self._get(('resource', resource_type), load)
+
+    def associations(self, predicate, rr_client):
+        '''
+        Returns the CachedAssociations of all the associations of the predicate
+        '''
+        load = lambda : CachedAssociations(rr_client.find_associations(predicate=predicate, id_only=False))
+        return self._get(('predicate', predicate), load)
+
+    def _get(self, key, load):
+        if not self.enabled:
+            return load()
+        self._start_monitor()
+        now = time.time()
+        with self._lock:
+            table, expiry, fingerprint = self._tables.pop(key, (None, 0, None))
+            if table is not None and expiry > now:
+                self._tables[key] = (table, expiry, fingerprint)
+                self.hits += 1
+            elif table is not None:
+                self._entries -= len(table)
+                table = None
+        if table is not None:
+            if self.check:
+                self._check(key, table, fingerprint, load())
+            return table
+
+        self.misses += 1
+        version = self.version
+        table = load()
+        fingerprint = self._fingerprint(table) if self.check else None
+        with self._lock:
+            # Not stored when invalidated while loading, the table may predate the change
+            if version == self.version and key not in self._tables:
+                self._tables[key] = (table, now + self.ttl, fingerprint)
+                self._entries += len(table)
+                while self._entries > self.max_entries and self._tables:
+                    _, (evicted, _, _) = self._tables.popitem(last=False)
+                    self._entries -= len(evicted)
+                    self.evictions += 1
+        return table
+
+    def _fingerprint(self, table):
+        serializer = IonObjectSerializer()
+        digest = hashlib.sha1()
+        for o in table:
+            digest.update(json.dumps(serializer.serialize(o), sort_keys=True, default=str))
+        return digest.hexdigest()
+
+    def _check(self, key, table, fingerprint, current):
+        if fingerprint is not None and self._fingerprint(table) != fingerprint:
+            self.inconsistencies += 1
+            raise Inconsistent('Cached %s %s was modified by a client, cached objects are read-only' % key)
+        cached = set((o._id, getattr(o, '_rev', None)) for o in table)
+        loaded = set((o._id, getattr(o, '_rev', None)) for o in current)
+        if cached != loaded:
+            self.inconsistencies += 1
+            raise Inconsistent('Cached %s %s differs from the resource registry: %d missing, %d stale' %
+                               (key[0], key[1], len(loaded - cached), len(cached - loaded)))
+
+    def invalidate(self, resource_type=None, predicate=None):
+        '''
+        Drops the resources of a type and the associations of a predicate, or everything
+        '''
+        if resource_type is None and predicate is None:
+            self._drop(self._tables.keys())
+        else:
+            self._drop([('resource', resource_type), ('predicate', predicate)])
+
+    def invalidate_associations(self, predicate=None):
+        '''
+        Drops the associations of a predicate, or of every predicate
+        '''
+        if predicate is None:
+            self._drop([key for key in self._tables if key[0] == 'predicate'])
+        else:
+            self._drop([('predicate', predicate)])
+
+    def _drop(self, keys):
+        with self._lock:
+            self.version += 1
+            for key in keys:
+                if key in self._tables:
+                    table, _, _ = self._tables.pop(key)
+                    self._entries -= len(table)
+                    self.invalidations += 1
+
+    def stats(self):
+        return {'hits'            : self.hits,
+                'misses'          : self.misses,
+                'invalidations'   : self.invalidations,
+                'evictions'       : self.evictions,
+                'inconsistencies' : self.inconsistencies,
+                'tables'          : len(self._tables),
+                'entries'         : self._entries,
+                'version'         : self.version}
+
+    def _on_modified(self, event, *args, **kwargs):
+        keys = [key for key in self._tables
+                if (key[0] == 'resource' and (not event.origin_type or key[1] == event.origin_type))
+                or (key[0] == 'predicate' and event.sub_type != 'UPDATE')]
+        log.debug('%s %s modified (%s), dropping %d cached tables', event.origin_type, event.origin, event.sub_type, len(keys))
+        self._drop(keys)
+
+    def _on_association(self, event, *args, **kwargs):
+        predicate = getattr(event, 'predicate', None)
+        log.debug('%s from %s, dropping cached associations of %s', event.type_, event.origin, predicate or 'every predicate')
+        self.invalidate_associations(predicate)
+
+    def _start_monitor(self):
+        '''
+        Subscribes to resource modifications and to the association events the
+        first time the cache is used inside a container
+        '''
+        if self._subscribers is not None or Container.instance is None:
+            return
+        self._subscribers = []
+        try:
+            callbacks = [(OT.ResourceModifiedEvent, self._on_modified)]
+            callbacks.extend((event_type, self._on_association) for event_type in self.association_events)
+            for event_type, callback in callbacks:
+                subscriber = EventSubscriber(event_type=event_type, callback=callback, auto_delete=True)
+                subscriber.start()
+                self._subscribers.append(subscriber)
+        except Exception:
+            log.exception('Unable to monitor resource modifications, disabling the resource cache')
+            self.stop_monitor()
+            self._subscribers = []
+            self.enabled = False
+
+    def stop_monitor(self):
+        for subscriber in self._subscribers or []:
+            subscriber.stop()
+        self._subscribers = None
+
+
+resource_cache = ResourceRegistryCache(enabled=CFG.get_safe('container.resource_cache.enabled', False),
+                                       max_entries=CFG.get_safe('container.resource_cache.max_entries', 500000),
+                                       ttl=CFG.get_safe('container.resource_cache.ttl', 300),
+                                       check=CFG.get_safe('container.resource_cache.check', False),
+                                       association_events=CFG.get_safe('container.resource_cache.association_events', DEFAULT_ASSOCIATION_EVENTS))
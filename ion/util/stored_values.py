@@ -5,19 +5,183 @@
 @file ion/util/stored_values.py
 '''
 
+from pyon.container.cc import Container
 from pyon.core.exception import NotFound
+from pyon.ion.event import EventPublisher, EventSubscriber
+from pyon.public import CFG, OT
+from pyon.util.log import log
+
+from collections import OrderedDict
+from gevent.coros import RLock
 import gevent
+import time
+
+
+
+class StoredValueCache(object):
+    '''
+    Process-wide cache of stored value documents (calibration coefficients,
+    QC lookup tables) keyed by document key.
+
+    Documents expire after ttl seconds, keys that don't exist are remembered
+    for negative_ttl seconds. A key is dropped as soon as it is written or
+    deleted through a StoredValueManager in this process, or when an
+    ExternalReferencesUpdatedEvent lists it, which StoredValueManager
+    publishes for every write. Documents written to the object store some
+    other way are only picked up once they expire, so caching is off (a ttl
+    of 0) unless configured, and the events are only published by processes
+    that cache. The cached documents are shared and must be treated as
+    read-only.
+    '''
+    def __init__(self, ttl=0, negative_ttl=0, maxsize=1000):
+        self.ttl           = ttl
+        self.negative_ttl  = negative_ttl
+        self.maxsize       = maxsize
+        self._docs         = OrderedDict() # doc_key -> (document or None, expiration)
+        self._lock         = RLock()
+        self._subscriber   = None
+        self._publisher    = None
+        self.version       = 0 # bumped on every invalidation
+        self.hits          = 0
+        self.misses        = 0
+        self.invalidations = 0
+
+    def read_mult(self, store, doc_keys):
+        '''
+        Returns the documents for doc_keys, None for the ones that don't
+        exist. Documents that aren't cached are read in a single request.
+        '''
+        if not self.enabled:
+            return store.read_doc_mult(doc_keys, strict=False)
+        self._start_monitor()
+        now = time.time()
+        docs = {}
+        missing = []
+        with self._lock:
+            for key in doc_keys:
+                entry = self._docs.get(key)
+                if entry is not None and entry[1] > now:
+                    docs[key] = entry[0]
+                    self.hits += 1
+                elif key not in missing:
+                    missing.append(key)
+                    self.misses += 1
+        if missing:
+            version = self.version
+            doc_list = store.read_doc_mult(missing, strict=False)
+            with self._lock:
+                # Not stored when invalidated while reading, the documents may predate the change
+                store_docs = version == self.version
+                for key, doc in zip(missing, doc_list):
+                    docs[key] = doc
+                    if store_docs:
+                        self._put(key, doc, now)
+        return [docs[key] for key in doc_keys]
 
+    @property
+    def enabled(self):
+        return bool(self.ttl or self.negative_ttl)
+
+    def read(self, store, doc_key):
+        doc = self.read_mult(store, [doc_key])[0]
+        if doc is None:
+            raise NotFound('Stored value %s does not exist' % doc_key)
+        return doc
+
+    def invalidate(self, doc_keys=None):
+        '''
+        Drops the given keys, or every key
+        '''
+        with self._lock:
+            self.version += 1
+            if doc_keys is None:
+                self._docs.clear()
+                return
+            for key in doc_keys:
+                if self._docs.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def publish_invalidation(self, doc_key):
+        '''
+        Drops the key and tells the other processes to drop it from their
+        caches, when caching is configured
+        '''
+        if not self.enabled:
+            return
+        self.invalidate([doc_key])
+        if Container.instance is None:
+            return
+        try:
+            if self._publisher is None:
+                self._publisher = EventPublisher(event_type=OT.ExternalReferencesUpdatedEvent)
+            self._publisher.publish_event(origin=doc_key, reference_keys=[doc_key])
+        except Exception:
+            log.exception('Unable to publish the update of stored value %s', doc_key)
+
+    def stats(self):
+        return {'hits'          : self.hits,
+                'misses'        : self.misses,
+                'invalidations' : self.invalidations,
+                'documents'     : len(self._docs)}
+
+    def _put(self, key, doc, now):
+        ttl = self.ttl if doc is not None else self.negative_ttl
+        if not ttl:
+            return
+        self._docs.pop(key, None)
+        self._docs[key] = (doc, now + ttl)
+        while len(self._docs) > self.maxsize:
+            self._docs.popitem(last=False)
+
+    def _on_references_updated(self, event, *args, **kwargs):
+        if isinstance(event.reference_keys, list):
+            self.invalidate(event.reference_keys)
+
+    def _start_monitor(self):
+        '''
+        Subscribes to reference updates the first time the cache is used
+        inside a container
+        '''
+        if self._subscriber is not None or Container.instance is None:
+            return
+        try:
+            self._subscriber = EventSubscriber(event_type=OT.ExternalReferencesUpdatedEvent,
+                                               callback=self._on_references_updated,
+                                               auto_delete=True)
+            self._subscriber.start()
+        except Exception:
+            log.exception('Unable to monitor external reference updates')
+            self._subscriber = False
+
+    def stop_monitor(self):
+        if self._subscriber:
+            self._subscriber.stop()
+        self._subscriber = None
+        if self._publisher is not None:
+            self._publisher.close()
+        self._publisher = None
+
+
+stored_value_cache = StoredValueCache(ttl=CFG.get_safe('container.stored_value_cache.ttl', 0),
+                                      negative_ttl=CFG.get_safe('container.stored_value_cache.negative_ttl', 0),
+                                      maxsize=CFG.get_safe('container.stored_value_cache.size', 1000))
 
 
 class StoredValueManager(object):
-    def __init__(self, container):
+    def __init__(self, container, cache=stored_value_cache):
         self.store = container.object_store
+        self.cache = cache
 
     def stored_value_cas(self, doc_key, document_updates):
         '''
         Performs a check and set for a lookup_table in the object store for the given key
         '''
+        try:
+            return self._stored_value_cas(doc_key, document_updates)
+        finally:
+            self._invalidate(doc_key)
+
+    def _stored_value_cas(self, doc_key, document_updates):
         try:
             doc = self.store.read_doc(doc_key)
         except NotFound:
@@ -34,14 +198,26 @@ class StoredValueManager(object):
         return doc_id, rev
 
     def read_value(self, doc_key):
+        if self.cache is not None:
+            return self.cache.read(self.store, doc_key)
         doc = self.store.read_doc(doc_key)
         return doc
 
     def read_value_mult(self, doc_keys, strict=False):
+        if self.cache is not None:
+            doc_list = self.cache.read_mult(self.store, doc_keys)
+            if strict and None in doc_list:
+                raise NotFound('Stored values %s do not exist' % [k for k,d in zip(doc_keys, doc_list) if d is None])
+            return doc_list
         doc_list = self.store.read_doc_mult(doc_keys, strict=strict)
         return doc_list
 
     def delete_stored_value(self, doc_key):
-        self.store.delete_doc(doc_key)
-
+        try:
+            self.store.delete_doc(doc_key)
+        finally:
+            self._invalidate(doc_key)
 
+    def _invalidate(self, doc_key):
+        if self.cache is not None:
+            self.cache.publish_invalidation(doc_key)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+@file ion/util/test/test_egg_cache.py
+@brief Tests for the local egg cache
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.util.egg_cache import EggCache
+from ion.util.module_uploader import RegisterModuleUploaderEgg
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+import base64
+import gevent
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+@attr('UNIT', group='dm')
+class EggCacheTest(PyonTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cache = EggCache(path=self.root)
+
+        self.contents = 'egg contents' * 100
+        patcher = patch('ion.util.egg_cache.requests')
+        self.requests = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.requests.get.side_effect = self.fake_get
+
+    def fake_get(self, url, stream=False, headers=None):
+        gevent.sleep(0) # Let other greenlets request the egg
+        etag = '"%s"' % hashlib.md5(self.contents).hexdigest()
+        response = Mock()
+        response.headers = {'etag' : etag}
+        response.status_code = 304 if (headers or {}).get('If-None-Match') == etag else 200
+        response.iter_content.return_value = [self.contents[:500], self.contents[500:]]
+        return response
+
+    def test_cache(self):
+        url = 'http://host/path/example-0.1-py2.7.egg'
+        path = self.cache.get(url)
+        self.assertEquals(os.path.basename(path), 'example-0.1-py2.7.egg')
+        with open(path) as f:
+            self.assertEquals(f.read(), self.contents)
+        self.assertEquals(self.cache.get(url), path)
+        self.assertEquals(self.requests.get.call_count, 1)
+
+        # Other processes revalidate the egg without downloading it again
+        other = EggCache(path=self.root)
+        self.assertEquals(other.get(url), path)
+        self.assertEquals(self.requests.get.call_count, 2)
+        self.assertEquals(other.revalidations, 1)
+
+        # The egg is uploaded again to the same URL
+        self.contents = 'new egg contents' * 100
+        self.assertEquals(other.get(url), path)
+        other.forget(url)
+        new_path = other.get(url)
+        self.assertNotEquals(new_path, path)
+        with open(new_path) as f:
+            self.assertEquals(f.read(), self.contents)
+        self.assertNotEquals(EggCache(path=self.root).get(url), path)
+
+    def test_single_flight(self):
+        url = 'http://host/path/example-0.1-py2.7.egg'
+        greenlets = [gevent.spawn(self.cache.get, url) for i in xrange(5)]
+        gevent.joinall(greenlets)
+        self.assertEquals(len(set(g.value for g in greenlets)), 1)
+        self.assertEquals(self.requests.get.call_count, 1)
+
+    def test_checksum(self):
+        digest = hashlib.sha256(self.contents).hexdigest()
+        url = 'http://host/path/example-0.1-py2.7.egg#sha256=%s' % digest
+        path = self.cache.get(url)
+        self.assertIn(digest, path)
+        # Pinned eggs are served without asking the server
+        self.assertEquals(EggCache(path=self.root).get(url), path)
+        self.assertEquals(self.requests.get.call_count, 1)
+
+        with self.assertRaises(IOError):
+            self.cache.get('http://host/path/other-0.1-py2.7.egg', sha256='0' * 64)
+        self.assertEquals(os.listdir(os.path.join(self.root, 'tmp')), [])
+
+    def test_uploaded_egg(self):
+        subprocess_mock = Mock()
+        subprocess_mock.Popen.return_value.communicate.return_value = ('', '')
+        subprocess_mock.Popen.return_value.returncode = 0
+        tempfile_mock = Mock()
+        tempfile_mock.mkstemp.return_value = ('handle', 'tempfile_name')
+        uploader = RegisterModuleUploaderEgg(dest_contents=base64.encodestring(self.contents),
+                                             dest_url='http://host/path/example-0.1-py2.7.egg',
+                                             modules={'subprocess':subprocess_mock, 'tempfile':tempfile_mock,
+                                                      'os':Mock(), 'egg_cache':self.cache})
+        self.assertEquals(uploader.upload(), (True, ''))
+
+        # The URL of the uploaded egg is pinned to its contents, other processes don't ask the server
+        url = uploader.get_destination_url()
+        digest = hashlib.sha256(self.contents).hexdigest()
+        self.assertEquals(url, 'http://host/path/example-0.1-py2.7.egg#sha256=%s' % digest)
+        self.assertIn(digest, EggCache(path=self.root).get(url))
+        self.assertFalse(self.requests.get.called)
+
+    def test_eviction(self):
+        self.cache.max_size = 2.5 / 1024 # 2.5 KB
+        for i in xrange(3):
+            self.cache.store('http://host/path/example-%d-py2.7.egg' % i, str(i) * 1024)
+        # The cache can't evict eggs it handed out
+        self.assertEquals(self.cache.evictions, 0)
+
+        other = EggCache(path=self.root, max_size=2.5 / 1024)
+        other.store('http://host/path/example-3-py2.7.egg', '3' * 1024)
+        self.assertEquals(other.evictions, 2)
+        self.assertTrue(other.size() <= 2.5 / 1024)
@@ -553,3 +553,35 @@ class TestEnhancedResourceRegistryClient(PyonTestCase):
         self.assertEqual([d], results)
 
         self.assertEqual(0, self.rr.find_subjects.call_count)
+
+
+    def test_cached_association_filter(self):
+        p1 = "p1_id"
+        p2 = "p2_id"
+        i1 = "i1_id"
+        i2 = "i2_id"
+
+        assns = [DotDict(s=p1, st=RT.PlatformSite, p=PRED.hasSite, o=p2, ot=RT.PlatformSite),
+                 DotDict(s=p1, st=RT.PlatformSite, p=PRED.hasSite, o=i1, ot=RT.InstrumentSite),
+                 DotDict(s=p2, st=RT.PlatformSite, p=PRED.hasSite, o=i2, ot=RT.InstrumentSite)]
+
+        self.rr.find_associations.return_value = assns
+
+        self.RR2.cache_predicate(PRED.hasSite)
+
+        everything = lambda a: True
+        self.assertEqual(assns, self.RR2.filter_cached_associations(PRED.hasSite, everything))
+        self.assertEqual(assns[:2], self.RR2.filter_cached_associations(PRED.hasSite, everything, subject_id=p1))
+        self.assertEqual(assns[2:], self.RR2.filter_cached_associations(PRED.hasSite, everything, object_id=i2))
+        self.assertEqual(assns[1:2], self.RR2.filter_cached_associations(PRED.hasSite, everything, subject_id=p1, object_id=i1))
+        self.assertEqual([], self.RR2.filter_cached_associations(PRED.hasSite, everything, subject_id=p2, object_id=i1))
+        self.assertEqual(assns[1:2], self.RR2.filter_cached_associations(PRED.hasSite,
+                                                                         lambda a: a.ot == RT.InstrumentSite,
+                                                                         subject_id=p1))
+
+        self.assertEqual([p2, i1], self.RR2.find_objects(p1, PRED.hasSite, "", True))
+        self.assertEqual([i1], self.RR2.find_objects(p1, PRED.hasSite, RT.InstrumentSite, True))
+        self.assertEqual([p2], self.RR2.find_subjects(RT.PlatformSite, PRED.hasSite, i2, True))
+        self.assertEqual([], self.RR2.find_subjects(RT.Observatory, PRED.hasSite, i2, True))
+
+        self.assertRaises(BadRequest, self.RR2.filter_cached_associations, PRED.hasModel, everything)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+@file ion/util/test/test_related_resources_benchmarks.py
+@brief Benchmark of crawling the cached associations of an observatory graph
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.util.log import log
+from pyon.public import RT, PRED, IonObject
+
+from ion.util.enhanced_resource_registry_client import EnhancedResourceRegistryClient
+from ion.util.related_resources_crawler import RelatedResourcesCrawler
+from nose.plugins.attrib import attr
+from mock import Mock
+
+import time
+
+
+@attr('UTIL', group='sa')
+class RelatedResourcesBenchmark(PyonTestCase):
+    subsites    = 50
+    platforms   = 25 # per subsite
+    instruments = 8  # per platform site
+    models      = 10
+
+    def setUp(self):
+        self.assocs = {PRED.hasSite: [], PRED.hasDevice: [], PRED.hasModel: [], PRED.hasDeployment: []}
+
+        def assoc(s, st, p, o, ot):
+            self.assocs[p].append(IonObject('Association', s=s, st=st, p=p, o=o, ot=ot))
+
+        def site(site_id, site_type, device_type, model_type):
+            device_id = site_id.replace('site', 'device')
+            deployment_id = site_id.replace('site', 'deployment')
+            assoc(site_id, site_type, PRED.hasDevice, device_id, device_type)
+            assoc(device_id, device_type, PRED.hasModel, 'model_%d' % (len(self.assocs[PRED.hasModel]) % self.models), model_type)
+            assoc(site_id, site_type, PRED.hasDeployment, deployment_id, RT.Deployment)
+            assoc(device_id, device_type, PRED.hasDeployment, deployment_id, RT.Deployment)
+
+        for i in xrange(self.subsites):
+            subsite_id = 'subsite_%d' % i
+            assoc('observatory', RT.Observatory, PRED.hasSite, subsite_id, RT.Subsite)
+            for j in xrange(self.platforms):
+                platform_id = 'platform_site_%d_%d' % (i, j)
+                assoc(subsite_id, RT.Subsite, PRED.hasSite, platform_id, RT.PlatformSite)
+                site(platform_id, RT.PlatformSite, RT.PlatformDevice, RT.PlatformModel)
+                for k in xrange(self.instruments):
+                    instrument_id = 'instrument_site_%d_%d_%d' % (i, j, k)
+                    assoc(platform_id, RT.PlatformSite, PRED.hasSite, instrument_id, RT.InstrumentSite)
+                    site(instrument_id, RT.InstrumentSite, RT.InstrumentDevice, RT.InstrumentModel)
+
+        self.rr = Mock()
+        self.rr.find_associations.side_effect = lambda predicate, id_only : self.assocs[predicate]
+        self.rr.find_resources.return_value = ([], None)
+
+    def test_crawl(self):
+        log.info('Observatory graph of %d associations', sum(len(v) for v in self.assocs.itervalues()))
+
+        RR2 = EnhancedResourceRegistryClient(self.rr)
+        predicates = {PRED.hasSite       : (True, False),
+                      PRED.hasDevice     : (True, False),
+                      PRED.hasModel      : (True, False),
+                      PRED.hasDeployment : (True, False)}
+        whitelist = [RT.Observatory, RT.Subsite, RT.PlatformSite, RT.InstrumentSite,
+                     RT.PlatformDevice, RT.InstrumentDevice, RT.PlatformModel, RT.InstrumentModel, RT.Deployment]
+
+        then = time.time()
+        crawl = RelatedResourcesCrawler().generate_get_related_resources_fn(RR2, whitelist, predicates)
+        log.info('Cached the associations in %ss', time.time() - then)
+
+        then = time.time()
+        related = crawl('observatory')
+        log.info('Crawled %d related associations in %ss', len(related), time.time() - then)
+        self.assertEquals(len(related), sum(len(v) for v in self.assocs.itervalues()))
+
+        # A single resource, through the subject and object indexes
+        then = time.time()
+        for i in xrange(self.subsites):
+            RR2.find_objects('subsite_%d' % i, PRED.hasSite, RT.PlatformSite, id_only=True)
+            RR2.find_subjects(RT.InstrumentDevice, PRED.hasModel, 'model_%d' % (i % self.models), id_only=True)
+        log.info('Ran %d cached finds in %ss', 2 * self.subsites, time.time() - then)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+@file ion/util/test/test_resource_cache.py
+@brief Tests for the container wide resource and association cache
+'''
+
+from pyon.core.exception import Inconsistent
+from pyon.public import RT, PRED, IonObject
+from pyon.util.containers import DotDict
+from pyon.util.unit_test import PyonTestCase
+
+from ion.util.enhanced_resource_registry_client import EnhancedResourceRegistryClient
+from ion.util.resource_cache import ResourceRegistryCache
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+
+def assoc(i, s, o, p=PRED.hasDevice):
+    a = IonObject('Association', s=s, st=RT.PlatformSite, p=p, o=o, ot=RT.PlatformDevice)
+    a._id = 'assoc_%d' % i
+    return a
+
+
+def device(i):
+    d = IonObject(RT.PlatformDevice, name='device_%d' % i)
+    d._id = 'device_%d' % i
+    return d
+
+
+@attr('UNIT', group='sa')
+class ResourceRegistryCacheTest(PyonTestCase):
+    def setUp(self):
+        self.assocs = {PRED.hasDevice : [assoc(0, 'site_0', 'device_0'), assoc(1, 'site_1', 'device_1')],
+                       PRED.hasModel  : [assoc(2, 'device_0', 'model_0', PRED.hasModel)]}
+        self.devices = [device(0), device(1)]
+        self.rr = Mock()
+        self.rr.find_associations.side_effect = lambda predicate, id_only : list(self.assocs[predicate])
+        self.rr.find_resources.side_effect = lambda restype, id_only : (list(self.devices), None)
+        self.cache = ResourceRegistryCache(enabled=True)
+
+    def test_shared_across_clients(self):
+        for i in xrange(3):
+            RR2 = EnhancedResourceRegistryClient(self.rr, shared_cache=self.cache)
+            RR2.cache_predicate(PRED.hasDevice)
+            RR2.cache_resources(RT.PlatformDevice)
+            self.assertEquals(RR2.find_objects('site_1', PRED.hasDevice, RT.PlatformDevice, id_only=True), ['device_1'])
+            self.assertEquals(RR2.read('device_0', RT.PlatformDevice).name, 'device_0')
+
+        self.assertEquals(self.rr.find_associations.call_count, 1)
+        self.assertEquals(self.rr.find_resources.call_count, 1)
+        self.assertEquals(self.rr.read.call_count, 0)
+        self.assertEquals(self.cache.stats()['hits'], 4)
+
+        # Disabled, every client reads the resource registry
+        self.cache.enabled = False
+        EnhancedResourceRegistryClient(self.rr, shared_cache=self.cache).cache_predicate(PRED.hasDevice)
+        self.assertEquals(self.rr.find_associations.call_count, 2)
+
+    def test_invalidation(self):
+        snapshot = self.cache.associations(PRED.hasDevice, self.rr)
+        self.cache.associations(PRED.hasModel, self.rr)
+        self.cache.resources(RT.PlatformDevice, self.rr)
+
+        # An update only drops the resources of its type
+        self.devices[0] = device(0)
+        self.cache._on_modified(DotDict(origin='device_0', origin_type=RT.PlatformDevice, sub_type='UPDATE'))
+        self.assertEquals(self.cache.stats()['tables'], 2)
+        self.assertIs(self.cache.resources(RT.PlatformDevice, self.rr)[0], self.devices[0])
+
+        # Anything else also drops the associations, readers keep the snapshot they have
+        self.assocs[PRED.hasDevice].append(assoc(3, 'site_2', 'device_2'))
+        self.cache._on_modified(DotDict(origin='site_2', origin_type=RT.PlatformSite, sub_type=''))
+        self.assertEquals(self.cache.stats()['tables'], 1)
+        self.assertEquals(len(snapshot), 2)
+        self.assertEquals(self.cache.associations(PRED.hasDevice, self.rr).by_subject('site_2')[0].o, 'device_2')
+
+        self.cache.invalidate()
+        self.assertEquals(self.cache.stats()['entries'], 0)
+
+    def test_bounded(self):
+        self.cache.max_entries = 3
+        self.cache.associations(PRED.hasDevice, self.rr)
+        self.cache.associations(PRED.hasModel, self.rr)
+        self.cache.resources(RT.PlatformDevice, self.rr)
+
+        self.assertEquals(self.cache.stats()['entries'], 3)
+        self.assertEquals(self.cache.evictions, 1)
+        self.cache.associations(PRED.hasModel, self.rr)
+        self.assertEquals(self.rr.find_associations.call_count, 2)
+
+    def test_check(self):
+        self.cache.check = True
+        self.cache.associations(PRED.hasDevice, self.rr)
+        self.cache.associations(PRED.hasDevice, self.rr)
+
+        # A change the cache wasn't told about
+        self.assocs[PRED.hasDevice].pop()
+        with self.assertRaises(Inconsistent):
+            self.cache.associations(PRED.hasDevice, self.rr)
+        self.assertEquals(self.cache.inconsistencies, 1)
+
+    def test_read_only(self):
+        self.cache.check = True
+        self.cache.resources(RT.PlatformDevice, self.rr)[0].name = 'renamed'
+        with self.assertRaises(Inconsistent):
+            self.cache.resources(RT.PlatformDevice, self.rr)
+
+    def test_association_changes(self):
+        RR2 = EnhancedResourceRegistryClient(self.rr, shared_cache=self.cache)
+        RR2.cache_predicate(PRED.hasDevice)
+        RR2.cache_predicate(PRED.hasModel)
+
+        # Deleting through a client drops the predicate
+        self.rr.get_association.return_value = self.assocs[PRED.hasDevice][0]
+        RR2.delete_association('site_0', PRED.hasDevice, 'device_0')
+        self.assertEquals(self.cache.stats()['tables'], 1)
+
+        # An association event drops its predicate, or every predicate
+        self.cache.associations(PRED.hasDevice, self.rr)
+        self.cache._on_association(DotDict(type_='AssociationEvent', origin='site_0', predicate=PRED.hasModel))
+        self.assertEquals(self.cache.stats()['tables'], 1)
+        self.cache.associations(PRED.hasModel, self.rr)
+        self.cache._on_association(DotDict(type_='AssociationEvent', origin='site_0'))
+        self.assertEquals(self.cache.stats()['tables'], 0)
+
+    def test_unshared_client(self):
+        # Clients that don't read the cache, like the services' own, still invalidate it
+        with patch('ion.util.resource_cache.resource_cache', self.cache):
+            self.cache.associations(PRED.hasDevice, self.rr)
+            self.rr.get_association.return_value = self.assocs[PRED.hasDevice][0]
+            EnhancedResourceRegistryClient(self.rr).delete_association('site_0', PRED.hasDevice, 'device_0')
+            self.assertEquals(self.cache.stats()['tables'], 0)
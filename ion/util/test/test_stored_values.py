@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+@file ion/util/test/test_stored_values.py
+@brief Tests for the stored value cache
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from pyon.core.exception import NotFound
+from ion.util.stored_values import StoredValueCache, StoredValueManager
+from nose.plugins.attrib import attr
+from mock import Mock, patch
+
+
+@attr('UNIT')
+class StoredValueCacheTest(PyonTestCase):
+    def setUp(self):
+        self.docs = {'coeffs_a' : {'offset':1.0}, 'coeffs_b' : {'offset':2.0}}
+        self.cache = StoredValueCache(ttl=300, negative_ttl=30)
+        self.cache._subscriber = False # No container
+        container = Mock()
+        container.object_store.read_doc_mult.side_effect = lambda keys, strict=False : [self.docs.get(k) for k in keys]
+        container.object_store.read_doc.side_effect = lambda key : dict(self.docs[key])
+        container.object_store.update_doc.side_effect = lambda doc : self.docs.update({'coeffs_a':doc}) or ('coeffs_a', '2')
+        self.store = container.object_store
+        self.container = container
+        self.svm = StoredValueManager(container, cache=self.cache)
+
+    def test_cache(self):
+        docs = self.svm.read_value_mult(['coeffs_a', 'coeffs_b', 'missing'])
+        self.assertEquals(docs, [{'offset':1.0}, {'offset':2.0}, None])
+        self.store.read_doc_mult.assert_called_once_with(['coeffs_a', 'coeffs_b', 'missing'], strict=False)
+
+        # Hits, including the missing document
+        self.assertEquals(self.svm.read_value('coeffs_a'), {'offset':1.0})
+        with self.assertRaises(NotFound):
+            self.svm.read_value('missing')
+        self.assertEquals(self.store.read_doc_mult.call_count, 1)
+        self.assertEquals(self.cache.stats()['hits'], 2)
+
+        # Writes drop the key
+        self.svm.stored_value_cas('coeffs_a', {'offset':3.0})
+        self.assertEquals(self.svm.read_value('coeffs_a'), {'offset':3.0})
+        self.store.read_doc_mult.assert_called_with(['coeffs_a'], strict=False)
+
+    @patch('ion.util.stored_values.time')
+    def test_expiration(self, time_mock):
+        time_mock.time.return_value = 0
+        self.svm.read_value_mult(['coeffs_a', 'missing'])
+        time_mock.time.return_value = 60
+        self.svm.read_value_mult(['coeffs_a', 'missing'])
+        # The missing document expired
+        self.store.read_doc_mult.assert_called_with(['missing'], strict=False)
+
+        self.cache._on_references_updated(Mock(reference_keys=['coeffs_a']))
+        self.svm.read_value_mult(['coeffs_a'])
+        self.store.read_doc_mult.assert_called_with(['coeffs_a'], strict=False)
+        self.assertEquals(self.store.read_doc_mult.call_count, 3)
+
+    @patch('ion.util.stored_values.EventPublisher')
+    @patch('ion.util.stored_values.Container')
+    def test_publish_invalidation(self, container_mock, publisher_mock):
+        self.svm.read_value('coeffs_b')
+        self.svm.delete_stored_value('coeffs_b')
+        publisher_mock.return_value.publish_event.assert_called_once_with(origin='coeffs_b', reference_keys=['coeffs_b'])
+        self.assertEquals(self.cache.stats()['documents'], 0)
+
+        # Off unless configured
+        cache = StoredValueCache()
+        cache.read_mult(self.store, ['coeffs_a'])
+        cache.read_mult(self.store, ['coeffs_a'])
+        self.assertEquals(cache.stats()['documents'], 0)
+        self.assertIsNone(cache._subscriber)
+
+        # A single publisher, nothing is published when caching is off
+        self.svm.stored_value_cas('coeffs_a', {'offset':3.0})
+        self.assertEquals(publisher_mock.call_count, 1)
+        self.assertEquals(publisher_mock.return_value.publish_event.call_count, 2)
+        StoredValueManager(self.container, cache=cache).delete_stored_value('coeffs_a')
+        self.assertEquals(publisher_mock.return_value.publish_event.call_count, 2)
+        self.assertIsNone(cache._publisher)
+
+    def test_invalidated_while_reading(self):
+        def read_doc_mult(keys, strict=False):
+            # An update arrives while the documents are read
+            self.cache.invalidate(['coeffs_a'])
+            return [self.docs.get(k) for k in keys]
+        self.store.read_doc_mult.side_effect = read_doc_mult
+        self.assertEquals(self.svm.read_value('coeffs_a'), {'offset':1.0})
+        self.assertEquals(self.cache.stats()['documents'], 0)
+        self.svm.read_value('coeffs_a')
+        self.assertEquals(self.store.read_doc_mult.call_count, 2)
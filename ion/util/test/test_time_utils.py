@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+'''
+@file ion/util/test/test_time_utils.py
+@brief Unit tests for the time utilities
+'''
+
+from pyon.util.unit_test import PyonTestCase
+from ion.util.time_utils import TimeUtils
+from nose.plugins.attrib import attr
+
+import numpy as np
+
+
+@attr('UNIT', group='dm')
+class TimeUtilsUnitTest(PyonTestCase):
+    def test_find_indices(self):
+        arr = np.arange(0, 100, 10, dtype='float64')
+        vals = np.array([-5, 0, 4, 5, 6, 95, 1000], dtype='float64')
+
+        np.testing.assert_array_equal(TimeUtils.find_indices(arr, vals), [0, 0, 0, 0, 1, 9, 9])
+        np.testing.assert_array_equal(TimeUtils.find_indices(arr, vals, 'floor'), [0, 0, 0, 0, 0, 9, 9])
+        np.testing.assert_array_equal(TimeUtils.find_indices(arr, vals, 'ceil'), [0, 0, 1, 1, 1, 9, 9])
+
+        # Matches the scalar lookup
+        for val in vals:
+            self.assertEquals(TimeUtils.find_indices(arr, val)[0], TimeUtils.find_nearest(arr, val))
+
+        # Unsorted times
+        arr = np.array([30, 10, 20, 0], dtype='float64')
+        np.testing.assert_array_equal(TimeUtils.find_indices(arr, [1, 12, 29]), [3, 1, 0])
+
+        np.testing.assert_array_equal(TimeUtils.find_indices(np.array([5.]), [0, 10]), [0, 0])
+        self.assertRaises(ValueError, TimeUtils.find_indices, arr, vals, 'round')
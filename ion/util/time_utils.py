@@ -21,6 +21,21 @@ class TimeUtils(object):
         values = coverage.get_parameter_values(time_name)
         return cls.find_nearest(values,time)
 
+    @classmethod
+    def get_relative_times(cls, coverage, times, method='nearest'):
+        '''
+        Determines the relative times in the coverage model for an array of
+        times with a single read of the temporal parameter.
+        The times must match the coverage's time units
+        '''
+        time_name = coverage.temporal_parameter_name
+        pc = coverage.get_parameter_context(time_name)
+        units = pc.uom
+        if 'iso' in units:
+            return None
+        values = coverage.get_parameter_values(time_name)
+        return cls.find_indices(values, times, method)
+
     @classmethod
     def ts_to_units(cls,units, val):
         '''
@@ -67,3 +82,38 @@ class TimeUtils(object):
         '''
         idx = np.abs(arr-val).argmin()
         return idx
+
+    @classmethod
+    def find_indices(cls, arr, vals, method='nearest'):
+        '''
+        Vectorized index lookup of each value in vals against arr
+          nearest - index of the closest value (the lower index on ties)
+          floor   - index of the last value <= val (0 if there is none)
+          ceil    - index of the first value >= val (the last index if there is none)
+        '''
+        if method not in ('nearest', 'floor', 'ceil'):
+            raise ValueError('Unknown method: %s' % method)
+        arr = np.atleast_1d(arr)
+        vals = np.atleast_1d(vals)
+        if not arr.size:
+            raise ValueError('Cannot find indices in an empty array')
+        sorter = None
+        if arr.size > 1 and (np.diff(arr) < 0).any():
+            sorter = np.argsort(arr, kind='mergesort')
+            arr = arr[sorter]
+
+        last = arr.size - 1
+        if method == 'floor':
+            idx = np.clip(np.searchsorted(arr, vals, side='right') - 1, 0, last)
+        elif method == 'ceil':
+            idx = np.clip(np.searchsorted(arr, vals, side='left'), 0, last)
+        elif last == 0:
+            idx = np.zeros(vals.shape, dtype=np.intp)
+        else:
+            right = np.clip(np.searchsorted(arr, vals, side='left'), 1, last)
+            left = right - 1
+            idx = np.where((vals - arr[left]) <= (arr[right] - vals), left, right)
+
+        if sorter is not None:
+            idx = sorter[idx]
+        return idx